@@ -0,0 +1,264 @@
+"""Selective activation checkpointing of the transformer blocks and an estimate of what each choice costs.
+
+Checkpointing a module keeps only its inputs for the backward pass and recomputes its forward there. Instead of
+all-or-nothing, a `CheckpointPolicy` picks which parts of a `Block` are recomputed and in which layers:
+
+    "none"            keep every activation
+    "block"           recompute whole blocks, what `FSDPStrategy(activation_checkpointing_policy={Block})` does
+    "attention"       recompute only the attention of every block
+    "mlp"             recompute only the MLP of every block
+    "attention+mlp"   recompute both, keeping the normalized inputs and the residual stream
+    "<parts>:N"       the same in every Nth block only, starting with the first, e.g. "mlp:2" or "block:4"
+
+Which one is best depends on the shapes and on the memory at hand: `estimate` predicts the per-device memory and the
+relative throughput of a policy from the config, `micro_batch_size` and `block_size`, and `best_policy` picks the
+fastest one that fits a memory budget.
+"""
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import torch.nn as nn
+from typing_extensions import Self
+
+from lit_gpt.config import Config
+from lit_gpt.model import GPT
+
+PARTS = ("block", "attention", "mlp")
+
+
+def unwrap_fsdp(module: nn.Module) -> nn.Module:
+    """The module wrapped by `FullyShardedDataParallel`, or `module` itself if it is not wrapped."""
+    while hasattr(module, "_fsdp_wrapped_module"):
+        module = module._fsdp_wrapped_module
+    return module
+
+
+class CheckpointPolicy:
+    def __init__(self, parts: Tuple[str, ...] = (), every: int = 1) -> None:
+        """Recompute `parts` (any of `PARTS`) of every `every`th block."""
+        unknown = [part for part in parts if part not in PARTS]
+        if unknown:
+            raise ValueError(f"Unknown block parts {unknown}, expected some of {PARTS}")
+        if "block" in parts and len(parts) > 1:
+            raise ValueError("Checkpointing the whole block already recomputes its attention and MLP")
+        if every < 1:
+            raise ValueError(f"Expected checkpointing every N >= 1 layers, got {every}")
+        self.parts = tuple(part for part in PARTS if part in parts)
+        self.every = every
+        # the ids of the modules to wrap, found when the policy is applied to a `GPT`
+        self._targets: Set[int] = set()
+
+    @classmethod
+    def from_string(cls, spec: str) -> Self:
+        """Parse a policy such as "none", "mlp", "attention+mlp:2" or "block:4" (see the module docstring)."""
+        spec = spec.strip().lower()
+        parts, _, every = spec.partition(":")
+        if parts in ("", "none"):
+            return cls()
+        return cls(tuple(parts.split("+")), int(every) if every else 1)
+
+    def __str__(self) -> str:
+        if not self.parts:
+            return "none"
+        return "+".join(self.parts) + (f":{self.every}" if self.every > 1 else "")
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({str(self)!r})"
+
+    def __bool__(self) -> bool:
+        return bool(self.parts)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, CheckpointPolicy) and (self.parts, self.every) == (other.parts, other.every)
+
+    def __hash__(self) -> int:
+        return hash((self.parts, self.every))
+
+    def layers(self, n_layer: int) -> List[int]:
+        """The indices of the blocks that are (partly) recomputed."""
+        return list(range(0, n_layer, self.every)) if self.parts else []
+
+    def modules(self, model: GPT) -> List[nn.Module]:
+        """The submodules of `model` to checkpoint."""
+        modules = []
+        for i in self.layers(len(model.transformer.h)):
+            # under FSDP the block is the module wrapped by `FullyShardedDataParallel`: checkpointing the wrapper would
+            # put the recomputation around the all-gather instead of inside it, FSDP(CheckpointWrapper(Block))
+            block = unwrap_fsdp(model.transformer.h[i])
+            for part in self.parts:
+                modules.append(block if part == "block" else getattr(block, "attn" if part == "attention" else part))
+        return modules
+
+    def __call__(self, module: nn.Module, recurse: bool, nonwrapped_numel: int = 0, **kwargs: Any) -> bool:
+        """The auto wrap policy signature, so that `FSDPStrategy(activation_checkpointing_policy=policy)` applies it to
+        the FSDP wrapped model. The targets are found when the traversal reaches the `GPT`."""
+        if recurse:
+            if isinstance(module, GPT):
+                self._targets = {id(m) for m in self.modules(module)}
+            return True
+        return id(module) in self._targets
+
+    def apply(self, model: GPT) -> None:
+        """Wrap the selected submodules of `model` in place, for training without FSDP."""
+        if not self:
+            return
+        from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
+            CheckpointImpl,
+            apply_activation_checkpointing,
+            checkpoint_wrapper,
+        )
+
+        wrapper = partial(checkpoint_wrapper, checkpoint_impl=CheckpointImpl.NO_REENTRANT)
+        apply_activation_checkpointing(model, checkpoint_wrapper_fn=wrapper, auto_wrap_policy=self)
+
+
+def candidate_policies(every: Tuple[int, ...] = (1, 2, 4)) -> List[CheckpointPolicy]:
+    """"none" and every combination of parts and layer interval."""
+    policies = [CheckpointPolicy()]
+    for parts in (("mlp",), ("attention",), ("attention", "mlp"), ("block",)):
+        policies.extend(CheckpointPolicy(parts, n) for n in every)
+    return policies
+
+
+def layer_activation_bytes(config: Config, micro_batch_size: int, block_size: int, bytes_per_element: int = 2) -> Dict:
+    """What one block keeps for the backward pass, in bytes, by part, assuming flash attention (no (T, T) scores).
+
+    "norm_1" and "norm_2" are the inputs of the two norms, "attention" and "mlp" everything their layers save,
+    including their (normalized) input, which is also all a checkpointed part keeps ("attention_input", "mlp_input").
+    """
+    tokens = micro_batch_size * block_size
+    n_embd = tokens * config.n_embd * bytes_per_element
+    qkv = tokens * (config.n_head + 2 * config.n_query_groups) * config.head_size * bytes_per_element
+    # flash attention keeps the log-sum-exp of every query in float32
+    lse = tokens * config.n_head * 4
+    intermediate = tokens * config.intermediate_size * bytes_per_element
+    # the qkv input, the rotated q, k and v, and the attention output that is the projection input
+    attention = 2 * n_embd + qkv + lse
+    if config._mlp_class == "LLaMAMLP":
+        # the input, w1(x), w2(x), silu(w1(x)) and their product that is the w3 input
+        mlp = n_embd + 4 * intermediate
+    else:
+        # the input, fc(x) and gelu(fc(x))
+        mlp = n_embd + 2 * intermediate
+    return {
+        "norm_1": n_embd,
+        "attention": attention,
+        "attention_input": n_embd,
+        "norm_2": 0 if config.shared_attention_norm else n_embd,
+        "mlp": mlp,
+        "mlp_input": n_embd,
+        "block_input": n_embd,
+    }
+
+
+def layer_forward_flops(config: Config, micro_batch_size: int, block_size: int) -> Dict:
+    """Forward FLOPs of one block's attention and MLP."""
+    tokens = micro_batch_size * block_size
+    qkv = 2 * tokens * config.n_embd * (config.n_head + 2 * config.n_query_groups) * config.head_size
+    proj = 2 * tokens * config.n_embd * config.n_embd
+    # q @ k^T and scores @ v over the causal half of the (T, T) scores
+    scores = 2 * micro_batch_size * block_size**2 * config.n_head * config.head_size
+    n_linear = 3 if config._mlp_class == "LLaMAMLP" else 2
+    mlp = 2 * tokens * n_linear * config.n_embd * config.intermediate_size
+    return {"attention": qkv + proj + scores, "mlp": mlp}
+
+
+@dataclass
+class CheckpointEstimate:
+    policy: CheckpointPolicy
+    # bytes per device
+    activation_memory: float
+    total_memory: float
+    # compute without recomputation / compute with it
+    relative_throughput: float
+    fits: bool
+
+
+def estimate(
+    config: Config,
+    policy: CheckpointPolicy,
+    micro_batch_size: int,
+    block_size: Optional[int] = None,
+    n_devices: int = 1,
+    memory_budget: Optional[float] = None,
+    bytes_per_element: int = 2,
+    state_bytes_per_param: int = 16,
+    loss_chunk_size: int = 1024,
+) -> CheckpointEstimate:
+    """Predict the peak memory per device and the relative throughput of training with `policy`.
+
+    Args:
+        config: the model.
+        policy: what is recomputed.
+        micro_batch_size: sequences per device per forward.
+        block_size: tokens per sequence, `config.block_size` by default.
+        n_devices: FSDP shards the parameters, gradients and optimizer states over this many devices.
+        memory_budget: bytes available per device. `fits` is True when it is None.
+        bytes_per_element: of the activations, 2 with bf16 or fp16 (mixed) precision.
+        state_bytes_per_param: float32 weights, gradients and the two AdamW moments.
+        loss_chunk_size: tokens whose logits exist at once in the loss (see `lit_gpt.linear_cross_entropy`).
+    """
+    block_size = block_size or config.block_size
+    sizes = layer_activation_bytes(config, micro_batch_size, block_size, bytes_per_element)
+    flops = layer_forward_flops(config, micro_batch_size, block_size)
+    checkpointed = set(policy.layers(config.n_layer))
+
+    full = sizes["norm_1"] + sizes["attention"] + sizes["norm_2"] + sizes["mlp"]
+    if "block" in policy.parts:
+        kept = sizes["block_input"]
+        recomputed_flops = flops["attention"] + flops["mlp"]
+        # the backward of a checkpointed part holds its recomputed activations, one part at a time
+        recompute_peak = full
+    else:
+        kept, recomputed_flops, recompute_peak = full, 0, 0
+        for part in policy.parts:
+            kept += sizes[f"{part}_input"] - sizes[part]
+            recomputed_flops += flops[part]
+            recompute_peak = max(recompute_peak, sizes[part])
+    activations = len(checkpointed) * kept + (config.n_layer - len(checkpointed)) * full + recompute_peak
+
+    tokens = micro_batch_size * block_size
+    n_embd = tokens * config.n_embd * bytes_per_element
+    vocab = config.padded_vocab_size * config.n_embd
+    # the final norm input, and in a training step (with grad mode enabled, unlike validation) the hidden state
+    # gradient and float32 weight gradient that the chunked loss computes in the forward pass. plus one chunk of
+    # float32 logits, turned into their gradient in place and then cast to the activation dtype
+    chunk = min(loss_chunk_size or tokens, tokens)
+    activations += 2 * n_embd + 4 * vocab + (4 + bytes_per_element) * chunk * config.padded_vocab_size
+
+    layer_params = (
+        config.n_embd * (config.n_head + 2 * config.n_query_groups) * config.head_size
+        + config.n_embd * config.n_embd
+        + (3 if config._mlp_class == "LLaMAMLP" else 2) * config.n_embd * config.intermediate_size
+    )
+    n_params = config.n_layer * layer_params + 2 * vocab
+    # FSDP gathers the unsharded weights of the current and the prefetched block
+    states = state_bytes_per_param * n_params / n_devices + 2 * layer_params * bytes_per_element
+    total = activations + states
+
+    layer_flops = flops["attention"] + flops["mlp"]
+    head_flops = 2 * tokens * vocab
+    # forward and backward (3x the forward) plus the recomputed forwards
+    train_flops = 3 * (config.n_layer * layer_flops + head_flops)
+    relative_throughput = train_flops / (train_flops + len(checkpointed) * recomputed_flops)
+    fits = memory_budget is None or total <= memory_budget
+    return CheckpointEstimate(policy, activations, total, relative_throughput, fits)
+
+
+def best_policy(
+    config: Config,
+    micro_batch_size: int,
+    memory_budget: float,
+    candidates: Optional[List[CheckpointPolicy]] = None,
+    **kwargs: Any,
+) -> Tuple[Optional[CheckpointEstimate], List[CheckpointEstimate]]:
+    """The fastest of `candidates` (by default `candidate_policies()`) that fits `memory_budget` bytes per device, or
+    None if none does, and the estimates of all of them. `kwargs` go to `estimate`."""
+    estimates = [
+        estimate(config, policy, micro_batch_size, memory_budget=memory_budget, **kwargs)
+        for policy in candidates or candidate_policies()
+    ]
+    fitting = [e for e in estimates if e.fits]
+    best = max(fitting, key=lambda e: (e.relative_throughput, -e.total_memory)) if fitting else None
+    return best, estimates
@@ -5,6 +5,7 @@ https://arxiv.org/abs/2303.16199
 
 Port for Lit-GPT
 """
+import math
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -12,10 +13,13 @@ import torch
 import torch.nn as nn
 from typing_extensions import Self
 
+from lit_gpt import kernels
 from lit_gpt.config import Config as BaseConfig
+from lit_gpt.kernels import grouped_attention
 from lit_gpt.model import GPT as BaseModel
+from lit_gpt.model import Block as BaseBlock
 from lit_gpt.model import CausalSelfAttention as BaseCausalSelfAttention
-from lit_gpt.model import KVCache, RoPECache, apply_rope
+from lit_gpt.model import KVCache, RoPECache
 
 
 @dataclass
@@ -32,6 +36,7 @@ class GPT(BaseModel):
         nn.Module.__init__(self)
         assert config.padded_vocab_size is not None
         self.config = config
+        kernels.configure(config.kernels)
 
         self.lm_head = nn.Linear(config.n_embd, config.padded_vocab_size, bias=False)
         self.transformer = nn.ModuleDict(
@@ -45,18 +50,15 @@ class GPT(BaseModel):
         self.rope_cache: Optional[RoPECache] = None
         self.mask_cache: Optional[torch.Tensor] = None
         self.kv_caches: List[KVCache] = []
-        self.adapter_kv_caches: List[KVCache] = []
-
-    def reset_cache(self) -> None:
-        super().reset_cache()
-        self.adapter_kv_caches.clear()
 
     def forward(
         self,
         idx: torch.Tensor,
         max_seq_length: Optional[int] = None,
         input_pos: Optional[torch.Tensor] = None,
+        padding_mask: Optional[torch.Tensor] = None,
         lm_head_chunk_size: int = 0,
+        lm_head_positions: Optional[torch.Tensor] = None,
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
         B, T = idx.size()
         use_kv_cache = input_pos is not None
@@ -83,8 +85,7 @@ class GPT(BaseModel):
         if use_kv_cache:
             cos = cos.index_select(0, input_pos)
             sin = sin.index_select(0, input_pos)
-            mask = self.mask_cache.index_select(2, input_pos)
-            mask = mask[:, :, :, :max_seq_length]
+            cache_pos, mask = self.kv_cache_index(input_pos, max_seq_length, padding_mask)
         else:
             cos = cos[:T]
             sin = sin[:T]
@@ -97,13 +98,15 @@ class GPT(BaseModel):
             for block in self.transformer.h:
                 x, *_ = block(x, (cos, sin), max_seq_length)
         else:
-            self.kv_caches = self.kv_caches or self.build_kv_caches(x, max_seq_length, cos.size(-1))
-            self.adapter_kv_caches = self.adapter_kv_caches or [None for _ in range(self.config.n_layer)]
+            self.kv_caches = self.kv_caches or self.build_kv_caches(
+                x, max_seq_length, cos.size(-1) * 2, self.kv_cache_storage_dtype
+            )
             for i, block in enumerate(self.transformer.h):
-                x, self.kv_caches[i], self.adapter_kv_caches[i] = block(
-                    x, (cos, sin), max_seq_length, mask, input_pos, self.kv_caches[i], self.adapter_kv_caches[i]
-                )
+                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, cache_pos, self.kv_caches[i])
 
+        if lm_head_positions is not None:
+            # only compute the logits that are needed, e.g. the last prompt position when generating
+            x = x.index_select(1, lm_head_positions)
         x = self.transformer.ln_f(x)
 
         if lm_head_chunk_size > 0:
@@ -122,12 +125,12 @@ class GPT(BaseModel):
             module.reset_parameters()
 
 
-class Block(nn.Module):
+class Block(BaseBlock):
     """The implementation is identical to `lit_gpt.model.Block` with the exception that
     we replace the attention layer where adaption is implemented."""
 
     def __init__(self, config: Config, block_idx: int) -> None:
-        super().__init__()
+        nn.Module.__init__(self)
         self.norm_1 = config.norm_class(config.n_embd, eps=config.norm_eps)
         self.attn = CausalSelfAttention(config, block_idx)
         if not config.shared_attention_norm:
@@ -136,33 +139,6 @@ class Block(nn.Module):
 
         self.config = config
 
-    def forward(
-        self,
-        x: torch.Tensor,
-        rope: RoPECache,
-        max_seq_length: int,
-        mask: Optional[torch.Tensor] = None,
-        input_pos: Optional[torch.Tensor] = None,
-        kv_cache: Optional[KVCache] = None,
-        adapter_kv_cache: Optional[KVCache] = None,
-    ) -> Tuple[torch.Tensor, Optional[KVCache], Optional[KVCache]]:
-        n_1 = self.norm_1(x)
-        h, new_kv_cache, new_adapter_kv_cache = self.attn(
-            n_1, rope, max_seq_length, mask, input_pos, kv_cache, adapter_kv_cache
-        )
-        if self.config.parallel_residual:
-            n_2 = n_1 if self.config.shared_attention_norm else self.norm_2(x)
-            x = x + h + self.mlp(n_2)
-        else:
-            if self.config.shared_attention_norm:
-                raise NotImplementedError(
-                    "No checkpoint amongst the ones we support uses this configuration"
-                    " (non-parallel residual and shared attention norm)."
-                )
-            x = x + h
-            x = x + self.mlp(self.norm_2(x))
-        return x, new_kv_cache, new_adapter_kv_cache
-
 
 class CausalSelfAttention(BaseCausalSelfAttention):
     """A modification of `lit_gpt.model.CausalSelfAttention` that adds the attention
@@ -177,91 +153,53 @@ class CausalSelfAttention(BaseCausalSelfAttention):
             self.gating_factor = torch.nn.Parameter(torch.zeros(1, 1, config.n_head, 1))
             self.reset_parameters()
         self.block_idx = block_idx
-
-    def forward(
-        self,
-        x: torch.Tensor,
-        rope: RoPECache,
-        max_seq_length: int,
-        mask: Optional[torch.Tensor] = None,
-        input_pos: Optional[torch.Tensor] = None,
-        kv_cache: Optional[KVCache] = None,
-        adapter_kv_cache: Optional[KVCache] = None,
-    ) -> Tuple[torch.Tensor, Optional[KVCache], Optional[KVCache]]:
-        B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
-
-        qkv = self.attn(x)
-
-        # assemble into a number of query groups to support MHA, MQA and GQA together (see `config.n_query_groups`)
+        self.adapter_kv_cache: Optional[KVCache] = None
+        self._adapter_kv_key: Optional[Tuple] = None
+
+    def adapter_kv(self) -> KVCache:
+        """The keys and values of the adaption prompt, each of shape (1, adapter_prompt_length, n_query_groups, hs).
+
+        They only depend on the weights, so they are computed once and reused until `adapter_wte` or the qkv projection
+        change (an optimizer step, `load_state_dict`, moving the model). While autograd records through those weights
+        they are recomputed every forward so that the gradients reach them.
+        """
+        weights = (self.adapter_wte.weight, *self.attn.parameters())
+        key = tuple((p.data_ptr(), p._version) for p in weights)
+        recording = torch.is_grad_enabled() and any(p.requires_grad for p in weights)
+        if self.adapter_kv_cache is not None and key == self._adapter_kv_key and not recording:
+            return self.adapter_kv_cache
+
+        aT = self.config.adapter_prompt_length
         q_per_kv = self.config.n_head // self.config.n_query_groups
-        total_qkv = q_per_kv + 2  # each group has 1+ queries, 1 key, and 1 value
-        qkv = qkv.view(B, T, self.config.n_query_groups, total_qkv, self.config.head_size)
-        qkv = qkv.permute(0, 2, 3, 1, 4)  # (B, n_query_groups, total_qkv, T, hs)
-
-        # split batched computation into three
-        q, k, v = qkv.split((q_per_kv, 1, 1), dim=2)
-
-        # repeat k and v if necessary
-        if self.config.n_query_groups != 1:  # doing this would require a full kv cache with MQA (inefficient!)
-            # for MHA this is a no-op
-            k = k.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-            v = v.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-
-        q = q.reshape(B, -1, T, self.config.head_size)  # (B, nh_q, T, hs)
-        k = k.reshape(B, -1, T, self.config.head_size)  # (B, nh_k, T, hs)
-        v = v.reshape(B, -1, T, self.config.head_size)  # (B, nh_v, T, hs)
-
-        n_elem = int(self.config.rotary_percentage * self.config.head_size)
-
-        cos, sin = rope
-        q_roped = apply_rope(q[..., :n_elem], cos, sin)
-        k_roped = apply_rope(k[..., :n_elem], cos, sin)
-        q = torch.cat((q_roped, q[..., n_elem:]), dim=-1)
-        k = torch.cat((k_roped, k[..., n_elem:]), dim=-1)
-
-        if kv_cache is not None:
-            cache_k, cache_v = kv_cache
-            cache_k, cache_v = cache_k.to(dtype=k.dtype), cache_v.to(dtype=v.dtype)
-            # check if reached token limit
-            if input_pos[-1] >= max_seq_length:
-                input_pos = torch.tensor(max_seq_length - 1, device=input_pos.device)
-                # shift 1 position to the left
-                cache_k = torch.roll(cache_k, -1, dims=2)
-                cache_v = torch.roll(cache_v, -1, dims=2)
-            k = cache_k.index_copy_(2, input_pos, k)
-            v = cache_v.index_copy_(2, input_pos, v)
-            kv_cache = k, v
-
-        y = self.scaled_dot_product_attention(q, k, v, mask=mask)
-
+        prefix = self.adapter_wte.weight.reshape(1, aT, self.config.n_embd)
+        aqkv = self.attn(prefix)
+        aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
+        _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=-2)
+        ak = ak.reshape(1, aT, self.config.n_query_groups, self.config.head_size)
+        av = av.reshape(1, aT, self.config.n_query_groups, self.config.head_size)
+        if recording:
+            self.adapter_kv_cache, self._adapter_kv_key = None, None
+        else:
+            self.adapter_kv_cache, self._adapter_kv_key = (ak, av), key
+        return ak, av
+
+    def adapter_attention(self, q: torch.Tensor) -> torch.Tensor:
+        """Attend the queries (B, T, nh_q, hs) to the whole adaption prompt.
+
+        Every position sees every prompt token, so there is neither a mask nor causality and SDPA can pick its fused
+        kernels. The queries of a group share its prompt key and value head, which are not repeated.
+        """
+        ak, av = self.adapter_kv()
+        scale = 1.0 / math.sqrt(self.config.head_size)
+        return grouped_attention(q, ak.to(dtype=q.dtype), av.to(dtype=q.dtype), None, scale)
+
+    def scaled_dot_product_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        y = super().scaled_dot_product_attention(q, k, v, mask=mask)
         if self.block_idx >= self.config.adapter_start_layer:
-            aT = self.config.adapter_prompt_length
-            if adapter_kv_cache is not None:
-                ak, av = adapter_kv_cache
-            else:
-                prefix = self.adapter_wte.weight.reshape(1, aT, C)
-                aqkv = self.attn(prefix)
-                aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
-                aqkv = aqkv.permute(0, 2, 3, 1, 4)
-                _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=2)
-                if self.config.n_query_groups != 1:
-                    # for MHA this is a no-op
-                    ak = ak.repeat_interleave(q_per_kv, dim=2)
-                    av = av.repeat_interleave(q_per_kv, dim=2)
-                ak = ak.view(1, -1, aT, self.config.head_size)  # (1, nh_ak, aT, hs)
-                av = av.view(1, -1, aT, self.config.head_size)  # (1, nh_av, aT, hs)
-                adapter_kv_cache = (ak, av)
-
-            amask = torch.ones(T, aT, dtype=torch.bool, device=x.device)
-            ay = self.scaled_dot_product_attention(q, ak, av, amask)
-            y = y + self.gating_factor * ay
-
-        y = y.reshape(B, T, C)  # re-assemble all head outputs side by side
-
-        # output projection
-        y = self.proj(y)
-
-        return y, kv_cache, adapter_kv_cache
+            y = y + self.gating_factor * self.adapter_attention(q)
+        return y
 
     def reset_parameters(self) -> None:
         torch.nn.init.zeros_(self.gating_factor)
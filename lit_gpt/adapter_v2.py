@@ -13,12 +13,12 @@ import torch.nn as nn
 from typing_extensions import Self
 
 import lit_gpt
+from lit_gpt import kernels
 from lit_gpt.adapter import GPT as BaseModel
 from lit_gpt.adapter import Block as BaseBlock
+from lit_gpt.adapter import CausalSelfAttention as BaseCausalSelfAttention
 from lit_gpt.adapter import Config as BaseConfig
 from lit_gpt.adapter import KVCache, RoPECache
-from lit_gpt.model import CausalSelfAttention as BaseCausalSelfAttention
-from lit_gpt.model import apply_rope
 from lit_gpt.utils import map_old_state_dict_weights
 
 
@@ -67,6 +67,7 @@ class GPT(BaseModel):
         nn.Module.__init__(self)
         assert config.padded_vocab_size is not None
         self.config = config
+        kernels.configure(config.kernels)
 
         self.lm_head = AdapterV2Linear(config.n_embd, config.padded_vocab_size, bias=False)
         self.transformer = nn.ModuleDict(
@@ -80,7 +81,6 @@ class GPT(BaseModel):
         self.rope_cache: Optional[RoPECache] = None
         self.mask_cache: Optional[torch.Tensor] = None
         self.kv_caches: List[KVCache] = []
-        self.adapter_kv_caches: List[KVCache] = []
 
     @classmethod
     def from_name(cls, name: str, **kwargs: Any) -> Self:
@@ -139,94 +139,11 @@ class CausalSelfAttention(BaseCausalSelfAttention):
             self.gating_factor = torch.nn.Parameter(torch.zeros(1, 1, config.n_head, 1))
             self.reset_parameters()
         self.block_idx = block_idx
+        self.adapter_kv_cache: Optional[KVCache] = None
+        self._adapter_kv_key: Optional[Tuple] = None
 
         self.config = config
 
-    def forward(
-        self,
-        x: torch.Tensor,
-        rope: RoPECache,
-        max_seq_length: int,
-        mask: Optional[torch.Tensor] = None,
-        input_pos: Optional[torch.Tensor] = None,
-        kv_cache: Optional[KVCache] = None,
-        adapter_kv_cache: Optional[KVCache] = None,
-    ) -> Tuple[torch.Tensor, Optional[KVCache], Optional[KVCache]]:
-        B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
-
-        qkv = self.attn(x)
-
-        # assemble into a number of query groups to support MHA, MQA and GQA together (see `config.n_query_groups`)
-        q_per_kv = self.config.n_head // self.config.n_query_groups
-        total_qkv = q_per_kv + 2  # each group has 1+ queries, 1 key, and 1 value
-        qkv = qkv.view(B, T, self.config.n_query_groups, total_qkv, self.config.head_size)
-        qkv = qkv.permute(0, 2, 3, 1, 4)  # (B, n_query_groups, total_qkv, T, hs)
-
-        # split batched computation into three
-        q, k, v = qkv.split((q_per_kv, 1, 1), dim=2)
-
-        # repeat k and v if necessary
-        if self.config.n_query_groups != 1:  # doing this would require a full kv cache with MQA (inefficient!)
-            # for MHA this is a no-op
-            k = k.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-            v = v.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-
-        q = q.reshape(B, -1, T, self.config.head_size)  # (B, nh_q, T, hs)
-        k = k.reshape(B, -1, T, self.config.head_size)  # (B, nh_k, T, hs)
-        v = v.reshape(B, -1, T, self.config.head_size)  # (B, nh_v, T, hs)
-
-        n_elem = int(self.config.rotary_percentage * self.config.head_size)
-
-        cos, sin = rope
-        q_roped = apply_rope(q[..., :n_elem], cos, sin)
-        k_roped = apply_rope(k[..., :n_elem], cos, sin)
-        q = torch.cat((q_roped, q[..., n_elem:]), dim=-1)
-        k = torch.cat((k_roped, k[..., n_elem:]), dim=-1)
-
-        if kv_cache is not None:
-            cache_k, cache_v = kv_cache
-            cache_k, cache_v = cache_k.to(dtype=k.dtype), cache_v.to(dtype=v.dtype)
-            # check if reached token limit
-            if input_pos[-1] >= max_seq_length:
-                input_pos = torch.tensor(max_seq_length - 1, device=input_pos.device)
-                # shift 1 position to the left
-                cache_k = torch.roll(cache_k, -1, dims=2)
-                cache_v = torch.roll(cache_v, -1, dims=2)
-            k = cache_k.index_copy_(2, input_pos, k)
-            v = cache_v.index_copy_(2, input_pos, v)
-            kv_cache = k, v
-
-        y = self.scaled_dot_product_attention(q, k, v, mask=mask)
-
-        if self.block_idx >= self.config.adapter_start_layer:
-            aT = self.config.adapter_prompt_length
-            if adapter_kv_cache is not None:
-                ak, av = adapter_kv_cache
-            else:
-                prefix = self.adapter_wte.weight.reshape(1, aT, C)
-                aqkv = self.attn(prefix)
-                aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
-                aqkv = aqkv.permute(0, 2, 3, 1, 4)
-                _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=2)
-                if self.config.n_query_groups != 1:
-                    # for MHA this is a no-op
-                    ak = ak.repeat_interleave(q_per_kv, dim=2)
-                    av = av.repeat_interleave(q_per_kv, dim=2)
-                ak = ak.view(1, -1, aT, self.config.head_size)  # (1, nh_ak, aT, hs)
-                av = av.view(1, -1, aT, self.config.head_size)  # (1, nh_av, aT, hs)
-                adapter_kv_cache = (ak, av)
-
-            amask = torch.ones(T, aT, dtype=torch.bool, device=x.device)
-            ay = self.scaled_dot_product_attention(q, ak, av, amask)
-            y = y + self.gating_factor * ay
-
-        y = y.reshape(B, T, C)  # re-assemble all head outputs side by side
-
-        # output projection
-        y = self.proj(y)
-
-        return y, kv_cache, adapter_kv_cache
-
     def reset_parameters(self) -> None:
         torch.nn.init.zeros_(self.gating_factor)
 
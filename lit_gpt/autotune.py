@@ -0,0 +1,164 @@
+"""Pick the micro-batch size by measuring it.
+
+`autotune_micro_batch_size` runs a few real forward and backward passes of the set up model at increasing micro-batch
+sizes and returns the fastest in tokens per second. Only divisors of the per-device batch size are tried, so that
+gradient accumulation keeps the global batch size exactly.
+
+It stops before a size whose peak memory, extrapolated from the sizes measured so far, would not fit, so that no rank
+runs out of memory in the middle of the FSDP collectives, where the other ranks would wait for it forever. Recovering
+from an actual out-of-memory error only works on a single device.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import lightning as L
+import torch
+import torch.nn as nn
+
+
+@dataclass
+class MicroBatchTrial:
+    micro_batch_size: int
+    fits: bool
+    tokens_per_second: float = 0.0
+    # bytes, including `reserved_bytes`. 0 when the device does not report it
+    peak_memory: int = 0
+
+
+def candidate_sizes(batch_size: int, max_size: Optional[int] = None) -> List[int]:
+    """The divisors of the per-device `batch_size`, up to `max_size`."""
+    return [n for n in range(1, batch_size + 1) if batch_size % n == 0 and (max_size is None or n <= max_size)]
+
+
+def optimizer_state_bytes(model: nn.Module, n_states: int = 2) -> int:
+    """Memory of `n_states` buffers per trainable parameter (the AdamW moments), which only exist after the first
+    optimizer step. Under FSDP the parameters are this rank's shards."""
+    return n_states * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def probe(
+    fabric: L.Fabric,
+    model: nn.Module,
+    micro_batch_size: int,
+    block_size: int,
+    steps: int = 3,
+    reserved_bytes: int = 0,
+    memory_fraction: float = 0.95,
+) -> MicroBatchTrial:
+    """Time `steps` forward and backward passes (after one warm-up) of `micro_batch_size` random sequences.
+
+    The gradients accumulate without synchronization, like the accumulating iterations of training, and are freed
+    afterwards. A size fits when no rank runs out of memory and, on CUDA, when the peak memory plus `reserved_bytes` is
+    within `memory_fraction` of the device memory.
+
+    An out-of-memory error only counts as not fitting on a single device. With several ranks it is raised: the other
+    ranks are blocked in a collective that the failed rank will not join, and FSDP is left in the middle of a forward.
+    """
+    device = fabric.device
+    x = torch.randint(0, model.config.vocab_size, (micro_batch_size, block_size + 1), device=device)
+    input_ids, targets = x[:, :-1].contiguous(), x[:, 1:].contiguous()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    out_of_memory = False
+    elapsed = 0.0
+    try:
+        for i in range(steps + 1):
+            _sync(device)
+            t0 = time.perf_counter()
+            with fabric.no_backward_sync(model, enabled=True):
+                loss = model(input_ids, targets=targets)
+                fabric.backward(loss)
+            _sync(device)
+            if i:
+                elapsed += time.perf_counter() - t0
+    except torch.cuda.OutOfMemoryError:
+        if fabric.world_size > 1:
+            raise
+        out_of_memory = True
+    loss = None
+    model.zero_grad(set_to_none=True)
+
+    peak = 0
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated() + reserved_bytes
+        out_of_memory |= peak > memory_fraction * torch.cuda.get_device_properties(device).total_memory
+        torch.cuda.empty_cache()
+    # every rank has to agree, the slowest one sets the pace
+    out_of_memory = fabric.all_reduce(torch.tensor(float(out_of_memory), device=device), reduce_op="max").item() > 0
+    elapsed = fabric.all_reduce(torch.tensor(elapsed, device=device), reduce_op="max").item()
+    if out_of_memory:
+        return MicroBatchTrial(micro_batch_size, fits=False, peak_memory=peak)
+    return MicroBatchTrial(micro_batch_size, True, steps * micro_batch_size * block_size / elapsed, peak)
+
+
+def predict_peak_memory(trials: List[MicroBatchTrial], base_memory: int, micro_batch_size: int) -> int:
+    """Extrapolate the peak memory of `micro_batch_size` linearly from the last two fitting `trials`, or from the only
+    one and `base_memory`, the memory in use without any activation."""
+    measured = [(0, base_memory)] + [(t.micro_batch_size, t.peak_memory) for t in trials if t.fits]
+    (n0, m0), (n1, m1) = measured[-2:]
+    return int(m1 + (m1 - m0) / (n1 - n0) * (micro_batch_size - n1))
+
+
+def autotune_micro_batch_size(
+    fabric: L.Fabric,
+    model: nn.Module,
+    block_size: int,
+    batch_size: int,
+    max_size: Optional[int] = None,
+    reserved_bytes: int = 0,
+    memory_fraction: float = 0.95,
+    **probe_kwargs,
+) -> Tuple[int, List[MicroBatchTrial]]:
+    """The micro-batch size with the highest throughput that fits, and all the trials.
+
+    Args:
+        fabric: the fabric `model` is set up with.
+        model: the set up `GPT`.
+        block_size: tokens per sequence.
+        batch_size: sequences per device per optimizer step.
+        max_size: the largest micro-batch size to try.
+        reserved_bytes: memory that training needs on top of the probe, e.g. `optimizer_state_bytes(model)`.
+        memory_fraction: of the device memory that the peak memory, predicted or measured, must stay within.
+        probe_kwargs: passed to `probe`, e.g. `steps`.
+    """
+    device = fabric.device
+    limit = base_memory = 0
+    if device.type == "cuda":
+        limit = memory_fraction * torch.cuda.get_device_properties(device).total_memory
+        base_memory = torch.cuda.memory_allocated(device) + reserved_bytes
+    trials = []
+    for size in candidate_sizes(batch_size, max_size):
+        if limit and trials:
+            predicted = predict_peak_memory(trials, base_memory, size)
+            # decided by every rank together, before any of them tries the size
+            too_large = torch.tensor(float(predicted > limit), device=device)
+            if fabric.all_reduce(too_large, reduce_op="max").item() > 0:
+                trials.append(MicroBatchTrial(size, fits=False, peak_memory=predicted))
+                fabric.print(f"micro_batch_size {size}: predicted out of memory, peak memory {predicted / 1e9:.2f} GB")
+                break
+        trial = probe(
+            fabric,
+            model,
+            size,
+            block_size,
+            reserved_bytes=reserved_bytes,
+            memory_fraction=memory_fraction,
+            **probe_kwargs,
+        )
+        trials.append(trial)
+        peak = f", peak memory {trial.peak_memory / 1e9:.2f} GB" if trial.peak_memory else ""
+        if not trial.fits:
+            fabric.print(f"micro_batch_size {size}: out of memory{peak}")
+            break
+        fabric.print(f"micro_batch_size {size}: {trial.tokens_per_second:,.0f} tokens/s per device{peak}")
+    fitting = [trial for trial in trials if trial.fits]
+    if not fitting:
+        raise RuntimeError("Not even a micro-batch of one sequence fits in memory")
+    return max(fitting, key=lambda trial: trial.tokens_per_second).micro_batch_size, trials
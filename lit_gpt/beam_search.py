@@ -0,0 +1,126 @@
+"""Beam search over `lit_gpt.GPT` with the KV cache.
+
+Every decode step keeps the `num_beams` best continuations, which requires gathering the KV cache rows of their parent
+beams. Instead of building a new cache for each step, the rows are gathered with `index_select` into a second,
+preallocated set of caches and the two sets are swapped, so the search allocates no cache memory after its first step.
+"""
+from typing import Iterable, List, Tuple
+
+import torch
+
+from lit_gpt.generate import prefill
+from lit_gpt.model import GPT, KVCache
+
+
+def reorder_kv_caches(kv_caches: List[KVCache], out: List[KVCache], beam_idx: torch.Tensor) -> List[KVCache]:
+    """Gather the rows `beam_idx` of every layer's keys and values into the preallocated `out` caches."""
+    for (k, v), (out_k, out_v) in zip(kv_caches, out):
+        torch.index_select(k, 0, beam_idx, out=out_k)
+        torch.index_select(v, 0, beam_idx, out=out_v)
+    return out
+
+
+def _empty_like_batch(kv_caches: List[KVCache], batch_size: int) -> List[KVCache]:
+    return [
+        (k.new_empty((batch_size,) + k.shape[1:]), v.new_empty((batch_size,) + v.shape[1:])) for k, v in kv_caches
+    ]
+
+
+@torch.no_grad()
+def beam_search(
+    model: GPT,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    *,
+    num_beams: int = 4,
+    length_penalty: float = 1.0,
+    early_stopping: bool = False,
+    stop_tokens: Iterable[int] = (),
+) -> List[Tuple[torch.Tensor, float]]:
+    """Find the most likely continuations of `prompt` with beam search.
+
+    Args:
+        model: the model to search with.
+        prompt: 1D tensor of token ids.
+        max_new_tokens: maximum number of tokens to generate.
+        num_beams: number of continuations kept at every step.
+        length_penalty: a hypothesis scores its summed log-probability divided by `length ** length_penalty`, where
+            `length` counts the generated tokens. Values above 0 favour longer outputs.
+        early_stopping: stop as soon as `num_beams` hypotheses are finished. Otherwise, stop once no running beam can
+            score better than the worst finished hypothesis.
+        stop_tokens: a hypothesis is finished when it produces one of these tokens.
+
+    Returns:
+        Up to `num_beams` hypotheses as (generated tokens without the stop token, score) pairs, best first.
+    """
+    T = prompt.size(0)
+    max_seq_length = T + max_new_tokens
+    assert max_seq_length <= model.config.block_size, (
+        f"Cannot generate {max_new_tokens} tokens after a prompt of {T} tokens, block size is only"
+        f" {model.config.block_size}"
+    )
+    assert model.kv_cache_storage_dtype != torch.int8, "Beam search does not support the int8 KV cache"
+    device = prompt.device
+    stop_tokens = set(stop_tokens)
+
+    def score(logprob: float, length: int) -> float:
+        return logprob / length**length_penalty
+
+    # (score, tokens) of the best finished hypotheses, best first
+    finished: List[Tuple[float, torch.Tensor]] = []
+
+    def add_finished(tokens: torch.Tensor, logprob: float, length: int) -> None:
+        finished.append((score(logprob, length), tokens))
+        finished.sort(key=lambda h: h[0], reverse=True)
+        del finished[num_beams:]
+
+    logprobs = torch.log_softmax(prefill(model, prompt.unsqueeze(0), max_seq_length).float(), dim=-1)
+    beam_scores = torch.zeros(1, device=device)
+    beam_tokens = torch.empty((1, 0), dtype=prompt.dtype, device=device)
+    spare = _empty_like_batch(model.kv_caches, num_beams)
+    input_pos = torch.tensor([T], device=device)
+
+    for step in range(max_new_tokens):
+        vocab_size = logprobs.size(-1)
+        candidates = (beam_scores.unsqueeze(1) + logprobs).view(-1)
+        # twice as many candidates as beams: even if half of them stop, enough remain to continue every beam
+        top_scores, top_idx = torch.topk(candidates, min(2 * num_beams, candidates.numel()))
+        next_scores, next_beams, next_tokens = [], [], []
+        for rank, (cand_score, idx) in enumerate(zip(top_scores.tolist(), top_idx.tolist())):
+            beam, token = divmod(idx, vocab_size)
+            if token in stop_tokens:
+                # like a running beam, a finished hypothesis must rank among the `num_beams` best candidates
+                if rank < num_beams:
+                    add_finished(beam_tokens[beam], cand_score, step + 1)
+                continue
+            next_scores.append(cand_score)
+            next_beams.append(beam)
+            next_tokens.append(token)
+            if len(next_tokens) == num_beams:
+                break
+        if not next_tokens:
+            break
+
+        beam_idx = torch.tensor(next_beams, device=device)
+        beam_scores = torch.tensor(next_scores, device=device)
+        new_tokens = torch.tensor(next_tokens, dtype=prompt.dtype, device=device)
+        beam_tokens = torch.cat((beam_tokens.index_select(0, beam_idx), new_tokens.unsqueeze(1)), dim=1)
+        if step == max_new_tokens - 1:
+            # the beams still running at the length limit compete with the finished hypotheses
+            for tokens, logprob in zip(beam_tokens, next_scores):
+                add_finished(tokens, logprob, step + 1)
+            break
+        if len(finished) >= num_beams and (early_stopping or score(next_scores[0], step + 1) <= finished[-1][0]):
+            break
+
+        if spare[0][0].size(0) != len(next_beams):
+            # the prefill cache has a single row: the search needs a second full-size set after its first step
+            spare = _empty_like_batch(model.kv_caches, len(next_beams))
+        kv_caches = model.kv_caches
+        model.kv_caches = reorder_kv_caches(kv_caches, spare, beam_idx)
+        spare = kv_caches
+        logits = model(new_tokens.unsqueeze(1), max_seq_length, input_pos)[:, -1]
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+        input_pos = input_pos + 1
+
+    return [(tokens, hyp_score) for hyp_score, tokens in finished]
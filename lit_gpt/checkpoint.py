@@ -0,0 +1,258 @@
+"""Sharded training checkpoints written asynchronously.
+
+`fabric.save` with FSDP's full state dict gathers the whole model and optimizer state on rank 0 and every rank waits
+while it writes a single `.pth`. `AsyncCheckpointer` instead copies each rank's own shard of the parameters and of the
+optimizer state to host memory (pinned and reused across saves) and writes it from a background thread while training
+continues. A checkpoint only appears under its final name once every rank has written its part:
+
+    iter-000100-token-...-ckpt.tmp/      while it is written
+        rank-00000-of-00008.pt           the shard of a rank, renamed into place once written
+        rank-00000-of-00008.done         the completion marker of that rank
+        meta.pt                          the rest of the state (iteration counters, hparams), from rank 0
+    iter-000100-token-...-ckpt/          renamed by rank 0 once every marker exists
+
+A shard holds the local views of the original parameters that FSDP keeps with `use_orig_params=True` and the optimizer
+state of the rank, so a sharded checkpoint resumes on the same number of devices. Legacy full `.pth` checkpoints still
+load through `fabric.load`, on any number of devices.
+"""
+import copy
+import os
+import shutil
+import threading
+import time
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import lightning as L
+import torch
+import torch.nn as nn
+
+# "sharded" is written by `AsyncCheckpointer`, "full" is a single `.pth` from `fabric.save`
+CHECKPOINT_FORMATS = ("sharded", "full")
+META_FILENAME = "meta.pt"
+MARKER_SUFFIX = ".done"
+TMP_SUFFIX = ".tmp"
+# added to the parameter names by Fabric, FSDP, activation checkpointing and `torch.compile`
+_WRAPPER_PREFIXES = (
+    "_forward_module.",
+    "_original_module.",
+    "_fsdp_wrapped_module.",
+    "_checkpoint_wrapped_module.",
+    "_orig_mod.",
+)
+
+
+def shard_name(rank: int, world_size: int) -> str:
+    return f"rank-{rank:05d}-of-{world_size:05d}.pt"
+
+
+def checkpoint_iteration(path: Path) -> int:
+    """The iteration in the name of a checkpoint, e.g. 100 for `iter-000100-token-...-ckpt`."""
+    return int(path.name.split("-")[1])
+
+
+def is_sharded_checkpoint(path: Path) -> bool:
+    """Whether `path` is a complete checkpoint written by `AsyncCheckpointer`."""
+    return path.is_dir() and not path.name.endswith(TMP_SUFFIX) and (path / META_FILENAME).is_file()
+
+
+def sharded_checkpoints(directory: Path) -> List[Path]:
+    """The complete sharded checkpoints in `directory`, oldest first."""
+    return sorted((p for p in directory.glob("iter-*") if is_sharded_checkpoint(p)), key=checkpoint_iteration)
+
+
+def latest_checkpoint(directory: Path) -> Optional[Path]:
+    """The complete checkpoint of `directory` with the highest iteration, sharded or a legacy full `.pth`."""
+    candidates = sharded_checkpoints(directory) + list(directory.glob("iter-*.pth"))
+    return max(candidates, key=checkpoint_iteration, default=None)
+
+
+def remove_incomplete_checkpoints(directory: Path) -> List[Path]:
+    """Delete the checkpoints of `directory` that a previous run left half-written. Call it on one rank only."""
+    incomplete = [p for p in directory.glob(f"iter-*{TMP_SUFFIX}") if p.is_dir()]
+    for path in incomplete:
+        shutil.rmtree(path)
+    return incomplete
+
+
+def remove_old_checkpoints(directory: Path, keep_last: Optional[int], keep_every: Optional[int] = None) -> List[Path]:
+    """Delete the complete sharded checkpoints of `directory` except the `keep_last` most recent ones and those whose
+    `step_count` is a multiple of `keep_every`. `keep_last=None` keeps everything. Legacy `.pth` files are left alone.
+    """
+    if keep_last is None:
+        return []
+    checkpoints = sharded_checkpoints(directory)
+    removed = []
+    for path in checkpoints[: max(len(checkpoints) - keep_last, 0)]:
+        if keep_every and torch.load(path / META_FILENAME)["state"].get("step_count", 0) % keep_every == 0:
+            continue
+        shutil.rmtree(path)
+        removed.append(path)
+    return removed
+
+
+def _clean_name(name: str) -> str:
+    for prefix in _WRAPPER_PREFIXES:
+        name = name.replace(prefix, "")
+    return name
+
+
+def _named_tensors(module: nn.Module) -> Iterator[Tuple[str, torch.Tensor]]:
+    for name, tensor in chain(module.named_parameters(), module.named_buffers()):
+        yield _clean_name(name), tensor
+
+
+def _unwrap(optimizer: torch.optim.Optimizer) -> torch.optim.Optimizer:
+    # the state of the optimizer itself, which is local to the rank, rather than the one the strategy would gather
+    return getattr(optimizer, "optimizer", optimizer)
+
+
+def local_state(state: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Split `state` into the shard of this rank (the tensors of the modules and the state dicts of the optimizers)
+    and the rest."""
+    shard, rest = {}, {}
+    for key, obj in state.items():
+        if isinstance(obj, nn.Module):
+            shard[key] = {name: tensor.detach() for name, tensor in _named_tensors(obj)}
+        elif isinstance(obj, torch.optim.Optimizer):
+            shard[key] = _unwrap(obj).state_dict()
+        else:
+            rest[key] = obj
+    return shard, rest
+
+
+def _atomic_save(obj: Any, path: Path) -> None:
+    tmp_path = path.with_name(path.name + TMP_SUFFIX)
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer:
+    """Saves sharded checkpoints of a training state in the background.
+
+    Args:
+        fabric: the launched `Fabric`, for the rank and the number of ranks.
+        keep_last: the number of most recent checkpoints kept in the directory of the saved ones, None to keep all.
+        keep_every: also keep the checkpoints whose `step_count` is a multiple of this.
+        timeout: seconds rank 0 waits for the shards of the other ranks before it fails the checkpoint.
+    """
+
+    def __init__(
+        self,
+        fabric: L.Fabric,
+        keep_last: Optional[int] = None,
+        keep_every: Optional[int] = None,
+        timeout: float = 3600.0,
+    ) -> None:
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(f"keep_last={keep_last} would delete the checkpoint just written, expected at least 1")
+        self.fabric = fabric
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.timeout = timeout
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        # host copies of the shard, reused by the next save when the shapes are unchanged
+        self._buffers: Dict[Tuple, torch.Tensor] = {}
+
+    def save(self, path: Union[str, Path], state: Dict[str, Any]) -> None:
+        """Snapshot the shard of this rank of `state` and write it to the directory `path` in the background.
+
+        The copies to host memory are queued on the current CUDA stream, so training can go on right away: the
+        parameter and optimizer updates that follow run after them. Waits for the previous checkpoint first.
+        """
+        self.wait()
+        shard, rest = local_state(state)
+        shard = self._to_host(shard, ())
+        rest = copy.deepcopy(rest)
+        event = None
+        if torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        self._thread = threading.Thread(target=self._run, args=(Path(path), shard, rest, event))
+        self._thread.start()
+
+    def wait(self) -> None:
+        """Block until the checkpoint being written is done on this rank and raise the error of its writer, if any."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the last checkpoint failed") from error
+
+    def _to_host(self, obj: Any, key: Tuple) -> Any:
+        if isinstance(obj, torch.Tensor):
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=obj.is_cuda)
+                self._buffers[key] = buffer
+            return buffer.copy_(obj, non_blocking=obj.is_cuda)
+        if isinstance(obj, dict):
+            return {k: self._to_host(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_host(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def _run(self, path: Path, shard: Dict[str, Any], rest: Dict[str, Any], event: Optional[torch.cuda.Event]) -> None:
+        try:
+            if event is not None:
+                event.synchronize()
+            self._write(path, shard, rest)
+        except BaseException as e:
+            self._error = e
+
+    def _write(self, path: Path, shard: Dict[str, Any], rest: Dict[str, Any]) -> None:
+        rank, world_size = self.fabric.global_rank, self.fabric.world_size
+        tmp_dir = path.with_name(path.name + TMP_SUFFIX)
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        shard_path = tmp_dir / shard_name(rank, world_size)
+        _atomic_save(shard, shard_path)
+        shard_path.with_suffix(MARKER_SUFFIX).touch()
+        if rank != 0:
+            return
+        _atomic_save({"world_size": world_size, "state": rest}, tmp_dir / META_FILENAME)
+        markers = [(tmp_dir / shard_name(r, world_size)).with_suffix(MARKER_SUFFIX) for r in range(world_size)]
+        deadline = time.monotonic() + self.timeout
+        while not all(marker.exists() for marker in markers):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Not every rank wrote its shard of {str(path)!r} within {self.timeout}s")
+            time.sleep(1.0)
+        if path.exists():
+            # a previous run saved the same iteration
+            shutil.rmtree(path)
+        os.replace(tmp_dir, path)
+        remove_old_checkpoints(path.parent, self.keep_last, self.keep_every)
+
+
+def load_checkpoint(fabric: L.Fabric, path: Union[str, Path], state: Dict[str, Any]) -> None:
+    """Load the checkpoint `path` into `state` in place: a sharded one written by `AsyncCheckpointer` or a legacy full
+    `.pth` written by `fabric.save`."""
+    path = Path(path)
+    if not is_sharded_checkpoint(path):
+        fabric.load(path, state)
+        return
+    meta = torch.load(path / META_FILENAME)
+    if meta["world_size"] != fabric.world_size:
+        raise ValueError(
+            f"{str(path)!r} is sharded over {meta['world_size']} ranks and only resumes on as many, not on"
+            f" {fabric.world_size}"
+        )
+    shard = torch.load(path / shard_name(fabric.global_rank, fabric.world_size), map_location="cpu")
+    for key, obj in state.items():
+        if isinstance(obj, nn.Module):
+            saved = shard[key]
+            with torch.no_grad():
+                for name, tensor in _named_tensors(obj):
+                    if name not in saved:
+                        raise KeyError(f"{name!r} is missing from {str(path)!r}")
+                    if saved[name].shape != tensor.shape:
+                        raise ValueError(
+                            f"{name!r} has the shape {tuple(saved[name].shape)} in {str(path)!r} and"
+                            f" {tuple(tensor.shape)} in the model"
+                        )
+                    tensor.copy_(saved[name])
+        elif isinstance(obj, torch.optim.Optimizer):
+            _unwrap(obj).load_state_dict(shard[key])
+    state.update(meta["state"])
@@ -0,0 +1,47 @@
+"""Opt-in `torch.compile` of `GPT` for training and for KV-cache decoding.
+
+Training compiles every `Block` in place ("regional" compilation): the blocks share their code, FSDP and activation
+checkpointing wrap them as before, the parameter names stay the same, and the embedding and the chunked loss, which is
+a Python loop, stay eager. Decoding compiles `decode_one`, whose shapes are static once the KV cache is allocated: one
+token per row, a (1,) position and caches of `max_seq_length` slots.
+
+Inside the compiled regions the ops use their PyTorch references (see `lit_gpt.kernels`) and the KV cache index has no
+data-dependent branch (see `GPT.static_kv_cache_index`), so neither breaks the graph. `scripts/report_graph_breaks.py`
+lists the breaks that remain.
+"""
+from typing import Any, Callable, Optional
+
+import torch
+
+from lit_gpt.generate import decode_one
+from lit_gpt.model import GPT
+from lit_gpt.utils import find_multiple
+
+
+def compile_blocks(model: GPT, **kwargs: Any) -> GPT:
+    """Compile the forward of every transformer block of `model` in place. `kwargs` go to `torch.compile`."""
+    for block in model.transformer.h:
+        if hasattr(block, "compile"):
+            block.compile(**kwargs)
+        else:
+            # `nn.Module.compile` is torch >= 2.2
+            block.forward = torch.compile(block.forward, **kwargs)
+    return model
+
+
+_compiled_decode_one: Optional[Callable] = None
+
+
+def compiled_decode_one(**kwargs: Any) -> Callable:
+    """`decode_one` compiled without dynamic shapes, created on the first call. `kwargs` go to `torch.compile`."""
+    global _compiled_decode_one
+    if _compiled_decode_one is None:
+        kwargs.setdefault("dynamic", False)
+        _compiled_decode_one = torch.compile(decode_one, **kwargs)
+    return _compiled_decode_one
+
+
+def static_max_seq_length(max_seq_length: int, block_size: int, multiple: int = 256) -> int:
+    """Round the KV cache length up, so that compiled decoding sees the same cache shapes for prompts and generation
+    lengths that differ slightly instead of recompiling for each of them."""
+    return min(find_multiple(max_seq_length, multiple), block_size)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, Literal, Optional, Type
+from typing import Any, Dict, Literal, Optional, Type
 
 import torch
 from typing_extensions import Self
@@ -49,6 +49,8 @@ class Config:
     _mlp_class: Literal["GptNeoxMLP", "LLaMAMLP"] = "GptNeoxMLP"
     intermediate_size: Optional[int] = None
     condense_ratio: int = 1
+    # kernel backend per op, e.g. `{"rmsnorm": "torch"}`. unset ops use the fastest available (see `lit_gpt.kernels`)
+    kernels: Optional[Dict[str, str]] = None
 
     def __post_init__(self):
         # error checking
@@ -0,0 +1,236 @@
+"""Continuous batching: requests join and leave the running batch at every decode step.
+
+All active requests share a single batched forward per step through a `PagedKVCache`, so a request that arrives while
+others are generating only waits for the current step instead of for the whole batch to finish.
+"""
+import asyncio
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import torch
+
+from lit_gpt import lora
+from lit_gpt.generate import sample
+from lit_gpt.model import GPT
+from lit_gpt.paged_kv_cache import PagedKVCache, forward_paged
+
+
+@dataclass
+class Request:
+    prompt: torch.Tensor
+    max_new_tokens: int
+    temperature: float = 1.0
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    stop_tokens: Tuple[int, ...] = ()
+    # index of the LoRA adapter to generate with (see `lit_gpt.lora.load_adapter_stack`), -1 for the base model
+    adapter: int = -1
+    id: int = 0
+    output: List[int] = field(default_factory=list)
+    # set by `ContinuousBatchingEngine.cancel`, the request is then dropped at the next step
+    cancelled: bool = False
+    # receives every generated token, then `None` once the request is retired
+    stream: Optional[asyncio.Queue] = None
+    loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def emit(self, token: Optional[int]) -> None:
+        if self.stream is not None:
+            self.loop.call_soon_threadsafe(self.stream.put_nowait, token)
+
+
+class ContinuousBatchingEngine:
+    def __init__(self, model: GPT, cache: PagedKVCache, max_batch_size: int = 16, metrics_window: int = 50) -> None:
+        """Schedules requests onto a shared model, admitting and retiring sequences at every decode step.
+
+        Args:
+            model: the model to generate with.
+            cache: the paged KV cache shared by all active requests.
+            max_batch_size: maximum number of sequences decoded together.
+            metrics_window: number of recent steps the tokens/sec metric is averaged over.
+        """
+        self.model = model
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.waiting: Deque[Request] = deque()
+        self.active: List[Request] = []
+        self._ids = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._step_history: Deque[Tuple[float, int]] = deque(maxlen=metrics_window)
+        self.total_tokens = 0
+        self.completed_requests = 0
+        self.preempted_requests = 0
+        self.cancelled_requests = 0
+        # the LoRA adapters requests can choose from, loaded with `lit_gpt.lora.load_adapter_stack` before the engine
+        self.num_adapters = lora.num_stacked_adapters(model) if isinstance(model, lora.GPT) else 0
+
+    @property
+    def max_sequence_length(self) -> int:
+        """The longest prompt and output a request can reach: the block size, or the whole cache for a single
+        sequence."""
+        return min(self.model.config.block_size, self.cache.num_pages * self.cache.page_size)
+
+    def check_prompt(self, prompt: torch.Tensor) -> None:
+        """Raise a `ValueError` for a prompt that could never be admitted."""
+        if prompt.size(0) == 0:
+            raise ValueError("The prompt is empty")
+        # the prefill also reserves the position of the first decode step
+        if prompt.size(0) >= self.max_sequence_length:
+            raise ValueError(
+                f"The prompt has {prompt.size(0)} tokens, at most {self.max_sequence_length - 1} fit in the model and"
+                f" the KV cache"
+            )
+
+    def add_request(self, request: Request) -> Request:
+        """Queue `request`. Raises a `ValueError` if its prompt could never be admitted or its adapter is not loaded."""
+        self.check_prompt(request.prompt)
+        if request.adapter >= self.num_adapters:
+            raise ValueError(f"Adapter {request.adapter} was requested but {self.num_adapters} are loaded")
+        request.id = next(self._ids)
+        self.waiting.append(request)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return request
+
+    async def generate(self, prompt: torch.Tensor, max_new_tokens: int, **kwargs) -> AsyncIterator[int]:
+        """Queue a request and yield its tokens as they are generated."""
+        loop = asyncio.get_running_loop()
+        request = Request(prompt, max_new_tokens, stream=asyncio.Queue(), loop=loop, **kwargs)
+        self.add_request(request)
+        try:
+            while (token := await request.stream.get()) is not None:
+                yield token
+        finally:
+            # the consumer stopped early, e.g. its client disconnected
+            self.cancel(request)
+
+    def cancel(self, request: Request) -> None:
+        """Stop generating for `request`. It leaves the queue or the batch at the next step, which runs in the worker
+        thread, so the cache is never freed under a running forward. Does nothing for a retired request."""
+        request.cancelled = True
+
+    def metrics(self) -> Dict[str, float]:
+        history = list(self._step_history)
+        if len(history) > 1:
+            tokens_per_sec = sum(n for _, n in history[1:]) / max(history[-1][0] - history[0][0], 1e-9)
+        else:
+            tokens_per_sec = 0.0
+        return {
+            "queue_depth": len(self.waiting),
+            "active_requests": len(self.active),
+            "tokens_per_sec": tokens_per_sec,
+            "total_tokens": self.total_tokens,
+            "completed_requests": self.completed_requests,
+            "preempted_requests": self.preempted_requests,
+            "cancelled_requests": self.cancelled_requests,
+            "free_cache_tokens": self.cache.num_free_tokens,
+        }
+
+    def _sample(self, request: Request, logits: torch.Tensor) -> int:
+        return int(sample(logits, request.temperature, request.top_k, request.top_p))
+
+    def _is_finished(self, request: Request) -> bool:
+        return (
+            request.output[-1] in request.stop_tokens
+            or len(request.output) >= request.max_new_tokens
+            or request.prompt.size(0) + len(request.output) >= self.max_sequence_length
+        )
+
+    def _set_adapters(self, requests: List[Request]) -> None:
+        # without a stack of adapters, a LoRA model applies its single adapter to every row
+        if self.num_adapters:
+            adapter_idx = torch.tensor([r.adapter for r in requests], device=self.cache.device)
+            lora.set_adapter_index(self.model, adapter_idx)
+
+    def _drop_cancelled(self) -> None:
+        for request in [r for r in self.waiting if r.cancelled]:
+            self.waiting.remove(request)
+            self.cancelled_requests += 1
+        for request in [r for r in self.active if r.cancelled]:
+            self.active.remove(request)
+            self.cache.free_sequence(request.id)
+            self.cancelled_requests += 1
+
+    def _retire(self, request: Request) -> None:
+        self.cache.free_sequence(request.id)
+        request.emit(None)
+        self.completed_requests += 1
+
+    def _admit(self) -> int:
+        """Prefill waiting requests while there is room in the batch and in the cache."""
+        admitted = 0
+        while self.waiting and len(self.active) < self.max_batch_size:
+            request = self.waiting[0]
+            # a preempted request resumes by prefilling its prompt and the tokens it already generated
+            idx = torch.cat((request.prompt, request.prompt.new_tensor(request.output)))
+            # one extra position for its first decode step. `check_prompt` and `_is_finished` keep this within
+            # `max_sequence_length`, so the request always fits in an empty cache
+            pages_needed = self.cache.pages_needed(request.id, idx.size(0) + 1)
+            if pages_needed > len(self.cache.free_pages):
+                break
+            self.waiting.popleft()
+            idx = idx.to(self.cache.device).unsqueeze(0)
+            self.cache.add_sequence(request.id)
+            last = torch.tensor([idx.size(1) - 1], device=idx.device)
+            self._set_adapters([request])
+            logits = forward_paged(self.model, idx, self.cache, [request.id], lm_head_positions=last)
+            token = self._sample(request, logits[:, -1])
+            request.output.append(token)
+            request.emit(token)
+            admitted += 1
+            if self._is_finished(request):
+                self._retire(request)
+            else:
+                self.active.append(request)
+        return admitted
+
+    def _preempt_for_decode(self) -> None:
+        """Free the most recently admitted requests until every active one has room for its next token."""
+        while sum(self.cache.pages_needed(r.id, 1) for r in self.active) > len(self.cache.free_pages):
+            request = self.active.pop()
+            self.cache.free_sequence(request.id)
+            self.waiting.appendleft(request)
+            self.preempted_requests += 1
+
+    @torch.no_grad()
+    def step(self) -> int:
+        """Run one scheduling iteration: admit new requests, decode one token for all active ones, retire the finished.
+
+        Returns:
+            The number of generated tokens.
+        """
+        self._drop_cancelled()
+        generated = self._admit()
+        self._preempt_for_decode()
+        if self.active:
+            seq_ids = [r.id for r in self.active]
+            idx = torch.tensor([[r.output[-1]] for r in self.active], device=self.cache.device)
+            # requests for different adapters share the batch, each row picks its own LoRA weights
+            self._set_adapters(self.active)
+            logits = forward_paged(self.model, idx, self.cache, seq_ids)[:, -1]
+            still_active = []
+            for request, row in zip(self.active, logits):
+                token = self._sample(request, row.unsqueeze(0))
+                request.output.append(token)
+                request.emit(token)
+                if self._is_finished(request):
+                    self._retire(request)
+                else:
+                    still_active.append(request)
+            generated += len(self.active)
+            self.active = still_active
+        self.total_tokens += generated
+        self._step_history.append((time.perf_counter(), generated))
+        return generated
+
+    async def run(self) -> None:
+        """Serve requests forever. The model runs in a worker thread so the event loop stays responsive."""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            if not self.waiting and not self.active:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await loop.run_in_executor(None, self.step)
@@ -2,7 +2,14 @@
 
 import torch
 import torch.nn as nn
-import xentropy_cuda_lib
+
+from lit_gpt import kernels
+
+try:
+    import xentropy_cuda_lib
+except ImportError:
+    # the fused kernel is optional, `lit_gpt.kernels` falls back to the PyTorch cross-entropy without it
+    xentropy_cuda_lib = None
 
 # `all_gather_into_tensor` and `reduce_scatter_tensor` are new placeholders for
 # `_all_gather_base` and `_reduce_scatter_base`. They require the most recent
@@ -129,12 +136,12 @@ class FusedCrossEntropyLoss(nn.Module):
         self.process_group = process_group
 
     def forward(self, input, target):
-        assert input.is_cuda and target.is_cuda
         # SoftmaxCrossEntropyLoss implicitly casts to float
         if len(input.shape) == 3:
             input = input.view(-1, input.size(-1))
             target = target.view(-1)
-        loss = SoftmaxCrossEntropyLossFn.apply(
+        # the fused kernel on CUDA when installed, else the PyTorch reference (see `lit_gpt.kernels`)
+        loss = kernels.get("cross_entropy", input)(
             input,
             target,
             self.label_smoothing,
@@ -0,0 +1,196 @@
+"""Native KV-cache generation for `lit_gpt.GPT`: prefill the prompt once, then decode one token at a time."""
+
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+
+from lit_gpt.model import GPT
+from lit_gpt.prefix_cache import PrefixCache
+
+
+def left_pad(prompts: List[torch.Tensor], pad_id: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Stack prompts of different lengths into a batch, padding on the left so that every row ends at the same column.
+
+    Returns:
+        The (B, T) token ids and a (B, T) boolean mask that is False at the padding positions.
+    """
+    T = max(p.size(0) for p in prompts)
+    device = prompts[0].device
+    idx = torch.full((len(prompts), T), pad_id, dtype=prompts[0].dtype, device=device)
+    padding_mask = torch.zeros((len(prompts), T), dtype=torch.bool, device=device)
+    for i, p in enumerate(prompts):
+        idx[i, T - p.size(0) :] = p
+        padding_mask[i, T - p.size(0) :] = True
+    return idx, padding_mask
+
+
+def logits_to_probs(
+    logits: torch.Tensor, temperature: float = 1.0, top_k: Optional[int] = None, top_p: Optional[float] = None
+) -> torch.Tensor:
+    """The sampling distribution over the last dimension of `logits`. A temperature of 0 gives the one-hot argmax."""
+    logits = logits.float()
+    if temperature == 0.0:
+        return torch.nn.functional.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).to(logits.dtype)
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = logits.masked_fill(logits < v[..., -1:], -float("inf"))
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # drop the low-probability tail whose total mass is below `1 - top_p`, always keeping the most likely token
+        sorted_to_remove = cumulative_probs <= 1 - top_p
+        sorted_to_remove[..., -1:] = False
+        to_remove = sorted_to_remove.scatter(-1, sorted_idx, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, -float("inf"))
+    return torch.nn.functional.softmax(logits, dim=-1)
+
+
+def sample(
+    logits: torch.Tensor, temperature: float = 1.0, top_k: Optional[int] = None, top_p: Optional[float] = None
+) -> torch.Tensor:
+    """Pick the next token for every row of `logits` (B, vocab_size). A temperature of 0 means greedy decoding."""
+    if temperature == 0.0:
+        return torch.argmax(logits, dim=-1)
+    probs = logits_to_probs(logits, temperature, top_k, top_p)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+
+def prefill(
+    model: GPT,
+    idx: torch.Tensor,
+    max_seq_length: int,
+    padding_mask: Optional[torch.Tensor] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+) -> torch.Tensor:
+    """Run the whole (left-padded) prompt through the model, filling the KV cache.
+
+    With a `prefix_cache`, the longest cached prefix of a single unpadded prompt is restored instead of recomputed, and
+    the prompt is added to the cache afterwards.
+
+    Returns:
+        The logits of the last prompt position, (B, vocab_size).
+    """
+    model.reset_cache()
+    start = 0
+    if prefix_cache is not None:
+        assert idx.size(0) == 1, "The prefix cache only supports a single prompt"
+        # the last prompt token is always forwarded, its logits give the first new token
+        start = prefix_cache.restore(model, idx[0, :-1], max_seq_length)
+    input_pos = torch.arange(start, idx.size(1), device=idx.device)
+    logits = model(
+        idx[:, start:],
+        max_seq_length,
+        input_pos,
+        padding_mask=padding_mask,
+        lm_head_positions=torch.tensor([idx.size(1) - start - 1], device=idx.device),
+    )
+    if prefix_cache is not None:
+        prefix_cache.insert(idx[0], model.kv_caches)
+    return logits[:, -1]
+
+
+def decode_one(
+    model: GPT,
+    token: torch.Tensor,
+    input_pos: torch.Tensor,
+    max_seq_length: int,
+    padding_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Feed one token per row (B,) at position `input_pos` (1,) through the model, reusing the KV cache.
+
+    Returns:
+        The logits for the next position, (B, vocab_size).
+    """
+    logits = model(token.view(-1, 1), max_seq_length, input_pos, padding_mask=padding_mask)
+    return logits[:, -1]
+
+
+@torch.no_grad()
+def generate(
+    model: GPT,
+    prompts: List[torch.Tensor],
+    max_new_tokens: int,
+    *,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+    stop_tokens: Iterable[int] = (),
+    pad_id: int = 0,
+    prefix_cache: Optional[PrefixCache] = None,
+    compile: bool = False,
+) -> List[torch.Tensor]:
+    """Generate continuations for a batch of prompts.
+
+    Args:
+        model: the model to sample from.
+        prompts: 1D tensors of token ids, possibly of different lengths. They are left padded into one batch.
+        max_new_tokens: maximum number of tokens to generate per prompt.
+        temperature: scales the logits before sampling. 0 selects greedy decoding.
+        top_k: if set, only sample among the `top_k` most likely tokens.
+        top_p: if set, only sample among the smallest set of tokens whose cumulative probability exceeds `top_p`.
+        stop_tokens: a row stops as soon as it produces one of these tokens. The batch stops once all rows did.
+        pad_id: token used for left padding and to fill rows that already stopped.
+        prefix_cache: if set, reuse the keys and values of previously seen prompt prefixes. Requires a single prompt.
+        compile: decode with `torch.compile` (see `lit_gpt.compile`). The KV cache length is rounded up so that the
+            decode step keeps its shapes across calls. The prompt is prefilled eagerly.
+
+    Returns:
+        For each prompt, the generated tokens without the prompt and without the stop token.
+    """
+    idx, padding_mask = left_pad(prompts, pad_id)
+    B, T = idx.size()
+    max_seq_length = T + max_new_tokens
+    assert max_seq_length <= model.config.block_size, (
+        f"Cannot generate {max_new_tokens} tokens after a prompt of {T} tokens, block size is only"
+        f" {model.config.block_size}"
+    )
+    step = decode_one
+    if compile:
+        from lit_gpt.compile import compiled_decode_one, static_max_seq_length
+
+        step = compiled_decode_one()
+        max_seq_length = static_max_seq_length(max_seq_length, model.config.block_size)
+    device = idx.device
+    padding_mask = torch.cat(
+        (padding_mask, torch.ones((B, max_seq_length - T), dtype=torch.bool, device=device)), dim=1
+    )
+    stop_tokens = torch.tensor(list(stop_tokens), dtype=idx.dtype, device=device)
+
+    logits = prefill(model, idx, max_seq_length, padding_mask, prefix_cache)
+    input_pos = torch.tensor([T], device=device)
+    finished = torch.zeros(B, dtype=torch.bool, device=device)
+    tokens = []
+    for i in range(max_new_tokens):
+        next_token = sample(logits, temperature, top_k, top_p).to(dtype=idx.dtype)
+        next_token = next_token.masked_fill(finished, pad_id)
+        tokens.append(next_token)
+        finished |= torch.isin(next_token, stop_tokens)
+        if i == max_new_tokens - 1 or finished.all():
+            break
+        logits = step(model, next_token, input_pos, max_seq_length, padding_mask)
+        input_pos = input_pos + 1
+
+    tokens = torch.stack(tokens, dim=1).cpu()
+    is_stop = torch.isin(tokens, stop_tokens.cpu())
+    outputs = []
+    for row, row_is_stop in zip(tokens, is_stop):
+        stops = row_is_stop.nonzero()
+        outputs.append(row[: stops[0, 0]] if len(stops) else row)
+    return outputs
+
+
+@torch.no_grad()
+def continuation_logprobs(model: GPT, context: torch.Tensor, continuation: torch.Tensor) -> torch.Tensor:
+    """Score `continuation` given `context` (both 1D token ids) in a single forward.
+
+    Only the positions that predict a continuation token go through the LM head.
+
+    Returns:
+        The log-probability of every continuation token, (len(continuation),).
+    """
+    idx = torch.cat((context, continuation)).unsqueeze(0)
+    positions = torch.arange(context.size(0) - 1, idx.size(1) - 1, device=idx.device)
+    logits = model(idx, lm_head_positions=positions)[0].float()
+    logprobs = torch.nn.functional.log_softmax(logits, dim=-1)
+    return logprobs.gather(-1, continuation.long().unsqueeze(-1)).squeeze(-1)
@@ -0,0 +1,348 @@
+"""Kernel backends for the hot ops: attention, rotary embedding, RMSNorm, SwiGLU and cross-entropy.
+
+Every op has a fused CUDA backend, imported the first time it is needed, and a PyTorch reference ("torch") that runs
+anywhere, so the package imports and runs on machines without flash-attn, xformers or the flash-attn CUDA extensions.
+By default ("auto") an op uses the first backend of `BACKENDS[op]` that imports and supports the input's device and
+dtype. A backend can be forced per op with `select`, `Config.kernels` or the `LIT_GPT_KERNELS` environment variable,
+which takes precedence: `LIT_GPT_KERNELS=torch` uses the references everywhere and
+`LIT_GPT_KERNELS=rmsnorm=torch,attention=flash_attn` picks them op by op.
+
+Under `torch.compile`, every op uses its PyTorch reference (see `compile_with_references`): the fused backends are
+opaque autograd functions or extension calls that break the graph, while inductor fuses the references itself and SDPA
+dispatches to its flash attention kernel on CUDA.
+"""
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from lightning_utilities.core.imports import RequirementCache
+
+FlashAttention2Available = RequirementCache("flash-attn>=2.0.0.post1")
+# `scaled_dot_product_attention(..., enable_gqa=True)` attends grouped keys and values without repeating them
+# a plain bool, so that `torch.compile` does not trace the requirement check
+SDPAEnableGQAAvailable = bool(RequirementCache("torch>=2.5.0"))
+
+
+@dataclass(frozen=True)
+class Backend:
+    name: str
+    # imports the implementation. raises `ImportError` when its extension is not installed
+    load: Callable[[], Callable]
+    # whether the implementation runs on an input, based on its device and dtype
+    supports: Callable[[torch.Tensor], bool] = lambda x: True
+
+
+# the backends of every op, preferred first
+BACKENDS: Dict[str, List[Backend]] = {}
+_selected: Dict[str, str] = {}
+_env_selected: Optional[Dict[str, str]] = None
+_loaded: Dict[Tuple[str, str], Callable] = {}
+_resolved: Dict[Tuple[str, str, torch.dtype], Callable] = {}
+# the "torch" backend of every op, loaded when registered
+_references: Dict[str, Callable] = {}
+# whether code traced by `torch.compile` uses the "torch" backends. False keeps the eager choice, e.g. to list the
+# graph breaks of the fused backends (see `scripts/report_graph_breaks.py`)
+compile_with_references: bool = True
+
+
+def register(op: str, backend: Backend) -> None:
+    """Add a backend for `op`, with a lower priority than the ones already registered."""
+    BACKENDS.setdefault(op, []).append(backend)
+    if backend.name == "torch":
+        _references[op] = backend.load()
+    _resolved.clear()
+
+
+def backend_names(op: str) -> List[str]:
+    if op not in BACKENDS:
+        raise ValueError(f"Unknown op {op!r}, expected one of {sorted(BACKENDS)}")
+    return [backend.name for backend in BACKENDS[op]]
+
+
+def _check(op: str, name: str) -> None:
+    if name != "auto" and name not in backend_names(op):
+        raise ValueError(f"Unknown {op} backend {name!r}, expected 'auto' or one of {backend_names(op)}")
+
+
+def select(op: str, name: str) -> None:
+    """Use the backend `name` for `op` in this process. "auto" restores the default resolution."""
+    _check(op, name)
+    _selected[op] = name
+    _resolved.clear()
+
+
+def configure(choices: Optional[Dict[str, str]]) -> None:
+    """`select` the backends of a `{op: name}` mapping, e.g. `Config.kernels`."""
+    for op, name in (choices or {}).items():
+        select(op, name)
+
+
+def _env_choices() -> Dict[str, str]:
+    global _env_selected
+    if _env_selected is None:
+        choices = {}
+        for entry in filter(None, os.environ.get("LIT_GPT_KERNELS", "").replace(" ", "").split(",")):
+            op, _, name = entry.rpartition("=")
+            # an entry without an op applies to all of them
+            for each in [op] if op else BACKENDS:
+                _check(each, name)
+                choices[each] = name
+        _env_selected = choices
+    return _env_selected
+
+
+def load(op: str, name: str) -> Callable:
+    """Import the implementation of the backend `name` of `op`. Raises `ImportError` if it is not installed."""
+    if (op, name) not in _loaded:
+        _check(op, name)
+        backend = next(backend for backend in BACKENDS[op] if backend.name == name)
+        _loaded[(op, name)] = backend.load()
+    return _loaded[(op, name)]
+
+
+def available(op: str, x: torch.Tensor) -> List[str]:
+    """The backends of `op` that are installed and support the input `x`."""
+    names = []
+    for backend in BACKENDS[op]:
+        try:
+            load(op, backend.name)
+        except ImportError:
+            continue
+        if backend.supports(x):
+            names.append(backend.name)
+    return names
+
+
+def is_compiling() -> bool:
+    """Whether the caller is being traced by `torch.compile`."""
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "is_compiling"):
+        return torch.compiler.is_compiling()
+    return torch._dynamo.is_compiling()
+
+
+def get(op: str, x: torch.Tensor) -> Callable:
+    """The implementation of `op` for the input `x`, resolved once per device type and dtype.
+
+    A selected backend that does not support `x` (e.g. flash-attn with float32 inputs) falls back to "torch", one that
+    is not installed raises `ImportError`. Code traced by `torch.compile` gets the "torch" backend.
+    """
+    if compile_with_references and is_compiling():
+        return _references[op]
+    key = (op, x.device.type, x.dtype)
+    fn = _resolved.get(key)
+    if fn is None:
+        fn = _resolved[key] = _resolve(op, x)
+    return fn
+
+
+def _resolve(op: str, x: torch.Tensor) -> Callable:
+    name = _env_choices().get(op) or _selected.get(op, "auto")
+    if name != "auto":
+        backend = next(backend for backend in BACKENDS[op] if backend.name == name)
+        return load(op, name) if backend.supports(x) else load(op, "torch")
+    for backend in BACKENDS[op]:
+        if not backend.supports(x):
+            continue
+        try:
+            return load(op, backend.name)
+        except ImportError:
+            continue
+    raise RuntimeError(f"No {op} backend supports {x.device.type} {x.dtype} inputs")
+
+
+def _is_cuda(x: torch.Tensor) -> bool:
+    return x.is_cuda
+
+
+def _is_cuda_half(x: torch.Tensor) -> bool:
+    return x.is_cuda and x.dtype in (torch.float16, torch.bfloat16)
+
+
+########################
+# Attention
+# (B, T, nh_q, hs) queries, (B, T, n_query_groups, hs) keys and values, causal
+########################
+
+
+def grouped_attention(
+    q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor], scale: float
+) -> torch.Tensor:
+    """Attention of (B, T, nh_q, hs) queries to (B or 1, S, n_query_groups, hs) keys and values without repeating them.
+
+    The `q_per_kv` queries of a group are folded into the sequence dimension, (B, n_query_groups, q_per_kv * T, hs), so
+    that every group attends to its single key and value head and the keys and values (the whole KV cache when
+    decoding) are never copied `q_per_kv` times.
+
+    Args:
+        q: queries, whose heads are ordered group by group like the fused qkv projection.
+        k: keys.
+        v: values.
+        mask: optional boolean (1 or B, 1, T, S) mask, True where attention is allowed. `None` attends to every key.
+        scale: scale of the attention scores.
+
+    Returns:
+        The (B, T, nh_q, hs) attention output.
+    """
+    B, T, n_head, head_size = q.shape
+    groups = k.size(2)
+    q_per_kv = n_head // groups
+    q = q.view(B, T, groups, q_per_kv, head_size).permute(0, 2, 3, 1, 4).reshape(B, groups, q_per_kv * T, head_size)
+    k = k.transpose(1, 2).expand(B, -1, -1, -1)  # (B, n_query_groups, S, hs)
+    v = v.transpose(1, 2).expand(B, -1, -1, -1)
+    if mask is not None:
+        # every folded query row keeps the mask row of its position
+        mask = mask.unsqueeze(2).expand(-1, -1, q_per_kv, -1, -1).reshape(mask.size(0), 1, q_per_kv * T, -1)
+    y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, scale=scale)
+    y = y.view(B, groups, q_per_kv, T, head_size).permute(0, 3, 1, 2, 4)
+    return y.reshape(B, T, n_head, head_size)
+
+
+def causal_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, scale: float) -> torch.Tensor:
+    kwargs = {}
+    if q.size(2) != k.size(2):
+        if SDPAEnableGQAAvailable:
+            # `enable_gqa` lets the causal fused kernels take fewer key and value heads than query heads
+            kwargs = {"enable_gqa": True}
+        else:
+            # an explicit causal mask would rule out the fused kernels, repeating the keys and values of the sequence
+            # being trained on costs less. The heads of a group are adjacent, see `grouped_attention`
+            q_per_kv = q.size(2) // k.size(2)
+            k, v = k.repeat_interleave(q_per_kv, dim=2), v.repeat_interleave(q_per_kv, dim=2)
+    y = F.scaled_dot_product_attention(
+        q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), dropout_p=0.0, scale=scale, is_causal=True, **kwargs
+    )
+    return y.transpose(1, 2)
+
+
+def _flash_attention() -> Callable:
+    if not FlashAttention2Available:
+        raise ImportError(str(FlashAttention2Available))
+    from flash_attn import flash_attn_func
+
+    def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, scale: float) -> torch.Tensor:
+        # flash-attn takes grouped keys and values as they are
+        return flash_attn_func(q, k, v, dropout_p=0.0, softmax_scale=scale, causal=True)
+
+    return attention
+
+
+register("attention", Backend("flash_attn", _flash_attention, _is_cuda_half))
+register("attention", Backend("torch", lambda: causal_attention))
+
+
+########################
+# Rotary embedding
+# (B, T, nh, hs) inputs, (T, n_elem / 2) cos and sin, rotating the first `n_elem` channels of every head
+########################
+
+
+def apply_rotary_emb(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    # computed in float32 like the fused kernel
+    half = cos.size(-1)
+    cos = cos.float().unsqueeze(1)  # (T, 1, n_elem / 2)
+    sin = sin.float().unsqueeze(1)
+    x1 = x[..., :half].float()
+    x2 = x[..., half : 2 * half].float()
+    roped = torch.cat((x1 * cos - x2 * sin, x1 * sin + x2 * cos), dim=-1).to(dtype=x.dtype)
+    return torch.cat((roped, x[..., 2 * half :]), dim=-1)
+
+
+def _fused_rotary_emb() -> Callable:
+    from lit_gpt.fused_rotary_embedding import apply_rotary_emb_func
+
+    def rotary_emb(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+        # GPT-NeoX style halves, written in place
+        return apply_rotary_emb_func(x, cos, sin, False, True)
+
+    return rotary_emb
+
+
+register("rotary", Backend("fused", _fused_rotary_emb, _is_cuda))
+register("rotary", Backend("torch", lambda: apply_rotary_emb))
+
+
+########################
+# RMSNorm
+########################
+
+
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    # computed in float32 like the fused kernel
+    x_float = x.float()
+    x_normed = x_float * torch.rsqrt(x_float.pow(2).mean(dim=-1, keepdim=True) + eps)
+    return (x_normed * weight.float()).to(dtype=x.dtype)
+
+
+def _fused_rms_norm() -> Callable:
+    import dropout_layer_norm  # noqa: F401
+
+    from lit_gpt.rmsnorm import rms_norm as fused_rms_norm
+
+    return fused_rms_norm
+
+
+register("rmsnorm", Backend("fused", _fused_rms_norm, _is_cuda))
+register("rmsnorm", Backend("torch", lambda: rms_norm))
+
+
+########################
+# SwiGLU
+# w3(silu(w1(x)) * w2(x))
+########################
+
+
+def swiglu(
+    x: torch.Tensor,
+    w1: torch.Tensor,
+    b1: Optional[torch.Tensor],
+    w2: torch.Tensor,
+    b2: Optional[torch.Tensor],
+    w3: torch.Tensor,
+    b3: Optional[torch.Tensor],
+) -> torch.Tensor:
+    return F.linear(F.silu(F.linear(x, w1, b1)) * F.linear(x, w2, b2), w3, b3)
+
+
+def _xformers_swiglu() -> Callable:
+    from xformers.ops import swiglu as xformers_swiglu
+
+    return xformers_swiglu
+
+
+register("swiglu", Backend("xformers", _xformers_swiglu, _is_cuda))
+register("swiglu", Backend("torch", lambda: swiglu))
+
+
+########################
+# Cross-entropy
+# (N, vocab_size) logits and (N,) labels to (N,) losses, 0 at `ignore_index`
+########################
+
+
+def cross_entropy(
+    logits: torch.Tensor,
+    labels: torch.Tensor,
+    smoothing: float = 0.0,
+    ignore_index: int = -100,
+    inplace_backward: bool = False,
+    process_group: Optional[object] = None,
+) -> torch.Tensor:
+    if process_group is not None:
+        raise NotImplementedError("The torch cross-entropy backend does not support tensor parallel logits")
+    return F.cross_entropy(
+        logits.float(), labels, ignore_index=ignore_index, label_smoothing=smoothing, reduction="none"
+    )
+
+
+def _fused_cross_entropy() -> Callable:
+    import xentropy_cuda_lib  # noqa: F401
+
+    from lit_gpt.fused_cross_entropy import SoftmaxCrossEntropyLossFn
+
+    return SoftmaxCrossEntropyLossFn.apply
+
+
+register("cross_entropy", Backend("fused", _fused_cross_entropy, _is_cuda))
+register("cross_entropy", Backend("torch", lambda: cross_entropy))
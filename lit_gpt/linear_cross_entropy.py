@@ -0,0 +1,93 @@
+"""Cross-entropy of the `lm_head` projection of the final hidden states, computed without materializing the logits.
+
+With `micro_batch_size=16`, `block_size=2048` and a 32000 token vocabulary, the logits alone take 2 GB in bfloat16 and
+their float32 gradient twice that, more than the activations of several transformer layers. `linear_cross_entropy`
+projects and scores the tokens chunk by chunk instead: the gradients of the hidden states and of the `lm_head` weight
+are computed in the forward pass while each chunk of logits is alive, then freed, so the peak memory of the loss is one
+(chunk_size, vocab_size) block. Under `torch.no_grad()`, e.g. in validation, only the loss is computed.
+"""
+import torch
+import torch.nn.functional as F
+
+
+class ChunkedLinearCrossEntropyFn(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx,
+        hidden: torch.Tensor,
+        weight: torch.Tensor,
+        targets: torch.Tensor,
+        chunk_size: int,
+        ignore_index: int,
+        grad_enabled: bool,
+    ) -> torch.Tensor:
+        """
+        hidden: (N, n_embd) final hidden states
+        weight: (vocab_size, n_embd) `lm_head` weight
+        targets: (N,) next token ids, `ignore_index` where there is nothing to predict
+        grad_enabled: whether grad mode was enabled by the caller, it is always disabled inside `forward`
+        Returns the cross-entropy averaged over the targets that are not ignored.
+        """
+        need_hidden_grad = grad_enabled and ctx.needs_input_grad[0]
+        need_weight_grad = grad_enabled and ctx.needs_input_grad[1]
+        grad_hidden = torch.empty_like(hidden) if need_hidden_grad else None
+        # accumulated over the chunks in float32, like the weight gradient of the full logits
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if need_weight_grad else None
+        loss = torch.zeros((), device=hidden.device, dtype=torch.float32)
+        weight_t = weight.to(dtype=hidden.dtype).t()
+        for start in range(0, hidden.size(0), chunk_size):
+            h = hidden[start : start + chunk_size]
+            t = targets[start : start + chunk_size]
+            valid = t != ignore_index
+            t = t.masked_fill(~valid, 0)
+            logits = (h @ weight_t).float()  # (chunk_size, vocab_size)
+            lse = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(1, t.unsqueeze(1)).squeeze(1)
+            loss += ((lse - target_logits) * valid).sum()
+            if not (need_hidden_grad or need_weight_grad):
+                continue
+            # d(lse - target_logit) / d(logits) = softmax(logits) - one_hot(target), reusing the logits' memory
+            grad_logits = logits.sub_(lse.unsqueeze(1)).exp_()
+            grad_logits[torch.arange(t.size(0), device=t.device), t] -= 1
+            grad_logits.mul_(valid.unsqueeze(1))
+            grad_logits = grad_logits.to(dtype=h.dtype)
+            if need_hidden_grad:
+                grad_hidden[start : start + chunk_size] = grad_logits @ weight_t.t()
+            if need_weight_grad:
+                grad_weight += (grad_logits.t() @ h).float()
+        n_valid = (targets != ignore_index).sum().clamp(min=1)
+        ctx.save_for_backward(grad_hidden, grad_weight, n_valid)
+        ctx.weight_dtype = weight.dtype
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_loss: torch.Tensor):
+        grad_hidden, grad_weight, n_valid = ctx.saved_tensors
+        scale = grad_loss / n_valid
+        if grad_hidden is not None:
+            grad_hidden = grad_hidden * scale.to(dtype=grad_hidden.dtype)
+        if grad_weight is not None:
+            grad_weight = (grad_weight * scale).to(dtype=ctx.weight_dtype)
+        return grad_hidden, grad_weight, None, None, None, None
+
+
+def linear_cross_entropy(
+    hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, chunk_size: int = 1024, ignore_index: int = -1
+) -> torch.Tensor:
+    """The mean cross-entropy of `hidden @ weight.T` against `targets`.
+
+    Args:
+        hidden: (..., n_embd) final hidden states.
+        weight: (vocab_size, n_embd) `lm_head` weight.
+        targets: (...) target token ids.
+        chunk_size: number of tokens whose logits exist at once. 0 materializes all the logits, which is the reference
+            implementation.
+        ignore_index: target value that does not contribute to the loss.
+    """
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    targets = targets.reshape(-1)
+    if chunk_size == 0:
+        return F.cross_entropy(F.linear(hidden, weight).float(), targets, ignore_index=ignore_index)
+    return ChunkedLinearCrossEntropyFn.apply(
+        hidden, weight, targets, chunk_size, ignore_index, torch.is_grad_enabled()
+    )
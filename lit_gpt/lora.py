@@ -42,6 +42,7 @@ two matrices of a lower rank.
 """
 
 import math
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
@@ -51,6 +52,7 @@ from torch.nn import functional as F
 from typing_extensions import Self
 
 import lit_gpt
+from lit_gpt import kernels
 from lit_gpt.config import Config as BaseConfig
 from lit_gpt.model import GPT as BaseModel
 from lit_gpt.model import Block as BaseBlock
@@ -82,6 +84,8 @@ class LoRALayer(nn.Module):
             self.lora_dropout = lambda x: x
         # Mark the weight as unmerged
         self.merged = False
+        # multi-adapter serving: the adapter of every batch row (-1 for none), see `set_adapter_index`
+        self.adapter_idx: Optional[torch.Tensor] = None
 
 
 class LoRALinear(LoRALayer):
@@ -133,18 +137,93 @@ class LoRALinear(LoRALayer):
             nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
             nn.init.zeros_(self.lora_B)
 
-    def merge(self):
-        """Merges the LoRA weights into the full-rank weights (W = W + delta_W)."""
-        if self.r > 0 and not self.merged:
+    @property
+    def has_lora(self) -> bool:
+        return self.r > 0
+
+    def _adapter(
+        self, lora_A: Optional[torch.Tensor], lora_B: Optional[torch.Tensor], dtype: Optional[torch.dtype]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        weight = self.linear.weight
+        kwargs = dict(device=weight.device, dtype=dtype or weight.dtype)
+        lora_A = self.lora_A.data if lora_A is None else lora_A
+        lora_B = self.lora_B.data if lora_B is None else lora_B
+        return lora_A.to(**kwargs), lora_B.to(**kwargs)
+
+    def delta_w(
+        self,
+        lora_A: Optional[torch.Tensor] = None,
+        lora_B: Optional[torch.Tensor] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+        """The scaled weight update of an adapter, shaped like the pretrained weight.
+
+        Args:
+            lora_A: the A matrix of the adapter, `self.lora_A` by default. The parameters are not modified.
+            lora_B: the B matrix of the adapter, `self.lora_B` by default.
+            dtype: the dtype of the update, the one of the pretrained weight by default.
+        """
+        lora_A, lora_B = self._adapter(lora_A, lora_B, dtype)
+        return (lora_B @ lora_A) * self.scaling
+
+    def _add_to_weight(self, delta_w: torch.Tensor, alpha: float) -> None:
+        weight = self.linear.weight.data
+        if delta_w.dtype == weight.dtype:
+            weight.add_(delta_w, alpha=alpha)
+        else:
+            # add in the higher precision of the update and round once to the dtype of the weight
+            weight.copy_(weight.to(delta_w.dtype).add_(delta_w, alpha=alpha))
+
+    def merge(self, delta_w: Optional[torch.Tensor] = None):
+        """Merges the LoRA weights into the full-rank weights (W = W + delta_W).
+
+        Args:
+            delta_w: a precomputed `self.delta_w()`, e.g. of an adapter that is not loaded in `lora_A` and `lora_B`.
+        """
+        if self.has_lora and not self.merged:
             # Merge the weights and mark it
-            self.linear.weight.data += (self.lora_B @ self.lora_A) * self.scaling
+            self._add_to_weight(self.delta_w() if delta_w is None else delta_w, 1)
             self.merged = True
 
+    def unmerge(self, delta_w: Optional[torch.Tensor] = None):
+        """Reverts `merge` (W = W - delta_W), up to the rounding of the weight to its dtype.
+
+        Args:
+            delta_w: the update that was merged, if it did not come from the current `lora_A` and `lora_B`.
+        """
+        if self.has_lora and self.merged:
+            self._add_to_weight(self.delta_w() if delta_w is None else delta_w, -1)
+            self.merged = False
+
+    def set_adapter_stack(self, lora_A: torch.Tensor, lora_B: torch.Tensor) -> None:
+        """Hold several adapters at once, stacked along a new first dimension of `lora_A` and `lora_B`.
+
+        The adapter applied to each batch row is then chosen by `self.adapter_idx`, and the adapter held in
+        `self.lora_A` and `self.lora_B` is ignored.
+        """
+        assert lora_A.shape[1:] == self.lora_A.shape, f"Expected adapters of shape {tuple(self.lora_A.shape)}"
+        assert lora_B.shape[1:] == self.lora_B.shape, f"Expected adapters of shape {tuple(self.lora_B.shape)}"
+        self.register_buffer("lora_A_stack", lora_A.to(self.lora_A), persistent=False)
+        self.register_buffer("lora_B_stack", lora_B.to(self.lora_B), persistent=False)
+
+    def gather_adapters(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """The A and B matrices of every row's adapter, and the (B, 1, 1) scaling, which is zero for rows without one."""
+        assert not self.merged, "Cannot apply per-row adapters on top of merged weights"
+        rows = self.adapter_idx.clamp(min=0)
+        scaling = (self.adapter_idx >= 0).to(self.lora_A_stack.dtype) * self.scaling
+        return self.lora_A_stack[rows], self.lora_B_stack[rows], scaling.view(-1, 1, 1)
+
     def forward(self, x: torch.Tensor):
         # if weights are merged or rank is less or equal to zero (LoRA is disabled) - it's only a regular nn.Linear forward pass;
         # otherwise in addition do the forward pass with LoRA weights and add it's output to the output from pretrained weights
         pretrained = self.linear(x)
-        if self.r == 0 or self.merged:
+        if self.r == 0:
+            return pretrained
+        if self.adapter_idx is not None:
+            # every row uses its own adapter: (B, T, in) @ (B, in, r) @ (B, r, out)
+            lora_A, lora_B, scaling = self.gather_adapters()
+            return pretrained + (x @ lora_A.transpose(1, 2)) @ lora_B.transpose(1, 2) * scaling
+        if self.merged:
             return pretrained
         lora = (self.lora_dropout(x) @ self.lora_A.transpose(0, 1) @ self.lora_B.transpose(0, 1)) * self.scaling
         return pretrained + lora
@@ -219,10 +298,9 @@ class LoRAQKVLinear(LoRALinear):
             # Notes about shapes above
             # - self.lora_A has shape (4, 128): 4 because rank is 2 and LoRA is applied only to two matrices;
             # 128 is the input size of the x (embedding size). (4, 128) and not (128, 4) because later on in
-            # F.linear function weights are automatically transposed. In addition conv1d requires channels to
-            # be before seq length
+            # F.linear function weights are automatically transposed
             # - self.lora_B has shape (256, 2): 256 because LoRA is applied only to two matrices, so the output is
-            # 128*2; 2 tells to have two channels per group for group convolution
+            # 128*2; 2 is the rank of each of them
 
             # Scaling:
             # This balances the pretrained model`s knowledge and the new task-specific adaptation
@@ -233,8 +311,8 @@ class LoRAQKVLinear(LoRALinear):
             # https://github.com/cloneofsimo/lora
             self.scaling = self.lora_alpha / self.r
 
-            # Compute the indices
-            # Indices are needed to properly pad weight updates with zeros. If we want to fine-tune queries and values,
+            # Compute the output slices
+            # LoRA only updates the enabled parts of the combined QKV output. If we want to fine-tune queries and values,
             # but not keys, then the weights update should be:
             #
             # [[ΔW,ΔW,ΔW, ..., 0,0,0, ..., ΔW,ΔW,ΔW,],
@@ -244,109 +322,36 @@ class LoRAQKVLinear(LoRALinear):
             # ________________________________________
             # | query         | key       | value    |
             # ----------------------------------------
-            self.lora_ind = []
-            if enable_q:
-                self.lora_ind.extend(range(0, self.linear.in_features))
-            if enable_k:
-                self.lora_ind.extend(range(self.linear.in_features, self.linear.in_features + self.kv_embd_size))
-            if enable_v:
-                self.lora_ind.extend(range(self.linear.in_features + self.kv_embd_size, self.linear.out_features))
+            # so instead of padding the update with zeros, it is added to the (start, end) columns of each enabled part
+            q_end = self.linear.in_features
+            k_end = q_end + self.kv_embd_size
+            slices = ((0, q_end), (q_end, k_end), (k_end, self.linear.out_features))
+            self.lora_slices = [s for s, enabled in zip(slices, enable_lora) if enabled]
             self.reset_parameters()
 
-    def zero_pad(self, x: torch.Tensor) -> torch.Tensor:
-        """Properly pad weight updates with zeros.
-
-        If, based on `self.enable_lora`, we want to fine-tune queries and values, but not keys,
-        then the weights update should be:
-
-        [[ΔW,ΔW,ΔW, ..., 0,0,0, ..., ΔW,ΔW,ΔW,],
-         [....................................],
-         [ΔW,ΔW,ΔW, ..., 0,0,0, ..., ΔW,ΔW,ΔW,]]
-            ↑              ↑            ↑
-        ________________________________________
-        | query         | key       | value    |
-        ----------------------------------------
-
-        Args:
-            x: tensor with weights update that will be padded with zeros if necessary
-
-        Returns:
-            A tensor with weight updates and zeros for deselected q, k or v
-        """
-        # we need to do zero padding only if LoRA is disabled for one of QKV matrices
-        if all(self.enable_lora):
-            return x
-
-        # Let's image that:
-        # ⚬ input x has shape (64, 64, 256): (batch_size, sequence_length, embeddings_size)
-        # ⚬ embeddings_size: 128
-        # ⚬ self.linear.out_features: 384 (3 * embeddings_size)
-        # ⚬ enable_lora: [True, False, True]
-        # Then x has embeddings_size of 256 (2 * 128 as enable_lora only for query and value, not keys) and expected
-        # embeddings_size is 384 (self.linear.out_features), so that means that we need to pad from 256 to 384 with zeros, but
-        # only for key updates (this is where self.lora_ind comes in handy)
-        # Note: double transpose (in the beginning and in the end) is basically a guard for two-dimensional tensors
-        # for example when we want to merge/unmerge LoRA weights and pretrained weights
-        x = x.transpose(0, 1)
-        result = x.new_zeros((*x.shape[:-1], self.linear.out_features))  # (64, 64, 384)
-        result = result.view(-1, self.linear.out_features)  # (4096, 384)
-        result = result.index_copy(
-            1, torch.tensor(self.lora_ind, device=result.device), x.reshape(-1, sum(self.qkv_shapes))
-        )  # (4096, 256)
-        return result.view((*x.shape[:-1], self.linear.out_features)).transpose(0, 1)  # (64, 64, 384)
-
-    def conv1d(self, input: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
-        """An extension of the `torch.nn.functional.conv1d` function with a logic specific to grouped queries.
-
-        If the number of heads is equal to the number of query groups - grouped queries are disabled
-        (see scheme in `lit_gpt/config.py:Config`). In this case the combined QKV matrix consists of equally sized
-        query, key and value parts, which means we can utilize `groups` argument from `conv1d`: with this argument the
-        input and weight matrices will be splitted in equally sized parts and applied separately (like having multiple
-        conv layers side by side).
-
-        Otherwise QKV matrix consists of unequally sized parts and thus we have to split input and weight matrices manually,
-        apply each part of the weight matrix to the corresponding input's part and concatenate the result.
-
-        Args:
-            input: input matrix of shape (B, C, T)
-            weight: weight matrix of shape (C_output, rank, 1).
-                "C_output" is defined as a sum of embedding sizes for each enabled LoRA layer (see init method of the class).
-
-        Returns:
-            A tensor with a shape (B, C_output, T)
-
-        """
-        if self.n_head == self.n_query_groups:
-            return F.conv1d(input, weight, groups=sum(self.enable_lora))  # (B, C_output, T)
-
-        # Notation:
-        # ⚬ N: number of enabled LoRA layers (self.enable_lora)
-        # ⚬ C_output': embeddings size for each LoRA layer (not equal in size)
-        # ⚬ r: rank of all LoRA layers (equal in size)
-
-        input_splitted = input.chunk(sum(self.enable_lora), dim=1)  # N * (B, C // N, T)
-        weight_splitted = weight.split(self.qkv_shapes)  # N * (C_output', r, 1)
-        return torch.cat(
-            [F.conv1d(a, b) for a, b in zip(input_splitted, weight_splitted)], dim=1  # (B, C_output', T)
-        )  # (B, C_output, T)
+    @property
+    def has_lora(self) -> bool:
+        return self.r > 0 and any(self.enable_lora)
 
-    def merge(self):
-        """Merges the LoRA weights into the full-rank weights (W = W + delta_W)."""
+    def delta_w(
+        self,
+        lora_A: Optional[torch.Tensor] = None,
+        lora_B: Optional[torch.Tensor] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> torch.Tensor:
+        """The scaled weight update of an adapter, shaped like the pretrained weight. See `LoRALinear.delta_w`."""
 
         # Let's assume that:
         # ⚬ self.linear.weight.data: (384, 128) or (3 * embedding_size, embedding_size)
         # ⚬ self.lora_A.data: (4, 128)
         # ⚬ self.lora_B.data: (256, 2)
-        if self.r > 0 and any(self.enable_lora) and not self.merged:
-            delta_w = self.conv1d(
-                self.lora_A.data.unsqueeze(0),  # (4, 128) -> (1, 4, 128)
-                self.lora_B.data.unsqueeze(-1),  # (256, 2) -> (256, 2, 1)
-            ).squeeze(
-                0
-            )  # (1, 4, 128) @ (256, 2, 1) -> (1, 256, 128) -> (256, 128)
-            # W = W + delta_W (merge)
-            self.linear.weight.data += self.zero_pad(delta_w * self.scaling)  # (256, 128) after zero_pad (384, 128)
-            self.merged = True
+        lora_A, lora_B = self._adapter(lora_A, lora_B, dtype)
+        delta_w = lora_A.new_zeros(self.linear.weight.shape)  # (384, 128)
+        lora_As = lora_A.split(self.r)  # 2 * (2, 128)
+        lora_Bs = lora_B.split(self.qkv_shapes)  # 2 * (128, 2)
+        for lora_A, lora_B, (start, end) in zip(lora_As, lora_Bs, self.lora_slices):
+            delta_w[start:end] = (lora_B @ lora_A) * self.scaling  # (128, 2) @ (2, 128) -> (128, 128)
+        return delta_w
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Do the forward pass.
@@ -370,20 +375,26 @@ class LoRAQKVLinear(LoRALinear):
         # if weights are merged or LoRA is disabled (r <= 0 or all `enable_lora` are False) - it's only a regular nn.Linear forward pass;
         # otherwise in addition do the forward pass with LoRA weights and add it's output to the output from pretrained weights
         pretrained = self.linear(x)
-        if self.r == 0 or not any(self.enable_lora) or self.merged:
+        if self.r == 0 or not any(self.enable_lora):
+            return pretrained
+        if self.adapter_idx is not None:
+            # every row uses its own adapter: (B, T, in) @ (B, in, r * n_enabled)
+            lora_A, lora_B, scaling = self.gather_adapters()
+            after_A = x @ lora_A.transpose(1, 2)
+            lora_Bs = lora_B.split(self.qkv_shapes, dim=1)
+            for after_A_i, lora_B_i, (start, end) in zip(after_A.split(self.r, dim=-1), lora_Bs, self.lora_slices):
+                pretrained[..., start:end] += (after_A_i @ lora_B_i.transpose(1, 2)) * scaling
+            return pretrained
+        if self.merged:
             return pretrained
         after_A = F.linear(self.lora_dropout(x), self.lora_A)  # (64, 64, 128) @ (4, 128) -> (64, 64, 4)
-        # For F.conv1d:
-        # ⚬ input: input tensor of shape (mini-batch, in_channels, iW)
-        # ⚬ weight: filters of shape (out_channels, in_channels/groups, kW)
-        after_B = self.conv1d(
-            after_A.transpose(-2, -1),  # (64, 64, 4) -> (64, 4, 64)
-            self.lora_B.unsqueeze(-1),  # (256, 2) -> (256, 2, 1)
-        ).transpose(
-            -2, -1
-        )  # (64, 4, 64) @ (256, 2, 1) -> (64, 256, 64) -> (64, 64, 256)
-        lora = self.zero_pad(after_B) * self.scaling  # (64, 64, 256) after zero_pad (64, 64, 384)
-        return pretrained + lora
+        # the rank-r slices of `after_A` belong to the enabled q, k, v parts in order. each one is projected by its part
+        # of `lora_B` and added in place to its columns of the pretrained output, which the linear backward does not need
+        lora_Bs = self.lora_B.split(self.qkv_shapes)  # 2 * (128, 2)
+        for after_A_i, lora_B_i, (start, end) in zip(after_A.split(self.r, dim=-1), lora_Bs, self.lora_slices):
+            # (64, 64, 2) @ (128, 2) -> (64, 64, 128)
+            pretrained[..., start:end].add_(F.linear(after_A_i, lora_B_i), alpha=self.scaling)
+        return pretrained
 
 
 def mark_only_lora_as_trainable(model: nn.Module, bias: str = "none") -> None:
@@ -456,6 +467,7 @@ class GPT(BaseModel):
         nn.Module.__init__(self)
         assert config.padded_vocab_size is not None
         self.config = config
+        kernels.configure(config.kernels)
 
         self.lm_head = LoRALinear(
             config.n_embd,
@@ -483,7 +495,9 @@ class GPT(BaseModel):
         idx: torch.Tensor,
         max_seq_length: Optional[int] = None,
         input_pos: Optional[torch.Tensor] = None,
+        padding_mask: Optional[torch.Tensor] = None,
         lm_head_chunk_size: int = 0,
+        lm_head_positions: Optional[torch.Tensor] = None,
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
         B, T = idx.size()
         use_kv_cache = input_pos is not None
@@ -510,8 +524,7 @@ class GPT(BaseModel):
         if use_kv_cache:
             cos = cos.index_select(0, input_pos)
             sin = sin.index_select(0, input_pos)
-            mask = self.mask_cache.index_select(2, input_pos)
-            mask = mask[:, :, :, :max_seq_length]
+            cache_pos, mask = self.kv_cache_index(input_pos, max_seq_length, padding_mask)
         else:
             cos = cos[:T]
             sin = sin[:T]
@@ -524,10 +537,15 @@ class GPT(BaseModel):
             for block in self.transformer.h:
                 x, *_ = block(x, (cos, sin), max_seq_length)
         else:
-            self.kv_caches = self.kv_caches or self.build_kv_caches(x, max_seq_length, cos.size(-1))
+            self.kv_caches = self.kv_caches or self.build_kv_caches(
+                x, max_seq_length, cos.size(-1) * 2, self.kv_cache_storage_dtype
+            )
             for i, block in enumerate(self.transformer.h):
-                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, input_pos, self.kv_caches[i])
+                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, cache_pos, self.kv_caches[i])
 
+        if lm_head_positions is not None:
+            # only compute the logits that are needed, e.g. the last prompt position when generating
+            x = x.index_select(1, lm_head_positions)
         x = self.transformer.ln_f(x)
 
         if lm_head_chunk_size > 0:
@@ -673,9 +691,17 @@ class LLaMAMLP(lit_gpt.model.LLaMAMLP):
             lora_dropout=config.dropout,
         )
 
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = torch.nn.functional.silu(self.fc_1(x)) * self.fc_2(x)
+        return self.proj(x)
+
     def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
         """For compatibility with base checkpoints."""
         mapping = {
+            # the base model computes the MLP with its `SwiGLU` module
+            "swiglu.w1.weight": "fc_1.linear.weight",
+            "swiglu.w2.weight": "fc_2.linear.weight",
+            "swiglu.w3.weight": "proj.linear.weight",
             "fc_1.weight": "fc_1.linear.weight",
             "fc_1.bias": "fc_1.linear.bias",
             "fc_2.weight": "fc_2.linear.weight",
@@ -692,3 +718,105 @@ def merge_lora_weights(model: GPT) -> None:
     for module in model.modules():
         if isinstance(module, LoRALinear):
             module.merge()
+
+
+def unmerge_lora_weights(model: GPT) -> None:
+    """Revert `merge_lora_weights`, up to floating point rounding."""
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.unmerge()
+
+
+class AdapterSwitcher:
+    def __init__(self, model: GPT, adapters: Dict[str, Dict[str, torch.Tensor]], cache_size: int = 4) -> None:
+        """Switch the adapter merged into `model` without reloading the base weights.
+
+        Switching unmerges the weight update of the active adapter and merges the one of the next adapter. The updates
+        (`delta_w`) of the `cache_size` most recently used adapters are kept, so switching back to one of them costs two
+        in-place additions per LoRA layer. The updates are computed from the adapter tensors, the adapter loaded in
+        `lora_A` and `lora_B` is left as is.
+
+        The updates are kept and added in float32, but every merge and unmerge rounds the weights to their dtype, so
+        with bfloat16 or float16 weights each switch can move the base weights by up to one unit in the last place.
+        Reload the base weights after many switches if that drift matters.
+
+        Args:
+            model: a LoRA model with no adapter merged.
+            adapters: LoRA state dicts, as saved with `lora_filter`, by name.
+            cache_size: number of adapters whose weight updates are cached. Each takes the memory of the pretrained
+                weights it updates in float32.
+        """
+        self.model = model
+        self.adapters = adapters
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()
+        self.active: Optional[str] = None
+        self.modules = {
+            name: module for name, module in model.named_modules() if isinstance(module, LoRALinear) and module.has_lora
+        }
+
+    def delta_ws(self, name: str) -> Dict[str, torch.Tensor]:
+        """The weight updates of adapter `name` for every LoRA layer, from the cache or computed and cached."""
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        adapter = self.adapters[name]
+        delta_ws = {}
+        for module_name, module in self.modules.items():
+            delta_ws[module_name] = module.delta_w(
+                adapter[f"{module_name}.lora_A"], adapter[f"{module_name}.lora_B"], dtype=torch.float32
+            )
+        self.cache[name] = delta_ws
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return delta_ws
+
+    @torch.no_grad()
+    def activate(self, name: Optional[str]) -> None:
+        """Merge adapter `name` into the model, or restore the base model with `None`."""
+        if name == self.active:
+            return
+        if self.active is not None:
+            active_delta_ws = self.delta_ws(self.active)
+            for module_name, module in self.modules.items():
+                module.unmerge(active_delta_ws[module_name])
+        self.active = None
+        if name is not None:
+            delta_ws = self.delta_ws(name)
+            for module_name, module in self.modules.items():
+                module.merge(delta_ws[module_name])
+            self.active = name
+
+
+def load_adapter_stack(model: GPT, adapters: List[Dict[str, torch.Tensor]]) -> None:
+    """Load several fine-tuned adapters into `model` at once, to serve them from a single copy of the base weights.
+
+    Args:
+        model: a LoRA model whose config matches the one the adapters were trained with.
+        adapters: LoRA state dicts, as saved with `lora_filter`. Adapter `i` is selected with index `i` in
+            `set_adapter_index`.
+    """
+    for name, module in model.named_modules():
+        if isinstance(module, LoRALinear) and hasattr(module, "lora_A"):
+            module.set_adapter_stack(
+                torch.stack([adapter[f"{name}.lora_A"] for adapter in adapters]),
+                torch.stack([adapter[f"{name}.lora_B"] for adapter in adapters]),
+            )
+
+
+def num_stacked_adapters(model: GPT) -> int:
+    """The number of adapters `load_adapter_stack` loaded into `model`, 0 if it was never called."""
+    for module in model.modules():
+        if isinstance(module, LoRALinear) and hasattr(module, "lora_A_stack"):
+            return module.lora_A_stack.size(0)
+    return 0
+
+
+def set_adapter_index(model: GPT, adapter_idx: Optional[torch.Tensor]) -> None:
+    """Choose the adapter of every row of the next batches: `adapter_idx` is (B,), with -1 for the base model alone.
+
+    `None` goes back to the single adapter held in `lora_A` and `lora_B`.
+    """
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.adapter_idx = adapter_idx
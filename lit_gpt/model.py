@@ -4,26 +4,35 @@ Based on the nanoGPT implementation: https://github.com/karpathy/nanoGPT and
 https://github.com/EleutherAI/gpt-neox/tree/main/megatron/model.
 """
 import math
-from typing import Any, List, Optional, Tuple
+from typing import Any, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
-from lightning_utilities.core.imports import RequirementCache
 from typing_extensions import Self
-from flash_attn import flash_attn_func
+
+from lit_gpt import kernels
 from lit_gpt.config import Config
-from xformers.ops import SwiGLU
-from .fused_rotary_embedding import apply_rotary_emb_func
+from lit_gpt.kernels import FlashAttention2Available, grouped_attention  # noqa: F401
+from lit_gpt.linear_cross_entropy import linear_cross_entropy
+
 RoPECache = Tuple[torch.Tensor, torch.Tensor]
 KVCache = Tuple[torch.Tensor, torch.Tensor]
-FlashAttention2Available = RequirementCache("flash-attn>=2.0.0.post1")
 
 
 class GPT(nn.Module):
+    # number of leading positions ("attention sinks") that stay pinned in the KV cache once generation runs past
+    # `max_seq_length` and the cache starts overwriting its oldest entries
+    kv_cache_sink_tokens: int = 0
+    # dtype the KV cache stores keys and values in. `None` uses the compute dtype, `torch.int8` builds an `Int8KVCache`
+    kv_cache_storage_dtype: Optional[torch.dtype] = None
+    # number of tokens whose logits exist at once when `forward` is given `targets` (see `linear_cross_entropy`)
+    cross_entropy_chunk_size: int = 1024
+
     def __init__(self, config: Config) -> None:
         super().__init__()
         assert config.padded_vocab_size is not None
         self.config = config
+        kernels.configure(config.kernels)
 
         self.lm_head = nn.Linear(config.n_embd, config.padded_vocab_size, bias=False)
         self.transformer = nn.ModuleDict(
@@ -62,8 +71,16 @@ class GPT(nn.Module):
             self.mask_cache = None
 
     def forward(
-        self, idx: torch.Tensor, max_seq_length: Optional[int] = None, input_pos: Optional[torch.Tensor] = None
+        self,
+        idx: torch.Tensor,
+        max_seq_length: Optional[int] = None,
+        input_pos: Optional[torch.Tensor] = None,
+        padding_mask: Optional[torch.Tensor] = None,
+        lm_head_positions: Optional[torch.Tensor] = None,
+        targets: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
+        """Return the (B, T, vocab_size) logits, or the mean next-token cross-entropy loss when `targets` (B, T) are
+        given. The loss is computed from the final hidden states chunk by chunk, without ever holding all the logits."""
         B, T = idx.size()
         use_kv_cache = input_pos is not None
 
@@ -87,11 +104,9 @@ class GPT(nn.Module):
 
         cos, sin = self.rope_cache
         if use_kv_cache:
-
             cos = cos.index_select(0, input_pos)
             sin = sin.index_select(0, input_pos)
-            mask = self.mask_cache.index_select(2, input_pos)
-            mask = mask[:, :, :, :max_seq_length]
+            cache_pos, mask = self.kv_cache_index(input_pos, max_seq_length, padding_mask)
         else:
             cos = cos[:T]
             sin = sin[:T]
@@ -99,19 +114,96 @@ class GPT(nn.Module):
 
         # forward the model itself
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
-            
+
         if not use_kv_cache:
             for block in self.transformer.h:
                 x, *_ = block(x, (cos, sin), max_seq_length)
         else:
-            self.kv_caches = self.kv_caches or self.build_kv_caches(x, max_seq_length, cos.size(-1) * 2)
+            self.kv_caches = self.kv_caches or self.build_kv_caches(
+                x, max_seq_length, cos.size(-1) * 2, self.kv_cache_storage_dtype
+            )
             for i, block in enumerate(self.transformer.h):
-                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, input_pos, self.kv_caches[i])
+                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, cache_pos, self.kv_caches[i])
 
+        if lm_head_positions is not None:
+            # only compute the logits that are needed, e.g. the last prompt position when generating
+            x = x.index_select(1, lm_head_positions)
         x = self.transformer.ln_f(x)
 
+        if targets is not None:
+            # inside `forward` so that wrappers like FSDP have gathered the `lm_head` weight
+            return linear_cross_entropy(x, self.lm_head.weight, targets, chunk_size=self.cross_entropy_chunk_size)
         return self.lm_head(x)  # (b, t, vocab_size)
 
+    def kv_cache_index(
+        self, input_pos: torch.Tensor, max_seq_length: int, padding_mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Map the absolute positions `input_pos` to KV cache slots and build the matching attention mask.
+
+        The KV cache is a ring buffer: once the positions go past `max_seq_length`, each new entry overwrites the oldest
+        one (except for the first `kv_cache_sink_tokens` positions, which stay pinned) instead of shifting the whole
+        cache. Keys are stored with RoPE already applied at their absolute position, so the slot order is irrelevant to
+        attention and the mask only has to hide the slots holding positions after the query.
+
+        Args:
+            input_pos: absolute positions of the tokens being forwarded.
+            max_seq_length: number of slots in the KV cache.
+            padding_mask: optional (B, max_seq_length) boolean mask that is False at left-padding positions.
+
+        Returns:
+            The cache slots to write `input_pos` to, and the (1 or B, 1, T, max_seq_length) attention mask.
+        """
+        if kernels.is_compiling():
+            # checking for the overflow reads `input_pos` on the host, which would break the graph
+            return self.static_kv_cache_index(input_pos, max_seq_length, padding_mask)
+        if input_pos[-1] < max_seq_length:
+            mask = self.mask_cache.index_select(2, input_pos)
+            mask = mask[:, :, :, :max_seq_length]
+            if padding_mask is not None:
+                # real tokens never attend to padding, while padding queries keep their causal row so that no softmax
+                # row is fully masked
+                padding_mask = padding_mask[:, :max_seq_length]
+                query_is_padding = ~padding_mask.index_select(1, input_pos)
+                mask = mask & (padding_mask[:, None, None, :] | query_is_padding[:, None, :, None])
+            return input_pos, mask
+
+        assert padding_mask is None, "`padding_mask` is not supported once the KV cache overflows"
+        sink = self.kv_cache_sink_tokens
+        window = max_seq_length - sink
+        assert window > 0, f"Cannot pin {sink} sink tokens in a KV cache of {max_seq_length} positions"
+        cache_pos = torch.where(input_pos < sink, input_pos, sink + (input_pos - sink) % window)
+        # absolute position held by every slot after `input_pos` has been written
+        last_pos = input_pos[-1]
+        slots = torch.arange(max_seq_length, device=input_pos.device)
+        slot_pos = torch.where(slots < sink, slots, last_pos - (last_pos - slots) % window)
+        mask = slot_pos.unsqueeze(0) <= input_pos.unsqueeze(1)
+        return cache_pos, mask.unsqueeze(0).unsqueeze(0)
+
+    def static_kv_cache_index(
+        self, input_pos: torch.Tensor, max_seq_length: int, padding_mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """`kv_cache_index` without data-dependent control flow, so that a compiled decode step is a single graph.
+
+        The ring buffer formulas also give the slots before the cache overflows. The mask takes the slot indices as
+        positions until then, which keeps the slots that were not written yet out of it. Unlike the eager path, a
+        `padding_mask` is not rejected after the overflow, where its columns no longer match the slots.
+        """
+        sink = self.kv_cache_sink_tokens
+        window = max_seq_length - sink
+        assert window > 0, f"Cannot pin {sink} sink tokens in a KV cache of {max_seq_length} positions"
+        cache_pos = torch.where(input_pos < sink, input_pos, sink + (input_pos - sink) % window)
+        last_pos = input_pos[-1]
+        slots = torch.arange(max_seq_length, device=input_pos.device)
+        ring_pos = torch.where(slots < sink, slots, last_pos - (last_pos - slots) % window)
+        # until the cache overflows, every slot holds its own position
+        slot_pos = torch.where(last_pos < max_seq_length, slots, ring_pos)
+        mask = (slot_pos.unsqueeze(0) <= input_pos.unsqueeze(1)).unsqueeze(0).unsqueeze(0)
+        if padding_mask is not None:
+            padding_mask = padding_mask[:, :max_seq_length]
+            query_is_padding = ~padding_mask.index_select(1, input_pos)
+            mask = mask & (padding_mask[:, None, None, :] | query_is_padding[:, None, :, None])
+        return cache_pos, mask
+
     @classmethod
     def from_name(cls, name: str, **kwargs: Any) -> Self:
         return cls(Config.from_name(name, **kwargs))
@@ -129,7 +221,9 @@ class GPT(nn.Module):
         ones = torch.ones((self.config.block_size, self.config.block_size), device=idx.device, dtype=torch.bool)
         return torch.tril(ones).unsqueeze(0).unsqueeze(0)
 
-    def build_kv_caches(self, idx: torch.Tensor, max_seq_length: int, rope_cache_length: int) -> List[KVCache]:
+    def build_kv_caches(
+        self, idx: torch.Tensor, max_seq_length: int, rope_cache_length: int, dtype: Optional[torch.dtype] = None
+    ) -> List[Union[KVCache, "Int8KVCache"]]:
         B = idx.size(0)
         heads = 1 if self.config.n_query_groups == 1 else self.config.n_query_groups
 
@@ -141,8 +235,19 @@ class GPT(nn.Module):
         )
         v_cache_shape = (B, max_seq_length, heads, self.config.head_size)
         device = idx.device
+        # allocate the caches in the dtype the keys and values are computed in so that every decode step only writes the
+        # new positions in place instead of casting the whole cache
+        dtype = dtype or kv_cache_dtype(idx)
+        if dtype == torch.int8:
+            return [
+                Int8KVCache(k_cache_shape, v_cache_shape, device=device, dtype=kv_cache_dtype(idx))
+                for _ in range(self.config.n_layer)
+            ]
         return [
-            (torch.zeros(k_cache_shape, device=device), torch.zeros(v_cache_shape, device=device))
+            (
+                torch.zeros(k_cache_shape, device=device, dtype=dtype),
+                torch.zeros(v_cache_shape, device=device, dtype=dtype),
+            )
             for _ in range(self.config.n_layer)
         ]
 
@@ -229,10 +334,16 @@ class CausalSelfAttention(nn.Module):
 
         cos, sin = rope
 
-        # apply rope in fp32 significanly stabalize training
-        # fused rope expect (batch_size, seqlen, nheads, headdim)
-        q = apply_rotary_emb_func(q, cos, sin, False, True)
-        k = apply_rotary_emb_func(k, cos, sin, False, True)
+        if cos.dim() == 3:
+            # every row sits at its own positions (e.g. sequences sharing a paged KV cache): cos, sin are (B, T, n_elem/2)
+            q = apply_rope_per_row(q, cos, sin)
+            k = apply_rope_per_row(k, cos, sin)
+        else:
+            # apply rope in fp32 significanly stabalize training
+            # fused rope expect (batch_size, seqlen, nheads, headdim)
+            rotary_emb = kernels.get("rotary", q)
+            q = rotary_emb(q, cos, sin)
+            k = rotary_emb(k, cos, sin)
         
         # n_elem = int(self.config.rotary_percentage * self.config.head_size)
     
@@ -242,18 +353,15 @@ class CausalSelfAttention(nn.Module):
         # q = torch.cat((q_roped, q[..., n_elem:]), dim=-1)
         # k = torch.cat((k_roped, k[..., n_elem:]), dim=-1)
 
-        if kv_cache is not None:
+        if kv_cache is not None and not isinstance(kv_cache, tuple):
+            # a cache object that manages its own storage, e.g. `Int8KVCache` or `lit_gpt.paged_kv_cache.PagedKVCache`
+            k, v = kv_cache.update(k, v, input_pos)
+        elif kv_cache is not None:
             cache_k, cache_v = kv_cache
-            cache_k, cache_v = cache_k.to(dtype=k.dtype), cache_v.to(dtype=v.dtype)
-            # check if reached token limit
-            if input_pos[-1] >= max_seq_length:
-                input_pos = torch.tensor(max_seq_length - 1, device=input_pos.device)
-                # shift 1 position to the left
-                cache_k = torch.roll(cache_k, -1, dims=1)
-                cache_v = torch.roll(cache_v, -1, dims=1)
-
-            k = cache_k.index_copy_(1, input_pos, k)
-            v = cache_v.index_copy_(1, input_pos, v)
+            # `input_pos` holds the cache slots to write to (see `GPT.kv_cache_index`).
+            # only the new positions are cast (a no-op when the cache was built in the compute dtype)
+            k = cache_k.index_copy_(1, input_pos, k.to(dtype=cache_k.dtype))
+            v = cache_v.index_copy_(1, input_pos, v.to(dtype=cache_v.dtype))
             kv_cache = k, v
 
         y = self.scaled_dot_product_attention(q, k, v, mask=mask)
@@ -269,24 +377,14 @@ class CausalSelfAttention(nn.Module):
         self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor] = None
     ):
         scale = 1.0 / math.sqrt(self.config.head_size)
-        
-        if (
-            FlashAttention2Available
-            and mask is None
-            and q.device.type == "cuda"
-            and q.dtype in (torch.float16, torch.bfloat16)
-        ):
-            from flash_attn import flash_attn_func
-
-            return flash_attn_func(q, k, v, dropout_p=0.0, softmax_scale=scale, causal=True)
-        q = q.transpose(1, 2)
-        k = k.transpose(1, 2)
-        v = v.transpose(1, 2)
-        if q.size() != k.size():
-             k = k.repeat_interleave(q.shape[1]//k.shape[1], dim=1)
-             v = v.repeat_interleave(q.shape[1]//v.shape[1], dim=1)
+        if mask is None:
+            # causal attention without a KV cache: flash-attn when available (see `lit_gpt.kernels`)
+            return kernels.get("attention", q)(q, k, v, scale)
+        if q.size(2) != k.size(2):
+            # grouped queries attend to the un-duplicated keys and values (see `grouped_attention`)
+            return grouped_attention(q, k, v, mask, scale)
         y = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=mask, dropout_p=0.0, scale=scale, is_causal=mask is None
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=mask, dropout_p=0.0, scale=scale
         )
         return y.transpose(1, 2)
 
@@ -309,7 +407,7 @@ class LLaMAMLP(nn.Module):
         # self.fc_1 = nn.Linear(config.n_embd, config.intermediate_size, bias=config.bias)
         # self.fc_2 = nn.Linear(config.n_embd, config.intermediate_size, bias=config.bias)
         # self.proj = nn.Linear(config.intermediate_size, config.n_embd, bias=config.bias)
-        self.swiglu = SwiGLU(config.n_embd,config.intermediate_size, bias=False, _pack_weights=False)
+        self.swiglu = SwiGLU(config.n_embd, config.intermediate_size, bias=False)
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # x_fc_1 = self.fc_1(x)
         # x_fc_2 = self.fc_2(x)
@@ -318,6 +416,72 @@ class LLaMAMLP(nn.Module):
         return self.swiglu(x)
 
 
+class SwiGLU(nn.Module):
+    def __init__(self, in_features: int, hidden_features: int, bias: bool = True) -> None:
+        """`w3(silu(w1(x)) * w2(x))`, with the same parameters as the unpacked xformers `SwiGLU` so that checkpoints
+        load either way. The computation uses the "swiglu" kernel backend (see `lit_gpt.kernels`), except for quantized
+        layers, which compute their own matmul."""
+        super().__init__()
+        self.w1 = nn.Linear(in_features, hidden_features, bias=bias)
+        self.w2 = nn.Linear(in_features, hidden_features, bias=bias)
+        self.w3 = nn.Linear(hidden_features, in_features, bias=bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # `nn.Linear` itself is replaced by the quantized class inside `lit_gpt.utils.quantization`
+        if not all(type(w) is nn.modules.linear.Linear for w in (self.w1, self.w2, self.w3)):
+            # the kernels take float weights, which a quantized layer would have to dequantize whole on every call
+            return self.w3(torch.nn.functional.silu(self.w1(x)) * self.w2(x))
+        return kernels.get("swiglu", x)(
+            x, self.w1.weight, self.w1.bias, self.w2.weight, self.w2.bias, self.w3.weight, self.w3.bias
+        )
+
+
+def kv_cache_dtype(x: torch.Tensor) -> torch.dtype:
+    """The dtype keys and values are computed in for an input `x`, accounting for autocast (mixed precision)."""
+    if x.device.type == "cuda" and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    if x.device.type == "cpu" and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return x.dtype
+
+
+class Int8KVCache:
+    def __init__(
+        self, k_shape: Tuple[int, ...], v_shape: Tuple[int, ...], device: torch.device, dtype: torch.dtype
+    ) -> None:
+        """A KV cache that stores keys and values in int8 with one scale per token and head.
+
+        Compared to a cache in the compute dtype, it takes about half the memory for 16-bit models and a quarter for
+        32-bit ones. The whole cache is dequantized to `dtype` whenever it is read.
+        """
+        self.k = torch.zeros(k_shape, device=device, dtype=torch.int8)
+        self.v = torch.zeros(v_shape, device=device, dtype=torch.int8)
+        self.k_scales = torch.zeros(k_shape[:-1] + (1,), device=device, dtype=dtype)
+        self.v_scales = torch.zeros(v_shape[:-1] + (1,), device=device, dtype=dtype)
+
+    @staticmethod
+    def quantize(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Symmetric int8 quantization over the last (head size) dimension."""
+        scales = x.float().abs().amax(dim=-1, keepdim=True).clamp_(min=1e-8) / 127
+        return torch.round(x.float() / scales).clamp_(-127, 127).to(torch.int8), scales
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor, input_pos: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Store the new (B, T, n_query_groups, head_size) keys and values at the slots `input_pos`, and return the
+        dequantized keys and values of the whole cache."""
+        for cache, cache_scales, x in ((self.k, self.k_scales, k), (self.v, self.v_scales, v)):
+            q, scales = self.quantize(x)
+            cache.index_copy_(1, input_pos, q)
+            cache_scales.index_copy_(1, input_pos, scales.to(dtype=cache_scales.dtype))
+        return self.k.to(k.dtype) * self.k_scales.to(k.dtype), self.v.to(v.dtype) * self.v_scales.to(v.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        tensors = (self.k, self.v, self.k_scales, self.v_scales)
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
 def build_rope_cache(
     seq_len: int, n_elem: int, dtype: torch.dtype, device: torch.device, base: int = 10000, condense_ratio: int = 1
 ) -> RoPECache:
@@ -354,3 +518,15 @@ def apply_rope(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.T
     rotated = torch.cat((-x2, x1), dim=-1)  # (B, nh, T, hs)
     roped = (x * cos) + (rotated * sin)
     return roped.type_as(x)
+
+
+def apply_rope_per_row(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    """`apply_rope` for (B, T, n_head, head_size) inputs whose rows sit at different positions.
+
+    `cos` and `sin` are (B, T, n_elem / 2) slices of the rope cache, rotating the first `n_elem` channels of each head.
+    """
+    n_elem = cos.size(-1) * 2
+    cos = cos.repeat(1, 1, 2).unsqueeze(2)
+    sin = sin.repeat(1, 1, 2).unsqueeze(2)
+    roped = apply_rope(x[..., :n_elem], cos, sin)
+    return torch.cat((roped, x[..., n_elem:]), dim=-1)
@@ -0,0 +1,97 @@
+"""AdamW for pretraining: the implementation to step with and the parameters to decay.
+
+`torch.optim.AdamW(foreach=False)` updates the parameters one by one in a Python loop, a handful of kernel launches per
+tensor. The "foreach" implementation batches every operation over all the tensors of a group, and the "fused" one does
+the whole update of a group in a few kernels. The "8bit" one (bitsandbytes) also stores both moments in 8 bits with
+block-wise scales, 2 bytes per parameter instead of 8.
+"""
+from typing import Dict, Iterable, List, Tuple
+
+import torch
+import torch.nn as nn
+from lightning_utilities.core.imports import RequirementCache
+
+from lit_gpt.rmsnorm import FusedRMSNorm, RMSNorm
+
+BitsandbytesAvailable = RequirementCache("bitsandbytes")
+
+IMPLEMENTATIONS = ("auto", "for_loop", "foreach", "fused", "8bit")
+# the modules whose parameters are not decayed when `decay_norms_and_embeddings=False`
+NO_DECAY_MODULES = (nn.Embedding, nn.LayerNorm, RMSNorm, FusedRMSNorm)
+
+
+def param_groups(model: nn.Module, weight_decay: float, decay_norms_and_embeddings: bool = False) -> List[Dict]:
+    """The trainable parameters of `model`, split into a group decayed with `weight_decay` and one that is not, made
+    of the biases and of the norm and embedding weights.
+
+    The parameters are classified by the module that holds them, which FSDP keeps in the module tree with
+    `use_orig_params=True`, so this can run on the set up model.
+    """
+    decay, no_decay = [], []
+    seen = set()
+    for module in model.modules():
+        for name, param in module.named_parameters(recurse=False):
+            if not param.requires_grad or id(param) in seen:
+                continue
+            seen.add(id(param))
+            excluded = name.endswith("bias") or isinstance(module, NO_DECAY_MODULES)
+            (no_decay if excluded and not decay_norms_and_embeddings else decay).append(param)
+    groups = [{"params": decay, "weight_decay": weight_decay}]
+    if no_decay:
+        groups.append({"params": no_decay, "weight_decay": 0.0})
+    return groups
+
+
+def _on_cuda(params: Iterable[torch.Tensor]) -> bool:
+    return all(p.is_cuda for p in params)
+
+
+def create_optimizer(
+    model: nn.Module,
+    implementation: str = "auto",
+    lr: float = 1e-3,
+    weight_decay: float = 0.0,
+    betas: Tuple[float, float] = (0.9, 0.999),
+    eps: float = 1e-8,
+    decay_norms_and_embeddings: bool = False,
+) -> torch.optim.Optimizer:
+    """AdamW over the `param_groups` of `model`.
+
+    Args:
+        model: the model to optimize, set up already when it is sharded.
+        implementation: "for_loop", "foreach", "fused", "8bit", or "auto" for "fused" when every parameter is on a GPU
+            and "foreach" otherwise.
+        lr: learning rate.
+        weight_decay: decoupled weight decay of the decayed group.
+        betas: coefficients of the running averages of the gradient and of its square.
+        eps: added to the denominator.
+        decay_norms_and_embeddings: also decay the biases and the norm and embedding weights, like a single group.
+    """
+    if implementation not in IMPLEMENTATIONS:
+        raise ValueError(f"Unknown optimizer implementation {implementation!r}, expected one of {IMPLEMENTATIONS}")
+    groups = param_groups(model, weight_decay, decay_norms_and_embeddings)
+    params = [p for group in groups for p in group["params"]]
+    if implementation == "auto":
+        implementation = "fused" if _on_cuda(params) else "foreach"
+    kwargs = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+    if implementation == "8bit":
+        if not BitsandbytesAvailable:
+            raise ImportError(str(BitsandbytesAvailable))
+        import bitsandbytes as bnb
+
+        return bnb.optim.AdamW8bit(groups, **kwargs)
+    if implementation == "fused" and not _on_cuda(params):
+        raise ValueError("The fused AdamW needs every parameter on a GPU")
+    return torch.optim.AdamW(
+        groups, foreach=implementation == "foreach", fused=True if implementation == "fused" else None, **kwargs
+    )
+
+
+def state_bytes(optimizer: torch.optim.Optimizer) -> int:
+    """Memory held by the optimizer state tensors, e.g. the AdamW moments."""
+    return sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if isinstance(value, torch.Tensor)
+    )
@@ -0,0 +1,201 @@
+"""Paged KV cache: fixed-size pages shared by many sequences through per-sequence page tables.
+
+The contiguous caches built by `GPT.build_kv_caches` reserve `max_seq_length` positions for every row of the batch.
+Here the keys and values of all sequences live in one pool of pages per layer, and a sequence only holds as many pages
+as its current length needs. Attention gathers each sequence's pages into a dense (B, L, n_query_groups, head_size)
+tensor with plain PyTorch indexing, so it runs on any device.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from lit_gpt.config import Config
+from lit_gpt.model import GPT
+
+
+@dataclass
+class PagedBatch:
+    """Indexing tensors for one forward of a batch of sequences through the paged cache."""
+
+    # absolute position of every new token, (B, T)
+    input_pos: torch.Tensor
+    # flat slot (page * page_size + offset) each new token is written to, (B, T)
+    write_slots: torch.Tensor
+    # flat slot of every cached position of every sequence, padded to the longest one, (B, L)
+    read_slots: torch.Tensor
+    # attention mask over the gathered positions, (B, 1, T, L)
+    mask: torch.Tensor
+
+
+class PagedKVCacheLayer:
+    """The view of a `PagedKVCache` that a single attention layer writes to and reads from."""
+
+    def __init__(self, k_pages: torch.Tensor, v_pages: torch.Tensor, batch: PagedBatch) -> None:
+        self.k_pages = k_pages
+        self.v_pages = v_pages
+        self.batch = batch
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor, input_pos: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Store the new (B, T, n_query_groups, head_size) keys and values, and return the keys and values of every
+        cached position, (B, L, n_query_groups, head_size). The slots come from the batch, `input_pos` is unused."""
+        B, T, groups, head_size = k.shape
+        k_slots = self.k_pages.view(-1, groups, head_size)
+        v_slots = self.v_pages.view(-1, groups, head_size)
+        write_slots = self.batch.write_slots.reshape(-1)
+        k_slots.index_copy_(0, write_slots, k.reshape(-1, groups, head_size).to(dtype=k_slots.dtype))
+        v_slots.index_copy_(0, write_slots, v.reshape(-1, groups, head_size).to(dtype=v_slots.dtype))
+        read_slots = self.batch.read_slots
+        L = read_slots.size(1)
+        k = k_slots.index_select(0, read_slots.reshape(-1)).view(B, L, groups, head_size)
+        v = v_slots.index_select(0, read_slots.reshape(-1)).view(B, L, groups, head_size)
+        return k, v
+
+
+class PagedKVCache:
+    def __init__(
+        self,
+        config: Config,
+        num_pages: int,
+        page_size: int = 16,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        """A pool of KV cache pages with a free-list allocator.
+
+        Args:
+            config: config of the model the cache is used with.
+            num_pages: number of pages in the pool, shared by all sequences.
+            page_size: number of positions per page.
+            device: device to allocate the pages on.
+            dtype: dtype of the stored keys and values.
+        """
+        self.config = config
+        self.num_pages = num_pages
+        self.page_size = page_size
+        shape = (num_pages, page_size, config.n_query_groups, config.head_size)
+        self.k_pages = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.v_pages = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        # a stack, so that recently freed (cache-warm) pages are reused first
+        self.free_pages: List[int] = list(range(num_pages - 1, -1, -1))
+        self.page_tables: Dict[int, List[int]] = {}
+        self.lengths: Dict[int, int] = {}
+
+    @classmethod
+    def from_memory_budget(
+        cls,
+        config: Config,
+        budget_bytes: int,
+        page_size: int = 16,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> "PagedKVCache":
+        """Create the largest pool of pages that fits in `budget_bytes`."""
+        element_size = torch.empty((), dtype=dtype).element_size()
+        # keys and values, for every layer
+        page_bytes = 2 * config.n_layer * page_size * config.n_query_groups * config.head_size * element_size
+        return cls(config, budget_bytes // page_bytes, page_size=page_size, device=device, dtype=dtype)
+
+    @property
+    def device(self) -> torch.device:
+        return self.k_pages[0].device
+
+    @property
+    def num_free_tokens(self) -> int:
+        return len(self.free_pages) * self.page_size
+
+    def pages_needed(self, seq_id: int, num_new_tokens: int) -> int:
+        """Number of free pages `seq_id` needs to grow by `num_new_tokens`."""
+        length = self.lengths.get(seq_id, 0) + num_new_tokens
+        allocated = len(self.page_tables.get(seq_id, ()))
+        return max(0, -(-length // self.page_size) - allocated)
+
+    def add_sequence(self, seq_id: int) -> None:
+        if seq_id in self.page_tables:
+            raise ValueError(f"Sequence {seq_id} is already in the cache")
+        self.page_tables[seq_id] = []
+        self.lengths[seq_id] = 0
+
+    def free_sequence(self, seq_id: int) -> None:
+        """Return the pages of `seq_id` to the pool."""
+        self.free_pages.extend(reversed(self.page_tables.pop(seq_id)))
+        del self.lengths[seq_id]
+
+    def _reserve(self, seq_id: int, num_new_tokens: int) -> None:
+        needed = self.pages_needed(seq_id, num_new_tokens)
+        if needed > len(self.free_pages):
+            raise RuntimeError(
+                f"The paged KV cache is full: sequence {seq_id} needs {needed} more pages, {len(self.free_pages)} free"
+            )
+        self.page_tables[seq_id].extend(self.free_pages.pop() for _ in range(needed))
+
+    def prepare(self, seq_ids: List[int], num_new_tokens: int) -> PagedBatch:
+        """Reserve room for `num_new_tokens` more tokens in every sequence of `seq_ids` and build the indices of the
+        forward that adds them."""
+        for seq_id in seq_ids:
+            self._reserve(seq_id, num_new_tokens)
+        device = self.device
+        lengths = [self.lengths[seq_id] for seq_id in seq_ids]
+        starts = torch.tensor(lengths, device=device)
+        input_pos = starts.unsqueeze(1) + torch.arange(num_new_tokens, device=device)  # (B, T)
+        max_pages = max(len(self.page_tables[seq_id]) for seq_id in seq_ids)
+        page_table = torch.tensor(
+            [self.page_tables[seq_id] + [0] * (max_pages - len(self.page_tables[seq_id])) for seq_id in seq_ids],
+            device=device,
+        )  # (B, max_pages)
+
+        def slots(positions: torch.Tensor) -> torch.Tensor:
+            pages = page_table.gather(1, positions // self.page_size)
+            return pages * self.page_size + positions % self.page_size
+
+        L = max(lengths) + num_new_tokens
+        positions = torch.arange(L, device=device)
+        # positions past the end of a shorter sequence read whatever its page table points to, they are masked out
+        read_positions = positions.expand(len(seq_ids), L)
+        mask = positions.view(1, 1, L) <= input_pos.unsqueeze(-1)  # (B, T, L)
+
+        for seq_id in seq_ids:
+            self.lengths[seq_id] += num_new_tokens
+        return PagedBatch(
+            input_pos=input_pos,
+            write_slots=slots(input_pos),
+            read_slots=slots(read_positions),
+            mask=mask.unsqueeze(1),
+        )
+
+    def layer(self, i: int, batch: PagedBatch) -> PagedKVCacheLayer:
+        return PagedKVCacheLayer(self.k_pages[i], self.v_pages[i], batch)
+
+
+def forward_paged(
+    model: GPT,
+    idx: torch.Tensor,
+    cache: PagedKVCache,
+    seq_ids: List[int],
+    lm_head_positions: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Forward `idx` (B, T) as the next T tokens of the sequences `seq_ids`, each at its own position in `cache`.
+
+    All rows add the same number of tokens: prompts of different lengths are prefilled one at a time (or in groups of
+    equal length) and then decoded together with T=1.
+
+    Returns:
+        The logits, (B, T, vocab_size) or (B, len(lm_head_positions), vocab_size).
+    """
+    T = idx.size(1)
+    batch = cache.prepare(seq_ids, T)
+    assert int(batch.input_pos.max()) < model.config.block_size, "Cannot attend past the block size"
+    if model.rope_cache is None:
+        model.rope_cache = model.build_rope_cache(idx)
+    cos, sin = model.rope_cache
+    cos, sin = cos[batch.input_pos], sin[batch.input_pos]  # (B, T, n_elem / 2)
+
+    x = model.transformer.wte(idx)
+    for i, block in enumerate(model.transformer.h):
+        x, _ = block(x, (cos, sin), model.config.block_size, batch.mask, None, cache.layer(i, batch))
+    if lm_head_positions is not None:
+        x = x.index_select(1, lm_head_positions)
+    x = model.transformer.ln_f(x)
+    return model.lm_head(x)
@@ -0,0 +1,163 @@
+"""Prompt prefix cache: reuse the keys and values of prompt prefixes that were already prefilled.
+
+Translation and few-shot prompts share long prefixes (a preamble, then `"{lang}: "`), and prefilling them again for every
+request is wasted work. `PrefixCache` keeps the per-layer keys and values of past prompts in a radix tree keyed by token
+ids. Before a prefill, the longest cached prefix is copied into the model's KV cache and only the rest of the prompt is
+forwarded. Keys are stored with RoPE applied at their absolute position, so a prefix is only reusable at the start of a
+sequence, which is always the case for an unpadded prompt.
+"""
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from lit_gpt.model import GPT, KVCache
+
+
+class _Node:
+    def __init__(self, tokens: Tuple[int, ...], kv: List[KVCache], parent: Optional["_Node"]) -> None:
+        # the token ids on the edge from `parent`, and their (len(tokens), n_query_groups, head_size) keys and values
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}
+        self.last_access = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.kv)
+
+    def split(self, length: int) -> "_Node":
+        """Cut the edge after `length` tokens, returning the new node holding the first part."""
+        head = _Node(self.tokens[:length], [(k[:length].clone(), v[:length].clone()) for k, v in self.kv], self.parent)
+        head.last_access = self.last_access
+        self.parent.children[self.tokens[0]] = head
+        self.tokens = self.tokens[length:]
+        self.kv = [(k[length:].clone(), v[length:].clone()) for k, v in self.kv]
+        self.parent = head
+        head.children[self.tokens[0]] = self
+        return head
+
+
+class PrefixCache:
+    def __init__(self, budget_bytes: int) -> None:
+        """A radix tree of prompt prefixes and their keys and values, evicted in least-recently-used order.
+
+        The cached tensors belong to one model: call `clear` after its weights change.
+
+        Args:
+            budget_bytes: maximum size of the cached keys and values. Least recently used prefixes are evicted beyond it.
+        """
+        self.budget_bytes = budget_bytes
+        self.root = _Node((), [], None)
+        self.nbytes = 0
+        self._clock = itertools.count(1)
+        self.lookups = 0
+        self.hits = 0
+        self.prefill_tokens = 0
+        self.saved_prefill_tokens = 0
+        self.evicted_tokens = 0
+
+    def clear(self) -> None:
+        self.root = _Node((), [], None)
+        self.nbytes = 0
+
+    def _match(self, tokens: List[int]) -> Tuple[int, List[_Node]]:
+        """The number of leading `tokens` in the tree and the nodes they go through (the last one possibly partially)."""
+        node, matched, path = self.root, 0, []
+        while matched < len(tokens) and (child := node.children.get(tokens[matched])) is not None:
+            common = 0
+            for a, b in zip(child.tokens, tokens[matched:]):
+                if a != b:
+                    break
+                common += 1
+            path.append(child)
+            matched += common
+            if common < len(child.tokens):
+                break
+            node = child
+        return matched, path
+
+    def _touch(self, path: List[_Node]) -> None:
+        now = next(self._clock)
+        for node in path:
+            node.last_access = now
+
+    def restore(self, model: GPT, tokens: torch.Tensor, max_seq_length: int) -> int:
+        """Copy the keys and values of the longest cached prefix of `tokens` (1D) into the empty KV cache of `model`.
+
+        Returns:
+            The number of restored positions. The prefill continues from there.
+        """
+        assert model.kv_cache_storage_dtype != torch.int8, "The prefix cache does not support the int8 KV cache"
+        tokens = tokens.tolist()
+        matched, path = self._match(tokens)
+        self.lookups += 1
+        self.prefill_tokens += len(tokens)
+        if matched == 0:
+            return 0
+        self.hits += 1
+        self.saved_prefill_tokens += matched
+        self._touch(path)
+
+        if not model.kv_caches:
+            k, _ = path[0].kv[0]
+            rope_cache_length = int(model.config.rotary_percentage * model.config.head_size)
+            model.kv_caches = model.build_kv_caches(
+                torch.empty(1, 0, device=k.device), max_seq_length, rope_cache_length, dtype=k.dtype
+            )
+        for i, (cache_k, cache_v) in enumerate(model.kv_caches):
+            start = 0
+            for node in path:
+                k, v = node.kv[i]
+                length = min(len(node.tokens), matched - start)
+                cache_k[:, start : start + length] = k[:length]
+                cache_v[:, start : start + length] = v[:length]
+                start += length
+        return matched
+
+    def insert(self, tokens: torch.Tensor, kv_caches: List[KVCache]) -> None:
+        """Store the keys and values of the prompt `tokens` (1D), read from the first row of a filled KV cache."""
+        tokens = tokens.tolist()
+        matched, path = self._match(tokens)
+        node = self.root
+        if path:
+            node = path[-1]
+            consumed = sum(len(n.tokens) for n in path)
+            if consumed > matched:
+                # the prompt diverges in the middle of an edge
+                node = node.split(len(node.tokens) - (consumed - matched))
+                path[-1] = node
+        if matched < len(tokens):
+            kv = [(k[0, matched : len(tokens)].clone(), v[0, matched : len(tokens)].clone()) for k, v in kv_caches]
+            leaf = _Node(tuple(tokens[matched:]), kv, node)
+            node.children[leaf.tokens[0]] = leaf
+            self.nbytes += leaf.nbytes
+            path.append(leaf)
+        self._touch(path)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.nbytes > self.budget_bytes:
+            leaves, stack = [], [self.root]
+            while stack:
+                node = stack.pop()
+                stack.extend(node.children.values())
+                if not node.children and node is not self.root:
+                    leaves.append(node)
+            if not leaves:
+                break
+            leaf = min(leaves, key=lambda n: n.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.nbytes -= leaf.nbytes
+            self.evicted_tokens += len(leaf.tokens)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "lookups": self.lookups,
+            "hit_rate": self.hits / max(self.lookups, 1),
+            "saved_prefill_tokens": self.saved_prefill_tokens,
+            "saved_prefill_fraction": self.saved_prefill_tokens / max(self.prefill_tokens, 1),
+            "cached_bytes": self.nbytes,
+            "evicted_tokens": self.evicted_tokens,
+        }
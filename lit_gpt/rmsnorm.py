@@ -2,10 +2,17 @@ import torch
 # Copyright (c) 2022, Tri Dao.
 # Adapted from https://github.com/NVIDIA/apex/blob/master/apex/contrib/layer_norm/layer_norm.py AND https://github.com/Dao-AILab/flash-attention/blob/7a983df74215e035e566e37125b0a71e3618f39d/flash_attn/ops/layer_norm.py#L16
 
-import dropout_layer_norm
 import torch
 from torch.nn import init
 
+from lit_gpt import kernels
+
+try:
+    import dropout_layer_norm
+except ImportError:
+    # the fused kernels below are optional, `lit_gpt.kernels` falls back to the PyTorch RMSNorm without them
+    dropout_layer_norm = None
+
 
 def maybe_align(x, alignment_in_bytes=16):
     """Assume that x already has last dim divisible by alignment_in_bytes"""
@@ -816,7 +823,8 @@ class FusedRMSNorm(torch.nn.Module):
         init.ones_(self.weight)
 
     def forward(self, x):
-        return rms_norm(x, self.weight, self.eps)
+        # the fused kernel when installed, else the PyTorch reference (see `lit_gpt.kernels`)
+        return kernels.get("rmsnorm", x)(x, self.weight, self.eps)
     
     
 class RMSNorm(torch.nn.Module):
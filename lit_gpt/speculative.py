@@ -0,0 +1,161 @@
+"""Speculative decoding: a small draft model proposes tokens that the target model verifies in a single forward.
+
+The draft model runs `num_draft_tokens` cheap decode steps, then the target model scores all proposals at once through
+its KV cache. Proposals are accepted with probability `min(1, p_target / p_draft)` and the first rejected one is
+replaced by a sample from the residual distribution, so the output follows the target model's distribution exactly
+(https://arxiv.org/abs/2211.17192). Both models must share the tokenizer, e.g. `tiny_LLaMA_120M` drafting for
+`tiny_LLaMA_1b`.
+"""
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+
+from lit_gpt.generate import logits_to_probs, prefill
+from lit_gpt.model import GPT
+
+
+@dataclass
+class SpeculativeStats:
+    # number of tokens proposed by the draft model
+    drafted: int = 0
+    # number of proposals the target model accepted
+    accepted: int = 0
+    # number of verification forwards of the target model, excluding the prefill
+    target_forwards: int = 0
+    # number of generated tokens
+    generated: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / max(self.drafted, 1)
+
+    @property
+    def tokens_per_target_forward(self) -> float:
+        return self.generated / max(self.target_forwards, 1)
+
+
+def _positions(start: int, length: int, device: torch.device) -> torch.Tensor:
+    return torch.arange(start, start + length, device=device)
+
+
+@torch.no_grad()
+def speculative_generate(
+    target: GPT,
+    draft: GPT,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    *,
+    num_draft_tokens: int = 4,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+    stop_tokens: Iterable[int] = (),
+) -> Tuple[torch.Tensor, SpeculativeStats]:
+    """Generate a continuation of `prompt` with `target`, drafting with `draft`.
+
+    Args:
+        target: the model whose distribution the output follows.
+        draft: a smaller model with the same vocabulary that proposes tokens.
+        prompt: 1D tensor of token ids.
+        max_new_tokens: maximum number of tokens to generate.
+        num_draft_tokens: number of tokens drafted before every verification forward.
+        temperature: scales the logits before sampling. 0 selects greedy decoding, and the output then matches greedy
+            decoding with `target` alone, up to numerical differences between batched and single-token forwards.
+        top_k: if set, only sample among the `top_k` most likely tokens.
+        top_p: if set, only sample among the smallest set of tokens whose cumulative probability exceeds `top_p`.
+        stop_tokens: generation stops as soon as one of these tokens is produced.
+
+    Returns:
+        The generated tokens without the prompt and without the stop token, and the drafting statistics.
+    """
+    assert target.config.padded_vocab_size == draft.config.padded_vocab_size, "The models must share the vocabulary"
+    device = prompt.device
+    T = prompt.size(0)
+    # the last verification may look up to `num_draft_tokens` positions past the final token
+    max_seq_length = T + max_new_tokens + num_draft_tokens
+    block_size = min(target.config.block_size, draft.config.block_size)
+    assert max_seq_length <= block_size, (
+        f"Cannot generate {max_new_tokens} tokens drafting {num_draft_tokens} after a prompt of {T} tokens, block size"
+        f" is only {block_size}"
+    )
+    stop_tokens = set(stop_tokens)
+    stats = SpeculativeStats()
+
+    def probs(logits: torch.Tensor) -> torch.Tensor:
+        return logits_to_probs(logits, temperature, top_k, top_p)
+
+    # both caches hold every position before `length - 1`. the last token is fed in the next forward. the draft cache
+    # may additionally lag behind by one accepted token, which is fed together with the last one
+    idx = prompt.unsqueeze(0)
+    if T > 1:
+        prefill(target, idx[:, :-1], max_seq_length)
+        prefill(draft, idx[:, :-1], max_seq_length)
+    else:
+        target.reset_cache()
+        draft.reset_cache()
+    tokens: List[int] = prompt.tolist()
+    draft_pending = tokens[-1:]
+
+    while len(tokens) - T < max_new_tokens:
+        length = len(tokens)
+        k = min(num_draft_tokens, max_new_tokens - (length - T))
+
+        # draft k tokens autoregressively
+        drafted, draft_probs = [], []
+        draft_input = torch.tensor([draft_pending], device=device)
+        input_pos = _positions(length - len(draft_pending), len(draft_pending), device)
+        for _ in range(k):
+            last = torch.tensor([draft_input.size(1) - 1], device=device)
+            logits = draft(draft_input, max_seq_length, input_pos, lm_head_positions=last)
+            q = probs(logits[0, -1])
+            token = int(torch.multinomial(q, num_samples=1))
+            drafted.append(token)
+            draft_probs.append(q)
+            draft_input = torch.tensor([[token]], device=device)
+            input_pos = input_pos[-1:] + 1
+
+        # score the last token and all proposals in one target forward
+        target_input = torch.tensor([tokens[-1:] + drafted], device=device)
+        target_logits = target(target_input, max_seq_length, _positions(length - 1, k + 1, device))[0]
+        stats.target_forwards += 1
+        stats.drafted += k
+
+        accepted: List[int] = []
+        next_token = None
+        for i, token in enumerate(drafted):
+            p, q = probs(target_logits[i]), draft_probs[i]
+            if torch.rand((), device=device) * q[token] < p[token]:
+                accepted.append(token)
+                if token in stop_tokens:
+                    break
+                continue
+            # the first rejection is resampled from the part of the target distribution the draft underweights
+            residual = (p - q).clamp_(min=0)
+            residual = residual if residual.sum() > 0 else p
+            next_token = int(torch.multinomial(residual, num_samples=1))
+            break
+        else:
+            # every proposal was accepted: the target forward already gives the distribution of one more token
+            next_token = int(torch.multinomial(probs(target_logits[k]), num_samples=1))
+        stats.accepted += len(accepted)
+
+        new_tokens = accepted + ([] if next_token is None else [next_token])
+        new_tokens = new_tokens[: max_new_tokens - (length - T)]
+        tokens.extend(new_tokens)
+        stats.generated += len(new_tokens)
+        # rolling back rejected positions needs no copy: the next forwards overwrite their cache slots before reading
+        # them, and the causal mask hides whatever is past the current position until then
+        if len(accepted) == k:
+            # the draft model never saw its last proposal
+            draft_pending = tokens[-2:] if next_token is not None else tokens[-1:]
+        else:
+            draft_pending = tokens[-1:]
+        if any(token in stop_tokens for token in new_tokens):
+            break
+
+    output = torch.tensor(tokens[T:], dtype=prompt.dtype)
+    for i, token in enumerate(output.tolist()):
+        if token in stop_tokens:
+            return output[:i], stats
+    return output, stats
@@ -1,7 +1,7 @@
 import time
 from collections import deque
 from contextlib import nullcontext
-from typing import Any, Callable, Deque, Dict, Optional
+from typing import Any, Callable, Deque, Dict, Optional, Union
 
 import torch
 from lightning import Callback, Fabric, LightningModule, Trainer
@@ -193,7 +193,7 @@ class SpeedMonitorBase:
         self.log_iter_interval = log_iter_interval
         # Track the batch num samples and wct to compute throughput over a window of batches
         self.history_samples: Deque[int] = deque(maxlen=window_size + 1)
-        self.history_training_loss: Deque[int] = deque(maxlen=log_iter_interval)
+        self.history_training_loss: Deque[Union[float, torch.Tensor]] = deque(maxlen=log_iter_interval)
         self.history_wct: Deque[float] = deque(maxlen=window_size + 1)
         self.history_lengths: Deque[int] = deque(maxlen=window_size + 1)
         self.history_flops: Deque[int] = deque(maxlen=window_size + 1)
@@ -224,10 +224,14 @@ class SpeedMonitorBase:
         step_count: int,
         flops_per_batch: Optional[int] = None,  # (per device)
         lengths: Optional[int] = None,  # total length of the samples seen (per device)
-        train_loss: Optional[float] = None,
-    ):
+        train_loss: Optional[Union[float, torch.Tensor]] = None,
+    ) -> Optional[Dict[str, float]]:
+        """Record a batch and, every `log_iter_interval` batches, compute and log the metrics and return them.
+
+        `train_loss` can stay a tensor on the device: it is only copied to the host when the metrics are computed, so
+        the iterations in between do not wait for the device.
+        """
         self.iter += 1
-        metrics = {}
 
         self.history_samples.append(samples)
         self.history_training_loss.append(train_loss)
@@ -236,6 +240,13 @@ class SpeedMonitorBase:
             # if lengths are passed, there should be as many values as samples
             assert len(self.history_samples) == len(self.history_lengths)
         self.history_wct.append(train_elapsed)
+        if flops_per_batch is not None:
+            # sum of flops per batch across ranks
+            self.history_flops.append(flops_per_batch * world_size)
+        if self.iter % self.log_iter_interval != 0:
+            return None
+
+        metrics = {}
         if len(self.history_wct) == self.history_wct.maxlen:
             elapsed_batches = len(self.history_samples) - 1
             elapsed_samples = self.history_samples[-1] - self.history_samples[0]
@@ -261,7 +272,8 @@ class SpeedMonitorBase:
                     }
                 )
                 if train_loss is not None:
-                    avg_loss = sum(self.history_training_loss) / len(self.history_training_loss)
+                    # the one host sync for the losses of the last `log_iter_interval` batches
+                    avg_loss = float(sum(self.history_training_loss) / len(self.history_training_loss))
                     metrics.update(
                         {
                             "metric/train_loss": avg_loss,
@@ -269,9 +281,6 @@ class SpeedMonitorBase:
                         }
                     )
 
-        if flops_per_batch is not None:
-            # sum of flops per batch across ranks
-            self.history_flops.append(flops_per_batch * world_size)
         if len(self.history_flops) == self.history_flops.maxlen:
             elapsed_flops = sum(self.history_flops) - self.history_flops[0]
             elapsed_wct = self.history_wct[-1] - self.history_wct[0]
@@ -291,8 +300,8 @@ class SpeedMonitorBase:
                 "samples": samples,
             }
         )
-        if self.iter % self.log_iter_interval == 0:
-            self.log_dict(metrics, step_count)
+        self.log_dict(metrics, step_count)
+        return metrics
 
     def eval_end(self, eval_elapsed: float):
         self.total_eval_wct += eval_elapsed  # seconds
@@ -305,8 +314,8 @@ class SpeedMonitorFabric(SpeedMonitorBase):
         super().__init__(flops_available, fabric.log_dict, *args, **kwargs)
 
     @fabric_rank_zero_only
-    def on_train_batch_end(self, *args: Any, **kwargs: Any):
-        super().on_train_batch_end(*args, **kwargs)
+    def on_train_batch_end(self, *args: Any, **kwargs: Any) -> Optional[Dict[str, float]]:
+        return super().on_train_batch_end(*args, **kwargs)
 
 
 class SpeedMonitorCallback(Callback):
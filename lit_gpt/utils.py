@@ -78,6 +78,17 @@ def quantization(mode: Optional[str] = None):
             def __init__(self, *args, **kwargs):
                 super().__init__(*args, bits=4, tile_cols=-1, **kwargs)
 
+        quantized_linear_cls = QuantizedLinear
+    elif mode in ("cpu.int8", "cpu.int4"):
+        from quantize.cpu import WeightOnlyQuantizedLinear
+
+        bits = 8 if mode == "cpu.int8" else 4
+
+        class QuantizedLinear(WeightOnlyQuantizedLinear):
+            def __init__(self, *args, **kwargs):
+                # int4 needs finer-grained scales than one per output channel to stay accurate
+                super().__init__(*args, bits=bits, group_size=None if bits == 8 else 128, **kwargs)
+
         quantized_linear_cls = QuantizedLinear
     else:
         raise ValueError(f"Unknown quantization mode: {mode}")
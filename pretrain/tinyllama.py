@@ -1,5 +1,6 @@
 import glob
 import math
+import os
 import sys
 import time
 from pathlib import Path
@@ -14,13 +15,23 @@ from functools import partial
 wd = Path(__file__).parent.parent.resolve()
 sys.path.append(str(wd))
 # from apex.optimizers import FusedAdam #torch optimizer has a cuda backend, which is faster actually
+from lit_gpt.activation_checkpointing import CheckpointPolicy, best_policy
+from lit_gpt.autotune import autotune_micro_batch_size, optimizer_state_bytes
+from lit_gpt.checkpoint import (
+    CHECKPOINT_FORMATS,
+    AsyncCheckpointer,
+    latest_checkpoint,
+    load_checkpoint,
+    remove_incomplete_checkpoints,
+)
+from lit_gpt.compile import compile_blocks
 from lit_gpt.model import GPT, Block, Config, CausalSelfAttention
+from lit_gpt.optimizer import create_optimizer
 from lit_gpt.packed_dataset import CombinedDataset, PackedDataset
 from lit_gpt.speed_monitor import SpeedMonitorFabric as Monitor
 from lit_gpt.speed_monitor import estimate_flops, measure_flops
 from lit_gpt.utils import chunked_cross_entropy, get_default_supported_precision, num_parameters, step_csv_logger, lazy_load
 from pytorch_lightning.loggers import WandbLogger
-from lit_gpt import FusedCrossEntropyLoss
 import random
 
 
@@ -40,6 +51,14 @@ weight_decay = 1e-1
 beta1 = 0.9
 beta2 = 0.95
 grad_clip = 1.0
+# AdamW implementation (see `lit_gpt.optimizer`): "for_loop", "foreach", "fused", "8bit" or "auto" (fused on GPUs).
+# "for_loop" is the `foreach=False` update the runs so far were trained and checkpointed with, the others are faster
+# but round differently, so switching a resumed run changes its numerics slightly
+optimizer_implementation = "for_loop"
+# decay every parameter, like TinyLlama. False keeps the biases and the norm and embedding weights out of weight decay
+decay_norms_and_embeddings = True
+# tokens whose logits exist at once in the loss (see `lit_gpt.linear_cross_entropy`). 0 materializes all the logits
+loss_chunk_size = 1024
 decay_lr = True
 min_lr = 4e-5
 
@@ -89,8 +108,30 @@ def setup(
     slim_offset: Optional[int] = 0,
     ensure_last_parallel: Optional[bool] = False,
     reset_dataloader: bool = False,
+    activation_checkpointing: str = "none",
+    autotune: bool = False,
+    compile: bool = False,
+    checkpoint_format: str = "sharded",
+    keep_checkpoints: Optional[int] = None,
+    keep_checkpoints_every: Optional[int] = None,
 ) -> None:
+    """`activation_checkpointing` picks the parts of the blocks recomputed in the backward pass, e.g. "mlp",
+    "attention", "block" or "mlp:2" (see `lit_gpt.activation_checkpointing`), or "auto" for the fastest policy
+    predicted to fit in the GPU memory.
+
+    `autotune` replaces `micro_batch_size` with the fastest size that fits, measured on the model before training
+    (see `lit_gpt.autotune`). A resumed run keeps the micro-batch size it was trained with.
+
+    `compile` runs the transformer blocks with `torch.compile` (see `lit_gpt.compile`).
+
+    `checkpoint_format` "sharded" has every rank write its shard in the background (see `lit_gpt.checkpoint`), resumed
+    on the same number of devices, and keeps the `keep_checkpoints` most recent ones (all by default) and those of the
+    steps that are multiples of `keep_checkpoints_every`. "full" saves a single `.pth` from rank 0. Either resumes."""
+    if checkpoint_format not in CHECKPOINT_FORMATS:
+        raise ValueError(f"Unknown checkpoint_format {checkpoint_format!r}, expected one of {CHECKPOINT_FORMATS}")
     precision = precision or get_default_supported_precision(training=True, tpu=tpu)
+    activation_checkpointing = checkpoint_policy(activation_checkpointing, model_name, devices, precision)
+    hparams["activation_checkpointing"] = str(activation_checkpointing)
     wandb_logger = WandbLogger(project=project_name)
     out_dir = Path("out") / project_name
 
@@ -102,8 +143,10 @@ def setup(
         else:
             strategy = FSDPStrategy(
                 auto_wrap_policy={Block},
-                activation_checkpointing_policy=None,
+                activation_checkpointing_policy=activation_checkpointing or None,
                 state_dict_type="full",
+                # sharded checkpoints save the local views of the original parameters
+                use_orig_params=True,
                 limit_all_gathers=True,
                 cpu_offload=False,
             )
@@ -112,37 +155,21 @@ def setup(
 
     fabric = L.Fabric(devices=devices, strategy=strategy, precision=precision, loggers=[logger, wandb_logger])
     fabric.print(hparams)
+    checkpointer = None
+    if checkpoint_format == "sharded":
+        checkpointer = AsyncCheckpointer(fabric, keep_last=keep_checkpoints, keep_every=keep_checkpoints_every)
     #fabric.launch(main, train_data_dir, val_data_dir, resume)
-    main(model_name, fabric, train_data_dir, val_data_dir, parallel_data_dir, parallel_location, resume, out_dir, eval_step_interval, slim_perc, reset_dataloader, parallel_upsample, slim_offset, ensure_last_parallel)
+    main(model_name, fabric, train_data_dir, val_data_dir, parallel_data_dir, parallel_location, resume, out_dir, eval_step_interval, slim_perc, reset_dataloader, parallel_upsample, slim_offset, ensure_last_parallel, activation_checkpointing, autotune, compile, checkpointer)
 
 
-def main(model_name, fabric, train_data_dir, val_data_dir, parallel_data_dir, parallel_location, resume, out_dir, eval_step_interval, slim_perc, reset_dataloader, parallel_upsample, slim_offset, ensure_last_parallel):
-    monitor = Monitor(fabric, window_size=2, time_unit="seconds", log_iter_interval=log_iter_interval)
+def main(model_name, fabric, train_data_dir, val_data_dir, parallel_data_dir, parallel_location, resume, out_dir, eval_step_interval, slim_perc, reset_dataloader, parallel_upsample, slim_offset, ensure_last_parallel, activation_checkpointing, autotune, compile, checkpointer):
     fabric.print(f"train_data_dir: {train_data_dir}, val_data_dir: {val_data_dir}, parallel_data_dir: {parallel_data_dir}, parallel_location: {parallel_location}, resume: {resume}, out_dir: {out_dir}, eval_step_interval: {eval_step_interval}, slim_perc: {slim_perc}, reset_dataloader: {reset_dataloader}, parallel_upsample: {parallel_upsample}, slim_offset: {slim_offset}, ensure_last_parallel: {ensure_last_parallel}")
     if fabric.global_rank == 0:
         out_dir.mkdir(parents=True, exist_ok=True)
+        remove_incomplete_checkpoints(out_dir)
 
     config = Config.from_name(model_name)
 
-    train_dataloader, val_dataloader = create_dataloaders(
-        batch_size=micro_batch_size,
-        block_size=config.block_size,
-        fabric=fabric,
-        train_data_dir=train_data_dir,
-        parallel_data_dir=parallel_data_dir,
-        parallel_location=parallel_location,
-        val_data_dir=val_data_dir,
-        slim_perc=slim_perc,
-        slim_offset=slim_offset,
-        parallel_upsample=parallel_upsample,
-        ensure_last_parallel=ensure_last_parallel,
-        seed=3407,
-    )
-    if val_dataloader is None:
-        train_dataloader = fabric.setup_dataloaders(train_dataloader)
-    else:
-        train_dataloader, val_dataloader = fabric.setup_dataloaders(train_dataloader, val_dataloader)
-
     fabric.seed_everything(3407)  # same seed for every process to init model (FSDP)
 
     fabric.print(f"Loading model with {config.__dict__}")
@@ -150,42 +177,91 @@ def main(model_name, fabric, train_data_dir, val_data_dir, parallel_data_dir, pa
     with fabric.init_module(empty_init=False):
         model = GPT(config)
         model.apply(partial(model._init_weights ,n_layer=config.n_layer))
+    model.cross_entropy_chunk_size = loss_chunk_size
+    if activation_checkpointing and not isinstance(fabric.strategy, FSDPStrategy):
+        # `FSDPStrategy` wraps the checkpointed modules itself in `fabric.setup`
+        activation_checkpointing.apply(model)
+    fabric.print(f"Activation checkpointing: {activation_checkpointing}")
+    if compile:
+        compile_blocks(model)
  
 
     fabric.print(f"Time to instantiate model: {time.perf_counter() - t0:.02f} seconds.")
     fabric.print(f"Total parameters {num_parameters(model):,}")
 
     model = fabric.setup(model)
-    optimizer = torch.optim.AdamW(
-        model.parameters(), lr=learning_rate, weight_decay=weight_decay, betas=(beta1, beta2), foreach=False
+    if autotune and not resume:
+        size, trials = autotune_micro_batch_size(
+            fabric,
+            model,
+            config.block_size,
+            global_batch_size // fabric.world_size,
+            reserved_bytes=optimizer_state_bytes(model),
+        )
+        set_micro_batch_size(size, fabric.world_size)
+        hparams["autotuned_tokens_per_second"] = {t.micro_batch_size: round(t.tokens_per_second) for t in trials}
+        fabric.print(f"Autotuned micro_batch_size {micro_batch_size}, gradient_accumulation_steps {gradient_accumulation_steps}")
+    optimizer = create_optimizer(
+        model,
+        optimizer_implementation,
+        lr=learning_rate,
+        weight_decay=weight_decay,
+        betas=(beta1, beta2),
+        decay_norms_and_embeddings=decay_norms_and_embeddings,
     )
-    # optimizer = FusedAdam(model.parameters(), lr=learning_rate, weight_decay=weight_decay, betas=(beta1, beta2),adam_w_mode=True)
     optimizer = fabric.setup_optimizers(optimizer)
 
     state = {"model": model, "optimizer": optimizer, "hparams": hparams, "iter_num": 0, "step_count": 0}
 
     if resume is True:
-        ckpts = out_dir.glob("*.pth")
-        iters = {int(str(c.name).split('-')[1]):c for c in ckpts}
-        last_iter = sorted(list(iters.keys()))[-1]
-        resume = iters[last_iter]
+        resume = latest_checkpoint(out_dir)
+        if resume is None:
+            raise FileNotFoundError(f"No checkpoint to resume from in {str(out_dir)!r}")
     if resume :
         fabric.print(f"Resuming training from {resume}")
-        fabric.load(resume, state)
+        load_checkpoint(fabric, resume, state)
+        # the data position of a resumed run counts micro-batches of the size it was trained with
+        resumed_size = state["hparams"].get("micro_batch_size", micro_batch_size)
+        if resumed_size != micro_batch_size:
+            fabric.print(f"Resuming with the checkpoint's micro_batch_size {resumed_size}")
+            set_micro_batch_size(resumed_size, fabric.world_size)
+        state["hparams"] = hparams
 
     if reset_dataloader:
         fabric.print(f"Data loader and num iteration reset to the start.")
         state["iter_num"] = 0
-    
+
+    train_dataloader, val_dataloader = create_dataloaders(
+        batch_size=micro_batch_size,
+        block_size=config.block_size,
+        fabric=fabric,
+        train_data_dir=train_data_dir,
+        parallel_data_dir=parallel_data_dir,
+        parallel_location=parallel_location,
+        val_data_dir=val_data_dir,
+        slim_perc=slim_perc,
+        slim_offset=slim_offset,
+        parallel_upsample=parallel_upsample,
+        ensure_last_parallel=ensure_last_parallel,
+        seed=3407,
+    )
+    if val_dataloader is None:
+        train_dataloader = fabric.setup_dataloaders(train_dataloader)
+    else:
+        train_dataloader, val_dataloader = fabric.setup_dataloaders(train_dataloader, val_dataloader)
+
+    monitor = Monitor(fabric, window_size=2, time_unit="seconds", log_iter_interval=log_iter_interval)
     fabric.print(torch.cuda.get_device_name(0))
     train_time = time.perf_counter()
-    train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_dir, eval_step_interval)
+    train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_dir, eval_step_interval, checkpointer)
+    if checkpointer is not None:
+        checkpointer.wait()
     fabric.print(f"Training time: {(time.perf_counter()-train_time):.2f}s")
     if fabric.device.type == "cuda":
         fabric.print(f"Memory used: {torch.cuda.max_memory_allocated() / 1e9:.02f} GB")
 
 
-def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_dir, eval_step_interval):
+def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_dir, eval_step_interval, checkpointer):
     model = state["model"]
     optimizer = state["optimizer"]
 
@@ -216,8 +292,8 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
     
     initial_iter = state["iter_num"]
     curr_iter = 0
+    log_t0, log_iter_num = time.perf_counter(), initial_iter
             
-    loss_func = FusedCrossEntropyLoss()
     for  train_data in train_dataloader:
         # resume loader state. This is not elegant but it works. Should rewrite it in the future.
         if resume:
@@ -229,6 +305,7 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
                 curr_iter = -1
                 fabric.barrier()
                 fabric.print("resume finished, taken {} seconds".format(time.perf_counter() - total_t0))
+                log_t0 = time.perf_counter()
         if state["iter_num"] >= max_iters:
             break
         
@@ -237,15 +314,12 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
         for param_group in optimizer.param_groups:
             param_group["lr"] = lr
 
-        iter_t0 = time.perf_counter()
-
         input_ids = train_data[:, 0 : model.config.block_size].contiguous()
         targets = train_data[:, 1 : model.config.block_size + 1].contiguous()
         is_accumulating = (state["iter_num"] + 1) % gradient_accumulation_steps != 0
         with fabric.no_backward_sync(model, enabled=is_accumulating):
-            logits = model(input_ids)
-            loss = loss_func(logits, targets)
-            # loss = chunked_cross_entropy(logits, targets, chunk_size=0)
+            # the loss comes from the final hidden states chunk by chunk, the (B, T, vocab_size) logits never exist
+            loss = model(input_ids, targets=targets)
             fabric.backward(loss / gradient_accumulation_steps)
 
         if not is_accumulating:
@@ -259,15 +333,9 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
         # input_id: B L 
         total_lengths += input_ids.size(1)
         t1 = time.perf_counter()
-        fabric.print(
-                f"iter {state['iter_num']} step {state['step_count']}: loss {loss.item():.4f}, iter time:"
-                f" {(t1 - iter_t0) * 1000:.2f}ms{' (optimizer.step)' if not is_accumulating else ''}"
-                f" remaining time: {(t1 - total_t0) / (state['iter_num'] - initial_iter) * (max_iters - state['iter_num']) / 3600:.2f} hours. " 
-                # print days as well
-                f" or {(t1 - total_t0) / (state['iter_num'] - initial_iter) * (max_iters - state['iter_num']) / 3600 / 24:.2f} days. "
-            )
- 
-        monitor.on_train_batch_end(
+        # the loss stays on the device: the monitor copies the average of the last `log_iter_interval` losses to the
+        # host when it logs, so the other iterations queue their kernels without waiting for the device
+        metrics = monitor.on_train_batch_end(
             state["iter_num"] * micro_batch_size,
             t1 - total_t0,
             # this assumes that device FLOPs are the same and that all devices have the same batch size
@@ -275,8 +343,11 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
             state["step_count"],
             flops_per_batch=estimated_flops,
             lengths=total_lengths,
-            train_loss = loss.item()
+            train_loss=loss.detach(),
         )
+        if metrics is not None:
+            print_progress(fabric, state, metrics, log_t0, log_iter_num, initial_iter, total_t0)
+            log_t0, log_iter_num = time.perf_counter(), state["iter_num"]
 
             
             
@@ -292,11 +363,81 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume, out_
             fabric.log_dict({"metric/val_ppl": math.exp(val_loss.item()), "total_tokens": model.config.block_size * (state["iter_num"] + 1) * micro_batch_size * fabric.world_size}, state["step_count"])
             fabric.barrier()
         if not is_accumulating and state["step_count"] % eval_step_interval == 0:
-            checkpoint_path = out_dir / f"iter-{state['iter_num']:06d}-token-{num_tokens}-ckpt.pth"
+            checkpoint_path = out_dir / f"iter-{state['iter_num']:06d}-token-{num_tokens}-ckpt"
+            if checkpointer is None:
+                checkpoint_path = checkpoint_path.with_suffix(".pth")
             fabric.print(f"Saving checkpoint to {str(checkpoint_path)!r}")
-            fabric.save(checkpoint_path, state)
+            if checkpointer is None:
+                fabric.save(checkpoint_path, state)
+            else:
+                checkpointer.save(checkpoint_path, state)
 
         
+def print_progress(
+    fabric: L.Fabric, state: dict, metrics: dict, log_t0: float, log_iter_num: int, initial_iter: int, total_t0: float
+) -> None:
+    """Print the average loss and iteration time since the last print and the remaining time."""
+    t1 = time.perf_counter()
+    iter_time = (t1 - log_t0) / max(state["iter_num"] - log_iter_num, 1)
+    remaining = (t1 - total_t0) / (state["iter_num"] - initial_iter) * (max_iters - state["iter_num"]) / 3600
+    loss = f"loss {metrics['metric/train_loss']:.4f}, " if "metric/train_loss" in metrics else ""
+    fabric.print(
+        f"iter {state['iter_num']} step {state['step_count']}: {loss}iter time: {iter_time * 1000:.2f}ms"
+        f" remaining time: {remaining:.2f} hours or {remaining / 24:.2f} days."
+    )
+
+
+def set_micro_batch_size(size: int, world_size: int) -> None:
+    """Train with `size` sequences per forward, keeping the global batch size and the schedule in optimizer steps."""
+    global micro_batch_size, batch_size, gradient_accumulation_steps, warmup_iters, log_iter_interval, max_iters
+    global lr_decay_iters
+    batch_size = global_batch_size // world_size
+    if batch_size % size:
+        raise ValueError(f"micro_batch_size {size} does not divide the {batch_size} sequences per device and step")
+    micro_batch_size = size
+    gradient_accumulation_steps = batch_size // micro_batch_size
+    warmup_iters = warmup_steps * gradient_accumulation_steps
+    log_iter_interval = log_step_interval * gradient_accumulation_steps
+    max_iters = max_step * gradient_accumulation_steps
+    lr_decay_iters = max_iters
+    hparams.update(
+        num_of_devices=world_size,
+        micro_batch_size=micro_batch_size,
+        batch_size=batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        warmup_iters=warmup_iters,
+        log_iter_interval=log_iter_interval,
+        max_iters=max_iters,
+        lr_decay_iters=lr_decay_iters,
+    )
+
+
+def checkpoint_policy(spec: str, model_name: str, devices: Union[int, str], precision: str) -> CheckpointPolicy:
+    """Parse `spec`, or with "auto" pick the fastest policy predicted to fit in 90% of the GPU memory."""
+    if spec != "auto":
+        return CheckpointPolicy.from_string(spec)
+    if not torch.cuda.is_available():
+        return CheckpointPolicy()
+    config = Config.from_name(model_name)
+    budget = 0.9 * torch.cuda.get_device_properties(0).total_memory
+    # FSDP shards the states over every rank: all the visible GPUs for "auto" or -1, and the ranks of all the nodes
+    # when a launcher like torchrun sets `WORLD_SIZE`
+    n_devices = devices if isinstance(devices, int) and devices > 0 else torch.cuda.device_count()
+    n_devices = int(os.environ.get("WORLD_SIZE", n_devices))
+    best, _ = best_policy(
+        config,
+        micro_batch_size,
+        budget,
+        n_devices=n_devices,
+        bytes_per_element=4 if precision.startswith("32") else 2,
+        loss_chunk_size=loss_chunk_size,
+    )
+    if best is None:
+        print(f"No activation checkpointing policy is predicted to fit micro_batch_size={micro_batch_size}, using 'block'")
+        return CheckpointPolicy(("block",))
+    return best.policy
+
+
 @torch.no_grad()
 def validate(fabric: L.Fabric, model: torch.nn.Module, val_dataloader: DataLoader) -> torch.Tensor:
     fabric.print("Validating ...")
@@ -308,12 +449,11 @@ def validate(fabric: L.Fabric, model: torch.nn.Module, val_dataloader: DataLoade
             break
         input_ids = val_data[:, 0 : model.config.block_size].contiguous()
         targets = val_data[:, 1 : model.config.block_size + 1].contiguous()
-        logits = model(input_ids)
-        loss = chunked_cross_entropy(logits, targets, chunk_size=0)
+        loss = model(input_ids, targets=targets)
 
         # loss_func = FusedCrossEntropyLoss()
         # loss = loss_func(logits, targets)
-        losses[k] = loss.item()
+        losses[k] = loss
         
     out = losses.mean()
 
@@ -0,0 +1,137 @@
+"""Weight-only int8/int4 quantized linear layers for CPU inference.
+
+The weights are stored as symmetric integers with one float scale per output channel (or per group of `group_size`
+input channels) and are dequantized on the fly in plain PyTorch, so they run anywhere without extra kernels. Only the
+memory footprint and the weight traffic shrink, the matmul itself runs in the activation dtype. The forward dequantizes
+a block of output channels at a time, so a float copy of the whole weight never exists.
+"""
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+
+def quantize_weight(weight: torch.Tensor, bits: int, group_size: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """Symmetrically quantize a (out_features, in_features) weight.
+
+    Returns:
+        The integer weight, as int8 values or as pairs of int4 values packed into uint8, and the
+        (out_features, in_features // group_size) scales.
+    """
+    out_features, in_features = weight.shape
+    group_size = group_size or in_features
+    assert in_features % group_size == 0, f"{in_features} input features cannot be split in groups of {group_size}"
+    max_int = 2 ** (bits - 1) - 1
+    groups = weight.float().view(out_features, in_features // group_size, group_size)
+    scales = groups.abs().amax(dim=-1).clamp_(min=1e-8) / max_int
+    qweight = torch.round(groups / scales.unsqueeze(-1)).clamp_(-max_int - 1, max_int).to(torch.int8)
+    qweight = qweight.view(out_features, in_features)
+    if bits == 4:
+        # two values per byte, stored with an offset of 8 to make them unsigned
+        unsigned = (qweight + 8).to(torch.uint8)
+        qweight = unsigned[:, 0::2] | (unsigned[:, 1::2] << 4)
+    return {"qweight": qweight, "scales": scales.to(weight.dtype)}
+
+
+class WeightOnlyQuantizedLinear(torch.nn.Module):
+    # output channels dequantized at once by `forward`
+    block_out_features = 256
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        bits: int = 8,
+        group_size: Optional[int] = None,
+    ) -> None:
+        """A drop-in replacement for `torch.nn.Linear` that stores its weight quantized.
+
+        A float `weight` found in a loaded state dict is quantized on the fly, and a state dict saved from this layer
+        (with `qweight` and `scales`) loads as is.
+
+        Args:
+            bits: 8 or 4.
+            group_size: number of input channels sharing a scale. `None` uses one scale per output channel.
+        """
+        super().__init__()
+        assert bits in (4, 8), f"Only 8 and 4 bits are supported, got {bits}"
+        if group_size is not None and in_features % group_size != 0:
+            # fall back to per-channel scales for layers that cannot be split evenly
+            group_size = None
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size or in_features
+        dtype = dtype or torch.get_default_dtype()
+        packed_features = in_features // 2 if bits == 4 else in_features
+        qdtype = torch.uint8 if bits == 4 else torch.int8
+        self.register_buffer("qweight", torch.zeros(out_features, packed_features, dtype=qdtype, device=device))
+        self.register_buffer(
+            "scales", torch.ones(out_features, in_features // self.group_size, dtype=dtype, device=device)
+        )
+        if bias:
+            self.bias = torch.nn.Parameter(torch.zeros(out_features, dtype=dtype, device=device))
+        else:
+            self.register_parameter("bias", None)
+
+    def _load_from_state_dict(
+        self,
+        state_dict: Dict[str, Any],
+        prefix: str,
+        local_metadata: Dict[str, Any],
+        strict: bool,
+        missing_keys: List[str],
+        unexpected_keys: List[str],
+        error_msgs: List[str],
+    ) -> None:
+        weight = state_dict.pop(prefix + "weight", None)
+        if weight is not None:
+            if hasattr(weight, "_load_tensor"):
+                # a `NotYetLoadedTensor` from `lit_gpt.utils.lazy_load`
+                weight = weight._load_tensor()
+            quantized = quantize_weight(weight, self.bits, self.group_size)
+            state_dict[prefix + "qweight"] = quantized["qweight"]
+            state_dict[prefix + "scales"] = quantized["scales"]
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+        )
+
+    def dequantize(
+        self, dtype: Optional[torch.dtype] = None, start: int = 0, end: Optional[int] = None
+    ) -> torch.Tensor:
+        """The dequantized rows `start:end` of the weight, all of them by default."""
+        end = self.out_features if end is None else end
+        qweight = self.qweight[start:end]
+        if self.bits == 4:
+            low = (qweight & 0xF).to(torch.int8) - 8
+            high = (qweight >> 4).to(torch.int8) - 8
+            qweight = torch.stack((low, high), dim=-1).view(end - start, self.in_features)
+        dtype = dtype or self.scales.dtype
+        groups = qweight.view(end - start, -1, self.group_size).to(dtype)
+        return (groups * self.scales[start:end].to(dtype).unsqueeze(-1)).view(end - start, self.in_features)
+
+    def _forward_block(self, x: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        bias = None if self.bias is None else self.bias[start:end].to(x.dtype)
+        if self.bits == 8 and self.group_size == self.in_features:
+            # per-channel scales commute with the matmul: scale the outputs instead of the weight
+            out = F.linear(x, self.qweight[start:end].to(x.dtype)) * self.scales[start:end].to(x.dtype).view(-1)
+            return out if bias is None else out + bias
+        return F.linear(x, self.dequantize(x.dtype, start, end), bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.out_features <= self.block_out_features:
+            return self._forward_block(x, 0, self.out_features)
+        out = x.new_empty(*x.shape[:-1], self.out_features)
+        for start in range(0, self.out_features, self.block_out_features):
+            end = min(start + self.block_out_features, self.out_features)
+            out[..., start:end] = self._forward_block(x, start, end)
+        return out
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None},"
+            f" bits={self.bits}, group_size={self.group_size}"
+        )
@@ -0,0 +1,87 @@
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.beam_search import beam_search, reorder_kv_caches
+from lit_gpt.model import GPT, Config
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def benchmark_reorder(model: GPT, num_beams: int, max_seq_length: int, num_steps: int, device: torch.device) -> tuple:
+    """Time reordering the KV caches into preallocated buffers against allocating new caches at every step."""
+    x = torch.empty(num_beams, 0, dtype=next(model.parameters()).dtype, device=device)
+    rope_cache_length = int(model.config.rotary_percentage * model.config.head_size)
+    kv_caches = model.build_kv_caches(x, max_seq_length, rope_cache_length)
+    spare = model.build_kv_caches(x, max_seq_length, rope_cache_length)
+    beam_idx = torch.randint(0, num_beams, (num_beams,), device=device)
+
+    _sync(device)
+    t0 = time.perf_counter()
+    for _ in range(num_steps):
+        kv_caches, spare = reorder_kv_caches(kv_caches, spare, beam_idx), kv_caches
+    _sync(device)
+    t1 = time.perf_counter()
+    for _ in range(num_steps):
+        kv_caches = [(k.index_select(0, beam_idx), v.index_select(0, beam_idx)) for k, v in kv_caches]
+    _sync(device)
+    t2 = time.perf_counter()
+    return (t1 - t0) / num_steps, (t2 - t1) / num_steps
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    beams: List[int] = [1, 4, 8],
+    prompt_length: int = 32,
+    max_new_tokens: int = 64,
+    num_runs: int = 3,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Report the beam search decode speed of a randomly initialized model for several beam sizes, and the cost of
+    reordering the KV caches in place compared to reallocating them."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    config = Config.from_name(model_name)
+    with torch.device(device):
+        model = GPT(config)
+    model = model.to(dtype=getattr(torch, dtype)).eval()
+    prompt = torch.randint(0, config.vocab_size, (prompt_length,), device=device)
+
+    for num_beams in beams:
+        times = []
+        # the first run is a warm-up and is not reported
+        for run in range(num_runs + 1):
+            _sync(device)
+            t0 = time.perf_counter()
+            beam_search(model, prompt, max_new_tokens, num_beams=num_beams)
+            _sync(device)
+            if run > 0:
+                times.append(time.perf_counter() - t0)
+        elapsed = sum(times) / num_runs
+        in_place, realloc = benchmark_reorder(model, num_beams, prompt_length + max_new_tokens, max_new_tokens, device)
+        print(
+            f"{model_name} beams={num_beams} ({dtype}, {device}): {elapsed * 1000 / max_new_tokens:.2f}ms per step,"
+            f" {max_new_tokens / elapsed:.1f} steps/s. cache reorder {in_place * 1000:.3f}ms in place vs"
+            f" {realloc * 1000:.3f}ms reallocated",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,89 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import lightning as L
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.checkpoint import AsyncCheckpointer, latest_checkpoint, load_checkpoint
+from lit_gpt.model import GPT, Config
+from lit_gpt.optimizer import create_optimizer
+
+
+def training_state(fabric: L.Fabric, config: Config, seed: int) -> Dict:
+    """A set up model and optimizer after one step on random gradients, as `pretrain/tinyllama.py` checkpoints them."""
+    torch.manual_seed(seed)
+    with fabric.init_module():
+        model = GPT(config)
+    model = fabric.setup(model)
+    optimizer = fabric.setup_optimizers(create_optimizer(model, lr=1e-4, weight_decay=0.1))
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+    optimizer.step()
+    return {"model": model, "optimizer": optimizer, "hparams": {"seed": seed}, "iter_num": 100, "step_count": 10}
+
+
+def max_diff(a: Dict, b: Dict) -> float:
+    diffs = [(p - q).abs().max().item() for p, q in zip(a["model"].parameters(), b["model"].parameters())]
+    for p, q in zip(a["model"].parameters(), b["model"].parameters()):
+        sa, sb = a["optimizer"].state[p], b["optimizer"].state[q]
+        diffs += [(sa[k] - sb[k]).abs().max().item() for k in ("exp_avg", "exp_avg_sq")]
+    return max(diffs)
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    saves: int = 3,
+    device: Optional[str] = None,
+    out_dir: Optional[Path] = None,
+    seed: int = 1234,
+) -> None:
+    """Compare how long training is blocked by `fabric.save` of a full `.pth` and by `AsyncCheckpointer.save` on one
+    device, how long the background write takes, and check that both checkpoints resume the same state."""
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    fabric = L.Fabric(devices=1, accelerator=device)
+    config = Config.from_name(model_name)
+    state = training_state(fabric, config, seed)
+    checkpointer = AsyncCheckpointer(fabric, keep_last=1)
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        blocked, written = [], []
+        for i in range(saves):
+            t0 = time.perf_counter()
+            fabric.save(tmp_dir / f"iter-{i:06d}-ckpt.pth", state)
+            blocked.append(time.perf_counter() - t0)
+        full_time = sum(blocked) / saves
+        blocked = []
+        for i in range(saves):
+            t0 = time.perf_counter()
+            checkpointer.save(tmp_dir / f"iter-{saves + i:06d}-ckpt", state)
+            blocked.append(time.perf_counter() - t0)
+            checkpointer.wait()
+            written.append(time.perf_counter() - t0)
+        print(
+            f"{model_name}, {device}: full .pth blocks {full_time * 1000:.1f}ms, sharded blocks"
+            f" {blocked[-1] * 1000:.1f}ms (first save {blocked[0] * 1000:.1f}ms with the host buffers),"
+            f" written in the background in {sum(written) / saves * 1000:.1f}ms",
+            flush=True,
+        )
+
+        for path in (tmp_dir / f"iter-{saves - 1:06d}-ckpt.pth", latest_checkpoint(tmp_dir)):
+            resumed = training_state(fabric, config, seed + 1)
+            load_checkpoint(fabric, path, resumed)
+            print(
+                f"  resumed from {path.name}: iter_num {resumed['iter_num']},"
+                f" max abs diff {max_diff(state, resumed):.2e}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(benchmark)
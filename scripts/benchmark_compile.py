@@ -0,0 +1,116 @@
+import copy
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.compile import compile_blocks, compiled_decode_one
+from lit_gpt.generate import decode_one, prefill
+from lit_gpt.model import GPT, Config
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timeit(fn: Callable, device: torch.device, iters: int) -> float:
+    _sync(device)
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - t0) / iters
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    n_layer: Optional[int] = None,
+    batch_size: int = 2,
+    seq_length: int = 256,
+    decode_steps: int = 32,
+    iters: int = 5,
+    device: str = "cpu",
+    mode: Optional[str] = None,
+    seed: int = 1234,
+) -> None:
+    """Compare eager and `torch.compile` (inductor) for a training forward and backward with the blocks compiled
+    (`compile_blocks`) and for KV-cache decode steps (`compiled_decode_one`): compile time, step time and max abs
+    difference of the outputs. Runs on CPU by default."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    kwargs = {} if n_layer is None else {"n_layer": n_layer}
+    config = Config.from_name(model_name, **kwargs)
+    with device:
+        eager = GPT(config)
+        eager.apply(lambda module: eager._init_weights(module, config.n_layer))
+    compiled = compile_blocks(copy.deepcopy(eager), mode=mode)
+    idx = torch.randint(0, config.vocab_size, (batch_size, seq_length + 1), device=device)
+    input_ids, targets = idx[:, :-1], idx[:, 1:]
+    print(f"{model_name}, {config.n_layer} layers, batch {batch_size} x {seq_length} tokens, {device.type}", flush=True)
+
+    def train_step(model: GPT) -> torch.Tensor:
+        model.zero_grad(set_to_none=True)
+        loss = model(input_ids, targets=targets)
+        loss.backward()
+        return loss.detach()
+
+    t0 = time.perf_counter()
+    compiled_loss = train_step(compiled)
+    compile_time = time.perf_counter() - t0
+    eager_loss = train_step(eager)
+    grad_diff = max(
+        (a.grad - b.grad).abs().max().item() for a, b in zip(eager.parameters(), compiled.parameters())
+    )
+    eager_time = timeit(lambda: train_step(eager), device, iters)
+    compiled_time = timeit(lambda: train_step(compiled), device, iters)
+    print(
+        f"  training step: eager {eager_time * 1000:.1f}ms, compiled blocks {compiled_time * 1000:.1f}ms"
+        f" ({eager_time / compiled_time:.2f}x, compiled in {compile_time:.1f}s),"
+        f" loss diff {(eager_loss - compiled_loss).abs().item():.2e}, max grad diff {grad_diff:.2e}",
+        flush=True,
+    )
+
+    # decode after an eager prefill of the prompt, with static cache shapes
+    eager.eval()
+    step = compiled_decode_one(mode=mode)
+    max_seq_length = seq_length + decode_steps + 1
+    prompt = idx[:, :seq_length]
+
+    @torch.no_grad()
+    def decode(fn: Callable) -> Tuple[torch.Tensor, float]:
+        """The last logits and the time per decode step, the eager prefill excluded."""
+        prefill(eager, prompt, max_seq_length)
+        token = prompt[:, -1]
+        _sync(device)
+        t0 = time.perf_counter()
+        for i in range(decode_steps):
+            logits = fn(eager, token, torch.tensor([seq_length + i], device=device), max_seq_length)
+            token = logits.argmax(dim=-1)
+        _sync(device)
+        return logits, (time.perf_counter() - t0) / decode_steps
+
+    compiled_logits, first_step_time = decode(step)
+    eager_logits, _ = decode(decode_one)
+    eager_time = sum(decode(decode_one)[1] for _ in range(iters)) / iters
+    compiled_time = sum(decode(step)[1] for _ in range(iters)) / iters
+    print(
+        f"  decode step: eager {eager_time * 1000:.2f}ms, compiled {compiled_time * 1000:.2f}ms"
+        f" ({eager_time / compiled_time:.2f}x, first run {first_step_time * decode_steps:.1f}s with compilation),"
+        f" max logits diff {(eager_logits - compiled_logits).abs().max().item():.2e}",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,88 @@
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.generate import decode_one, prefill, sample
+from lit_gpt.model import GPT, Config
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def benchmark_model(
+    model: GPT, batch_size: int, prompt_length: int, max_new_tokens: int, num_runs: int, device: torch.device
+) -> dict:
+    max_seq_length = prompt_length + max_new_tokens
+    idx = torch.randint(0, model.config.vocab_size, (batch_size, prompt_length), device=device)
+    prefill_times, decode_times = [], []
+    # the first run is a warm-up and is not reported
+    for run in range(num_runs + 1):
+        _sync(device)
+        t0 = time.perf_counter()
+        logits = prefill(model, idx, max_seq_length)
+        _sync(device)
+        t1 = time.perf_counter()
+        input_pos = torch.tensor([prompt_length], device=device)
+        for _ in range(max_new_tokens):
+            token = sample(logits, temperature=0.0)
+            logits = decode_one(model, token, input_pos, max_seq_length)
+            input_pos = input_pos + 1
+        _sync(device)
+        t2 = time.perf_counter()
+        if run > 0:
+            prefill_times.append(t1 - t0)
+            decode_times.append(t2 - t1)
+    prefill_time = sum(prefill_times) / num_runs
+    decode_time = sum(decode_times) / num_runs
+    return {
+        "prefill_tokens_per_sec": batch_size * prompt_length / prefill_time,
+        "decode_tokens_per_sec": batch_size * max_new_tokens / decode_time,
+        "prefill_ms": prefill_time * 1000,
+        "decode_ms_per_token": decode_time * 1000 / max_new_tokens,
+    }
+
+
+def benchmark(
+    model_names: List[str] = ["tiny_LLaMA_120M", "tiny_LLaMA_1b"],
+    batch_size: int = 1,
+    prompt_length: int = 128,
+    max_new_tokens: int = 64,
+    num_runs: int = 3,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Report prefill and decode throughput of `lit_gpt.generate` for randomly initialized models."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    for model_name in model_names:
+        config = Config.from_name(model_name)
+        with torch.device(device):
+            model = GPT(config)
+        model = model.to(dtype=getattr(torch, dtype)).eval()
+        stats = benchmark_model(model, batch_size, prompt_length, max_new_tokens, num_runs, device)
+        print(
+            f"{model_name} ({dtype}, {device}, batch {batch_size}, prompt {prompt_length}, new {max_new_tokens}):"
+            f" prefill {stats['prefill_tokens_per_sec']:.1f} tok/s ({stats['prefill_ms']:.1f}ms),"
+            f" decode {stats['decode_tokens_per_sec']:.1f} tok/s ({stats['decode_ms_per_token']:.2f}ms/token)",
+            flush=True,
+        )
+        del model
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
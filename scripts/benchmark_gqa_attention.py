@@ -0,0 +1,88 @@
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.model import Config, grouped_attention
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def repeated_attention(
+    q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: torch.Tensor, scale: float
+) -> torch.Tensor:
+    """The previous path: repeat every key and value head `q_per_kv` times before SDPA."""
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    k = k.repeat_interleave(q.size(1) // k.size(1), dim=1)
+    v = v.repeat_interleave(q.size(1) // v.size(1), dim=1)
+    y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, scale=scale)
+    return y.transpose(1, 2)
+
+
+def timeit(fn: Callable, *args, iters: int) -> float:
+    device = args[0].device
+    for _ in range(2):
+        fn(*args)
+    _sync(device)
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn(*args)
+    _sync(device)
+    return (time.perf_counter() - t0) / iters
+
+
+@torch.no_grad()
+def benchmark(
+    model_names: List[str] = ["tiny_LLaMA_120M", "tiny_LLaMA_1b"],
+    batch_size: int = 4,
+    cache_length: int = 2048,
+    query_lengths: List[int] = [1, 128],
+    iters: int = 20,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Compare masked attention against a grouped-query KV cache with and without repeating the key and value heads, as
+    in a decode step (1 query) or a chunked prefill: time, bytes of keys and values attended, and max abs difference."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    dtype = getattr(torch, dtype)
+    for name in model_names:
+        config = Config.from_name(name)
+        scale = 1.0 / math.sqrt(config.head_size)
+        kv_shape = (batch_size, cache_length, config.n_query_groups, config.head_size)
+        k = torch.randn(kv_shape, device=device, dtype=dtype)
+        v = torch.randn(kv_shape, device=device, dtype=dtype)
+        kv_bytes = 2 * k.numel() * k.element_size()
+        q_per_kv = config.n_head // config.n_query_groups
+        for T in query_lengths:
+            q = torch.randn(batch_size, T, config.n_head, config.head_size, device=device, dtype=dtype)
+            # the queries are the last `T` cached positions
+            mask = torch.ones(cache_length, cache_length, dtype=torch.bool, device=device).tril()[-T:][None, None]
+            diff = (grouped_attention(q, k, v, mask, scale) - repeated_attention(q, k, v, mask, scale)).abs().max()
+            repeated = timeit(repeated_attention, q, k, v, mask, scale, iters=iters)
+            grouped = timeit(grouped_attention, q, k, v, mask, scale, iters=iters)
+            print(
+                f"{name} ({config.n_head} heads, {config.n_query_groups} groups), {T} queries x {cache_length} cached:"
+                f" keys and values {kv_bytes * q_per_kv / 2**20:.1f} MiB repeated -> {kv_bytes / 2**20:.1f} MiB,"
+                f" {repeated * 1000:.2f}ms -> {grouped * 1000:.2f}ms, max abs diff {diff.item():.2e}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,82 @@
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.generate import decode_one, prefill
+from lit_gpt.model import GPT, Config
+
+
+def cache_bytes(model: GPT) -> int:
+    total = 0
+    for cache in model.kv_caches:
+        tensors = cache if isinstance(cache, tuple) else (cache.k, cache.v, cache.k_scales, cache.v_scales)
+        total += sum(t.numel() * t.element_size() for t in tensors)
+    return total
+
+
+@torch.no_grad()
+def run(model: GPT, idx: torch.Tensor, max_new_tokens: int, storage_dtype: Optional[torch.dtype]) -> tuple:
+    """Teacher-force `idx` after its first half and return the logits of every decoded step and the time per step."""
+    model.kv_cache_storage_dtype = storage_dtype
+    prompt_length = idx.size(1) - max_new_tokens
+    max_seq_length = idx.size(1)
+    logits = [prefill(model, idx[:, :prompt_length], max_seq_length)]
+    input_pos = torch.tensor([prompt_length], device=idx.device)
+    t0 = time.perf_counter()
+    for i in range(prompt_length, idx.size(1) - 1):
+        logits.append(decode_one(model, idx[:, i], input_pos, max_seq_length))
+        input_pos = input_pos + 1
+    elapsed = (time.perf_counter() - t0) / max(max_new_tokens - 1, 1)
+    return torch.stack(logits, dim=1).float(), elapsed, cache_bytes(model)
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    batch_size: int = 1,
+    prompt_length: int = 1024,
+    max_new_tokens: int = 64,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Compare the KV cache in the compute dtype against the int8 KV cache on a randomly initialized model: cache
+    memory, decode time per token, and how far the int8 logits are from the reference ones on the same tokens."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    config = Config.from_name(model_name)
+    with torch.device(device):
+        model = GPT(config)
+    model = model.to(dtype=getattr(torch, dtype)).eval()
+    idx = torch.randint(0, config.vocab_size, (batch_size, prompt_length + max_new_tokens), device=device)
+
+    reference, ref_time, ref_bytes = run(model, idx, max_new_tokens, None)
+    quantized, q_time, q_bytes = run(model, idx, max_new_tokens, torch.int8)
+    model.kv_cache_storage_dtype = None
+
+    max_diff = (reference - quantized).abs().max().item()
+    top1 = (reference.argmax(-1) == quantized.argmax(-1)).float().mean().item()
+    kl = torch.nn.functional.kl_div(
+        quantized.log_softmax(-1), reference.log_softmax(-1), log_target=True, reduction="batchmean"
+    ).item()
+    print(
+        f"{model_name} ({dtype}, {device}, {prompt_length + max_new_tokens} positions):\n"
+        f"  {dtype} cache: {ref_bytes / 2**20:8.1f} MiB, {ref_time * 1000:.2f}ms/token\n"
+        f"  int8 cache: {q_bytes / 2**20:8.1f} MiB, {q_time * 1000:.2f}ms/token\n"
+        f"  logits max abs diff {max_diff:.4f}, top-1 agreement {top1:.2%}, KL {kl:.2e}",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,126 @@
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import kernels
+from lit_gpt.model import Config, build_rope_cache
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def make_inputs(config: Config, batch_size: int, seq_length: int, device: torch.device, dtype: torch.dtype) -> Dict:
+    """The arguments of every op at the shapes of one layer of `config`."""
+
+    def randn(*shape: int, requires_grad: bool = True) -> torch.Tensor:
+        return torch.randn(*shape, device=device, dtype=dtype, requires_grad=requires_grad)
+
+    B, T, hs = batch_size, seq_length, config.head_size
+    n_elem = int(config.rotary_percentage * hs)
+    cos, sin = build_rope_cache(T, n_elem, dtype=dtype, device=device)
+    n_embd, hidden = config.n_embd, config.intermediate_size
+    return {
+        "attention": (
+            randn(B, T, config.n_head, hs),
+            randn(B, T, config.n_query_groups, hs),
+            randn(B, T, config.n_query_groups, hs),
+            1.0 / math.sqrt(hs),
+        ),
+        "rotary": (randn(B, T, config.n_head, hs), cos, sin),
+        "rmsnorm": (randn(B, T, n_embd), randn(n_embd), config.norm_eps),
+        "swiglu": (
+            randn(B, T, n_embd),
+            randn(hidden, n_embd) / math.sqrt(n_embd),
+            None,
+            randn(hidden, n_embd) / math.sqrt(n_embd),
+            None,
+            randn(n_embd, hidden) / math.sqrt(hidden),
+            None,
+        ),
+        "cross_entropy": (
+            randn(B * T, config.padded_vocab_size),
+            torch.randint(0, config.padded_vocab_size, (B * T,), device=device),
+        ),
+    }
+
+
+def run(fn: Callable, args: Tuple, backward: bool) -> torch.Tensor:
+    # the fused rotary embedding writes in place, so every call gets fresh non-leaf inputs
+    args = tuple(
+        a.detach().requires_grad_(a.requires_grad).clone() if isinstance(a, torch.Tensor) else a for a in args
+    )
+    with torch.set_grad_enabled(backward):
+        out = fn(*args)
+    if backward:
+        out.float().sum().backward()
+    return out
+
+
+def timeit(fn: Callable, args: Tuple, backward: bool, iters: int) -> float:
+    device = args[0].device
+    for _ in range(2):
+        run(fn, args, backward)
+    _sync(device)
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        run(fn, args, backward)
+    _sync(device)
+    return (time.perf_counter() - t0) / iters
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_1b",
+    ops: Optional[List[str]] = None,
+    batch_size: int = 2,
+    seq_length: int = 512,
+    iters: int = 10,
+    device: Optional[str] = None,
+    dtype: Optional[str] = None,
+    seed: int = 1234,
+) -> None:
+    """Time the forward and forward+backward of every kernel backend installed on this machine against the PyTorch
+    reference at the shapes of one layer of `model_name`, and report the max abs difference of their outputs.
+
+    `device` defaults to CUDA when present, `dtype` to bfloat16 on CUDA and float32 otherwise.
+    """
+    torch.manual_seed(seed)
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    dtype = getattr(torch, dtype or ("bfloat16" if device.type == "cuda" else "float32"))
+    config = Config.from_name(model_name)
+    inputs = make_inputs(config, batch_size, seq_length, device, dtype)
+    print(f"{model_name}, batch {batch_size} x {seq_length} tokens, {device.type} {dtype}", flush=True)
+    for op in ops or list(kernels.BACKENDS):
+        args = inputs[op]
+        names = kernels.available(op, args[0])
+        unavailable = [name for name in kernels.backend_names(op) if name not in names]
+        reference = run(kernels.load(op, "torch"), args, backward=False).float()
+        for name in names:
+            fn = kernels.load(op, name)
+            diff = (run(fn, args, backward=False).float() - reference).abs().max().item()
+            fwd = timeit(fn, args, False, iters)
+            bwd = timeit(fn, args, True, iters)
+            print(
+                f"  {op:>13} {name:>10}: forward {fwd * 1000:8.3f}ms, forward+backward {bwd * 1000:8.3f}ms,"
+                f" max abs diff {diff:.2e}",
+                flush=True,
+            )
+        if unavailable:
+            print(f"  {op:>13} not available here: {', '.join(unavailable)}", flush=True)
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
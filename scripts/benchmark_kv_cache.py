@@ -0,0 +1,121 @@
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.model import GPT, Config
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Counts the bytes of the tensors the dispatched ops allocate, views and in-place writes excluded."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.allocated = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        tensors = tree_flatten((args, kwargs))[0]
+        inputs = {t.untyped_storage().data_ptr() for t in tensors if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                self.allocated += t.untyped_storage().nbytes()
+        return out
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def run(
+    model: GPT, prompt_length: int, num_steps: int, max_seq_length: int, cache_dtype: torch.dtype, legacy_cast: bool
+) -> Dict[str, float]:
+    """Prefill `prompt_length` positions and decode `num_steps` more through the real attention of the first layer.
+
+    `legacy_cast` replays the cast that the attention used to do on the whole cache before writing to it.
+    """
+    config, device = model.config, model.lm_head.weight.device
+    dtype = model.lm_head.weight.dtype
+    attn = model.transformer.h[0].attn
+    model.rope_cache = model.build_rope_cache(torch.empty(1, device=device, dtype=dtype))
+    model.mask_cache = model.build_mask_cache(torch.empty(1, device=device, dtype=dtype))
+    cos, sin = model.rope_cache
+    idx = torch.empty(1, 1, device=device, dtype=torch.long)
+    cache: Tuple[torch.Tensor, torch.Tensor] = model.build_kv_caches(idx, max_seq_length, cos.size(-1), cache_dtype)[0]
+    # the cache built before the prompt, which the old path replaced with its cast copy in the prefill
+    cache_bytes = sum(c.numel() * c.element_size() for c in cache)
+    allocated: List[int] = []
+    _sync(device)
+    t0 = time.perf_counter()
+    for step in range(num_steps + 1):
+        input_pos = torch.arange(prompt_length) if step == 0 else torch.tensor([prompt_length + step - 1])
+        input_pos = input_pos.to(device)
+        x = torch.randn(1, input_pos.size(0), config.n_embd, device=device, dtype=dtype)
+        rope = (cos.index_select(0, input_pos), sin.index_select(0, input_pos))
+        cache_pos, mask = model.kv_cache_index(input_pos, max_seq_length)
+        with AllocationCounter() as counter:
+            if legacy_cast:
+                cache = cache[0].to(dtype=x.dtype), cache[1].to(dtype=x.dtype)
+            _, cache = attn(x, rope, max_seq_length, mask, cache_pos, cache)
+        allocated.append(counter.allocated)
+        if step == 0:
+            _sync(device)
+            t0 = time.perf_counter()
+    _sync(device)
+    return {
+        "prefill": allocated[0],
+        "decode": sum(allocated[1:]) / num_steps,
+        "first_decode": allocated[1],
+        "cache": cache_bytes,
+        "ms_per_token": (time.perf_counter() - t0) * 1000 / num_steps,
+    }
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_1b",
+    prompt_length: int = 128,
+    max_seq_length: int = 2048,
+    num_steps: int = 32,
+    device: str = "cpu",
+    dtype: str = "bfloat16",
+) -> None:
+    """Measure what the KV cache costs through the attention of one layer, scaled to all the layers: a float32 cache
+    that the attention cast to the compute dtype, as before, against a cache allocated in the compute dtype.
+
+    The bytes are those of the tensors the ops allocate, counted with a `TorchDispatchMode`. The cast cache replaced
+    the float32 one, so the old path copied the whole cache once, in the prefill, and kept the cast copy afterwards.
+    """
+    device = torch.device(device)
+    dtype = getattr(torch, dtype)
+    with device:
+        model = GPT(Config.from_name(model_name, n_layer=1)).to(dtype=dtype).eval()
+    n_layer = Config.from_name(model_name).n_layer
+
+    def mib(n: float) -> str:
+        return f"{n * n_layer / 2**20:9.2f} MiB"
+
+    for name, cache_dtype, legacy_cast in (("float32 cache + cast", torch.float32, True), ("in place", dtype, False)):
+        stats = run(model, prompt_length, num_steps, max_seq_length, cache_dtype, legacy_cast)
+        print(
+            f"{model_name} {name:>20}: {cache_dtype} cache {mib(stats['cache'])},"
+            f" allocated by the prefill {mib(stats['prefill'])}, by the first decode step {mib(stats['first_decode'])},"
+            f" by later steps {mib(stats['decode'])} on average, {stats['ms_per_token']:.3f} ms per token"
+            f" ({n_layer} layers)",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(benchmark)
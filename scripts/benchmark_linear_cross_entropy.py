@@ -0,0 +1,88 @@
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.linear_cross_entropy import linear_cross_entropy
+from lit_gpt.model import Config
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run(hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor, chunk_size: int) -> tuple:
+    """Loss, gradients, time and peak memory (CUDA only) of one forward and backward."""
+    hidden = hidden.detach().requires_grad_()
+    weight = weight.detach().requires_grad_()
+    device = hidden.device
+    _sync(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    start_memory = torch.cuda.memory_allocated() if device.type == "cuda" else 0
+    t0 = time.perf_counter()
+    loss = linear_cross_entropy(hidden, weight, targets, chunk_size=chunk_size)
+    loss.backward()
+    _sync(device)
+    elapsed = time.perf_counter() - t0
+    peak = torch.cuda.max_memory_allocated() - start_memory if device.type == "cuda" else None
+    return loss.detach(), hidden.grad, weight.grad, elapsed, peak
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_1b",
+    micro_batch_size: int = 4,
+    block_size: int = 2048,
+    chunk_sizes: List[int] = [4096, 1024, 256],
+    ignore_fraction: float = 0.1,
+    device: Optional[str] = None,
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Check the chunked `linear_cross_entropy` against the reference that materializes the logits (`chunk_size=0`):
+    loss, gradients of the hidden states and of the `lm_head` weight, time and, on CUDA, peak memory of the loss.
+
+    A random `ignore_fraction` of the targets is set to the ignored index.
+    """
+    torch.manual_seed(seed)
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    dtype = getattr(torch, dtype)
+    config = Config.from_name(model_name)
+    hidden = torch.randn(micro_batch_size, block_size, config.n_embd, device=device, dtype=dtype)
+    weight = torch.randn(config.padded_vocab_size, config.n_embd, device=device, dtype=dtype) * config.n_embd**-0.5
+    targets = torch.randint(0, config.vocab_size, (micro_batch_size, block_size), device=device)
+    targets[torch.rand(targets.shape, device=device) < ignore_fraction] = -1
+
+    def memory(peak: Optional[int]) -> str:
+        return f", peak {peak / 2**20:.0f} MiB" if peak is not None else ""
+
+    ref_loss, ref_hidden_grad, ref_weight_grad, ref_time, ref_peak = run(hidden, weight, targets, 0)
+    print(
+        f"{model_name} logits of {micro_batch_size}x{block_size} tokens ({device.type} {dtype}):\n"
+        f"  reference: loss {ref_loss.item():.5f}, {ref_time * 1000:.1f}ms{memory(ref_peak)}",
+        flush=True,
+    )
+    for chunk_size in chunk_sizes:
+        loss, hidden_grad, weight_grad, elapsed, peak = run(hidden, weight, targets, chunk_size)
+        print(
+            f"  chunk {chunk_size:>5}: loss diff {(loss - ref_loss).abs().item():.2e},"
+            f" hidden grad diff {(hidden_grad - ref_hidden_grad).abs().max().item():.2e},"
+            f" weight grad diff {(weight_grad - ref_weight_grad).abs().max().item():.2e},"
+            f" {elapsed * 1000:.1f}ms{memory(peak)}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,140 @@
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+import torch.nn.functional as F
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.lora import LoRAQKVLinear
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def reference_zero_pad(layer: LoRAQKVLinear, x: torch.Tensor) -> torch.Tensor:
+    """The previous `LoRAQKVLinear.zero_pad`: scatter the enabled q, k, v columns into a zero tensor."""
+    if all(layer.enable_lora):
+        return x
+    lora_ind = [i for start, end in layer.lora_slices for i in range(start, end)]
+    x = x.transpose(0, 1)
+    result = x.new_zeros((*x.shape[:-1], layer.linear.out_features))
+    result = result.view(-1, layer.linear.out_features)
+    result = result.index_copy(1, torch.tensor(lora_ind, device=result.device), x.reshape(-1, sum(layer.qkv_shapes)))
+    return result.view((*x.shape[:-1], layer.linear.out_features)).transpose(0, 1)
+
+
+def reference_conv1d(layer: LoRAQKVLinear, input: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+    """The previous `LoRAQKVLinear.conv1d`: a grouped convolution, split by hand when the q, k, v parts differ in size."""
+    if layer.n_head == layer.n_query_groups:
+        return F.conv1d(input, weight, groups=sum(layer.enable_lora))
+    input_splitted = input.chunk(sum(layer.enable_lora), dim=1)
+    weight_splitted = weight.split(layer.qkv_shapes)
+    return torch.cat([F.conv1d(a, b) for a, b in zip(input_splitted, weight_splitted)], dim=1)
+
+
+def reference_forward(layer: LoRAQKVLinear, x: torch.Tensor) -> torch.Tensor:
+    pretrained = layer.linear(x)
+    after_A = F.linear(layer.lora_dropout(x), layer.lora_A)
+    after_B = reference_conv1d(layer, after_A.transpose(-2, -1), layer.lora_B.unsqueeze(-1)).transpose(-2, -1)
+    return pretrained + reference_zero_pad(layer, after_B) * layer.scaling
+
+
+def reference_delta_w(layer: LoRAQKVLinear) -> torch.Tensor:
+    delta_w = reference_conv1d(layer, layer.lora_A.data.unsqueeze(0), layer.lora_B.data.unsqueeze(-1)).squeeze(0)
+    return reference_zero_pad(layer, delta_w * layer.scaling)
+
+
+def make_layer(n_embd: int, n_head: int, n_query_groups: int, r: int, enable_lora: List[bool]) -> LoRAQKVLinear:
+    head_size = n_embd // n_head
+    layer = LoRAQKVLinear(
+        n_embd,
+        (n_head + 2 * n_query_groups) * head_size,
+        n_head=n_head,
+        n_query_groups=n_query_groups,
+        r=r,
+        lora_alpha=16,
+        enable_lora=enable_lora,
+    )
+    # `lora_B` starts at zero, which would hide any difference in the LoRA branch
+    torch.nn.init.normal_(layer.lora_B, std=0.02)
+    return layer
+
+
+def check(layer: LoRAQKVLinear, x: torch.Tensor) -> Tuple[float, float, float]:
+    """The max abs difference of the outputs, the LoRA gradients and `delta_w` against the previous implementation."""
+    grads = []
+    for fn in (reference_forward, LoRAQKVLinear.forward):
+        layer.zero_grad()
+        y = fn(layer, x)
+        y.backward(torch.ones_like(y))
+        grads.append((y.detach(), layer.lora_A.grad.clone(), layer.lora_B.grad.clone()))
+    (y_ref, a_ref, b_ref), (y, a, b) = grads
+    out_diff = (y - y_ref).abs().max().item()
+    grad_diff = max((a - a_ref).abs().max().item(), (b - b_ref).abs().max().item())
+    delta_diff = (layer.delta_w() - reference_delta_w(layer)).abs().max().item()
+    return out_diff, grad_diff, delta_diff
+
+
+def timeit(fn, layer: LoRAQKVLinear, x: torch.Tensor, backward: bool, iters: int) -> float:
+    device = x.device
+    for i in range(iters + 2):
+        if i == 2:
+            _sync(device)
+            t0 = time.perf_counter()
+        y = fn(layer, x)
+        if backward:
+            y.backward(torch.ones_like(y))
+    _sync(device)
+    return (time.perf_counter() - t0) / iters
+
+
+def benchmark(
+    n_embd: int = 768,
+    n_head: int = 12,
+    n_query_groups: List[int] = [12, 4],
+    r: int = 8,
+    batch_size: int = 8,
+    seq_length: int = 512,
+    iters: int = 20,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Check the slice-and-add `LoRAQKVLinear` against the previous `conv1d` and `zero_pad` implementation and time the
+    forward and forward+backward passes of both, for multi-head and grouped-query layouts and several `enable_lora`."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    dtype = getattr(torch, dtype)
+    for groups in n_query_groups:
+        for enable_lora in ([True, True, True], [True, False, True], [False, True, False]):
+            layer = make_layer(n_embd, n_head, groups, r, enable_lora).to(device=device, dtype=dtype)
+            x = torch.randn(batch_size, seq_length, n_embd, device=device, dtype=dtype, requires_grad=True)
+            out_diff, grad_diff, delta_diff = check(layer, x)
+            times = {}
+            for name, fn in (("before", reference_forward), ("after", LoRAQKVLinear.forward)):
+                with torch.no_grad():
+                    fwd = timeit(fn, layer, x, False, iters)
+                bwd = timeit(fn, layer, x, True, iters)
+                times[name] = (fwd, bwd)
+            print(
+                f"n_query_groups={groups:<3} enable_lora={enable_lora}: max abs diff output {out_diff:.2e},"
+                f" grads {grad_diff:.2e}, delta_w {delta_diff:.2e}\n"
+                f"  forward {times['before'][0] * 1000:.2f}ms -> {times['after'][0] * 1000:.2f}ms,"
+                f" forward+backward {times['before'][1] * 1000:.2f}ms -> {times['after'][1] * 1000:.2f}ms",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,84 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.lora import GPT, AdapterSwitcher, Config, LoRALinear, lora_filter, merge_lora_weights
+
+
+def random_adapter(model: GPT) -> dict:
+    adapter = {}
+    for name, param in model.named_parameters():
+        if lora_filter(name, param):
+            adapter[name] = torch.randn_like(param) * 0.01
+    return adapter
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    r: int = 8,
+    num_adapters: int = 4,
+    cache_size: int = 2,
+    num_switches: int = 8,
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Time switching between LoRA adapters with `AdapterSwitcher` against reloading the base weights from disk and
+    merging the next adapter."""
+    torch.manual_seed(seed)
+    config = Config.from_name(
+        model_name, r=r, alpha=16, to_query=True, to_value=True, to_projection=True, to_mlp=True
+    )
+    model = GPT(config).to(dtype=getattr(torch, dtype)).eval()
+    base = {k: v.clone() for k, v in model.state_dict().items()}
+    adapters = {f"adapter_{i}": random_adapter(model) for i in range(num_adapters)}
+    names = [f"adapter_{i % num_adapters}" for i in range(num_switches)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = Path(tmp_dir) / "lit_model.pth"
+        torch.save(base, checkpoint_path)
+        t0 = time.perf_counter()
+        for name in names:
+            model.load_state_dict(torch.load(checkpoint_path), strict=False)
+            for module in model.modules():
+                if isinstance(module, LoRALinear):
+                    module.merged = False
+            model.load_state_dict(adapters[name], strict=False)
+            merge_lora_weights(model)
+        reload_time = (time.perf_counter() - t0) / num_switches
+    model.load_state_dict(base)
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.merged = False
+
+    switcher = AdapterSwitcher(model, adapters, cache_size=cache_size)
+    switch_times = {True: [], False: []}
+    for name in names + names:
+        hit = name in switcher.cache
+        t0 = time.perf_counter()
+        switcher.activate(name)
+        switch_times[hit].append(time.perf_counter() - t0)
+    switcher.activate(None)
+    drift = max((model.state_dict()[k] - v).abs().max().item() for k, v in base.items() if not lora_filter(k, v))
+
+    def ms(times: list) -> str:
+        return f"{sum(times) / len(times) * 1000:.2f}ms" if times else "n/a"
+
+    print(
+        f"{model_name} r={r} ({dtype}): full reload {reload_time * 1000:.2f}ms per switch,"
+        f" switch {ms(switch_times[True])} with cached deltas, {ms(switch_times[False])} otherwise"
+        f" (cache of {cache_size} for {num_adapters} adapters). max weight drift after unmerging: {drift:.2e}",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,79 @@
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.model import GPT, Config
+from lit_gpt.optimizer import IMPLEMENTATIONS, create_optimizer, param_groups, state_bytes
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def benchmark(
+    model_names: List[str] = ["tiny_LLaMA_120M", "tiny_LLaMA_1b"],
+    implementations: Optional[List[str]] = None,
+    iters: int = 10,
+    device: Optional[str] = None,
+    seed: int = 1234,
+) -> None:
+    """Time `optimizer.step()` and measure the optimizer state memory of every AdamW implementation of
+    `lit_gpt.optimizer` on randomly initialized float32 models with random gradients.
+
+    `implementations` defaults to all of them except "auto". The ones that cannot run here (e.g. "fused" on CPU before
+    torch 2.4, "8bit" without bitsandbytes) are reported and skipped.
+    """
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    implementations = implementations or [name for name in IMPLEMENTATIONS if name != "auto"]
+    for model_name in model_names:
+        torch.manual_seed(seed)
+        config = Config.from_name(model_name)
+        with device:
+            model = GPT(config)
+        for p in model.parameters():
+            p.grad = torch.randn_like(p) * 1e-3
+        n_params = sum(p.numel() for p in model.parameters())
+        decay, *no_decay = param_groups(model, 0.1)
+        n_no_decay = sum(p.numel() for group in no_decay for p in group["params"])
+        print(
+            f"{model_name}: {n_params / 1e6:.1f}M parameters in {len(decay['params'])} decayed tensors,"
+            f" {n_no_decay / 1e6:.2f}M in {sum(len(g['params']) for g in no_decay)} tensors without decay,"
+            f" {device.type}",
+            flush=True,
+        )
+        for implementation in implementations:
+            try:
+                optimizer = create_optimizer(model, implementation, lr=1e-4, weight_decay=0.1, betas=(0.9, 0.95))
+                # the first step allocates the state
+                optimizer.step()
+            except (ImportError, RuntimeError, ValueError) as e:
+                print(f"  {implementation:>8}: not available, {str(e).splitlines()[0]}", flush=True)
+                continue
+            _sync(device)
+            t0 = time.perf_counter()
+            for _ in range(iters):
+                optimizer.step()
+            _sync(device)
+            elapsed = (time.perf_counter() - t0) / iters
+            memory = state_bytes(optimizer)
+            print(
+                f"  {implementation:>8}: step {elapsed * 1000:8.2f}ms, state {memory / 2**20:9.1f} MiB"
+                f" ({memory / n_params:.2f} bytes per parameter)",
+                flush=True,
+            )
+            del optimizer
+        del model
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(benchmark)
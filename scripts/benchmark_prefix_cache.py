@@ -0,0 +1,65 @@
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.generate import prefill
+from lit_gpt.model import GPT, Config
+from lit_gpt.prefix_cache import PrefixCache
+
+
+@torch.no_grad()
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    preamble_length: int = 256,
+    num_templates: int = 4,
+    text_length: int = 32,
+    num_requests: int = 64,
+    cache_memory_gb: float = 1.0,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Prefill translation-style prompts (a shared few-shot preamble, one of a few `"{lang}: "` templates, then the
+    text) with and without a `PrefixCache`, and report the prefill time and cache metrics."""
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    config = Config.from_name(model_name)
+    with torch.device(device):
+        model = GPT(config)
+    model = model.to(dtype=getattr(torch, dtype)).eval()
+
+    preamble = torch.randint(0, config.vocab_size, (preamble_length,), device=device)
+    templates = [torch.randint(0, config.vocab_size, (4,), device=device) for _ in range(num_templates)]
+    prompts = [
+        torch.cat(
+            (preamble, templates[i % num_templates], torch.randint(0, config.vocab_size, (text_length,), device=device))
+        )
+        for i in range(num_requests)
+    ]
+    max_seq_length = max(p.size(0) for p in prompts) + 1
+
+    for prefix_cache in (None, PrefixCache(int(cache_memory_gb * 2**30))):
+        t0 = time.perf_counter()
+        for prompt in prompts:
+            prefill(model, prompt.unsqueeze(0), max_seq_length, prefix_cache=prefix_cache)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - t0
+        name = "no prefix cache" if prefix_cache is None else "prefix cache"
+        print(f"{model_name} {name:>15}: {elapsed * 1000 / num_requests:.2f}ms per prefill", flush=True)
+        if prefix_cache is not None:
+            print(f"  {prefix_cache.metrics()}", flush=True)
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,112 @@
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import Tokenizer
+from lit_gpt.generate import generate
+from lit_gpt.model import GPT, Config
+from lit_gpt.speculative import speculative_generate
+from lit_gpt.utils import check_valid_checkpoint_dir, lazy_load
+
+
+def load_model(checkpoint_dir: Optional[Path], model_name: str, device: torch.device, dtype: torch.dtype) -> GPT:
+    if checkpoint_dir is not None:
+        check_valid_checkpoint_dir(checkpoint_dir)
+        with open(checkpoint_dir / "lit_config.json") as fp:
+            config = Config(**json.load(fp))
+    else:
+        config = Config.from_name(model_name)
+    with torch.device(device):
+        model = GPT(config)
+    if checkpoint_dir is not None:
+        with lazy_load(checkpoint_dir / "lit_model.pth") as checkpoint:
+            model.load_state_dict(checkpoint.get("model", checkpoint), strict=True)
+    return model.to(dtype=dtype).eval()
+
+
+def benchmark(
+    target_checkpoint_dir: Optional[Path] = None,
+    draft_checkpoint_dir: Optional[Path] = None,
+    target_model_name: str = "tiny_LLaMA_1b",
+    draft_model_name: str = "tiny_LLaMA_120M",
+    prompt: str = "def quick_sort(arr):",
+    prompt_length: int = 32,
+    max_new_tokens: int = 128,
+    num_draft_tokens: int = 4,
+    temperature: float = 0.0,
+    num_runs: int = 3,
+    device: str = "cpu",
+    dtype: str = "float32",
+    seed: int = 1234,
+) -> None:
+    """Compare plain decoding of the target model against speculative decoding with a draft model.
+
+    Reports the acceptance rate of the drafted tokens and the end-to-end speedup. With checkpoints, `prompt` is
+    tokenized with the target's tokenizer. Without them both models are randomly initialized and `prompt_length` random
+    token ids are used: the acceptance rate is then meaningless, but the cost of drafting and verifying is measured.
+    """
+    torch.manual_seed(seed)
+    device = torch.device(device)
+    dtype = getattr(torch, dtype)
+    target = load_model(target_checkpoint_dir, target_model_name, device, dtype)
+    draft = load_model(draft_checkpoint_dir, draft_model_name, device, dtype)
+    if target_checkpoint_dir is not None:
+        tokenizer = Tokenizer(target_checkpoint_dir)
+        idx = tokenizer.encode(prompt, device=device, bos=True, eos=False)
+        stop_tokens = (tokenizer.eos_id,)
+    else:
+        idx = torch.randint(0, target.config.vocab_size, (prompt_length,), device=device)
+        stop_tokens = ()
+
+    baseline_times, speculative_times = [], []
+    # the first run is a warm-up and is not reported
+    for run in range(num_runs + 1):
+        t0 = time.perf_counter()
+        baseline = generate(target, [idx], max_new_tokens, temperature=temperature, stop_tokens=stop_tokens)[0]
+        t1 = time.perf_counter()
+        output, stats = speculative_generate(
+            target,
+            draft,
+            idx,
+            max_new_tokens,
+            num_draft_tokens=num_draft_tokens,
+            temperature=temperature,
+            stop_tokens=stop_tokens,
+        )
+        t2 = time.perf_counter()
+        if run > 0:
+            baseline_times.append((t1 - t0) / max(baseline.size(0), 1))
+            speculative_times.append((t2 - t1) / max(output.size(0), 1))
+            print(
+                f"run {run}: acceptance rate {stats.acceptance_rate:.1%},"
+                f" {stats.tokens_per_target_forward:.2f} tokens per target forward,"
+                f" {output.size(0)} tokens",
+                flush=True,
+            )
+            if temperature == 0.0 and not torch.equal(baseline.cpu(), output.cpu()):
+                print("  greedy outputs differ (numerical differences between batched and single-token forwards)")
+
+    baseline_time = sum(baseline_times) / num_runs
+    speculative_time = sum(speculative_times) / num_runs
+    print(
+        f"{target.config.name} drafted by {draft.config.name} (k={num_draft_tokens}, {dtype}, {device}):"
+        f" baseline {baseline_time * 1000:.2f}ms/token, speculative {speculative_time * 1000:.2f}ms/token,"
+        f" speedup {baseline_time / speculative_time:.2f}x",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
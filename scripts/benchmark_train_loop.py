@@ -0,0 +1,107 @@
+import io
+import sys
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.model import GPT, Config
+from lit_gpt.speed_monitor import SpeedMonitorBase
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run(
+    model: GPT,
+    optimizer: torch.optim.Optimizer,
+    data: torch.Tensor,
+    iters: int,
+    gradient_accumulation_steps: int,
+    log_iter_interval: int,
+    host_loss: bool,
+) -> float:
+    """Seconds per iteration of the body of `pretrain/tinyllama.py`'s training loop. With `host_loss`, the loss is
+    copied to the host twice and the progress line formatted on every iteration, as it used to be."""
+    monitor = SpeedMonitorBase(None, lambda metrics, step: None, window_size=2, log_iter_interval=log_iter_interval)
+    device = data.device
+    block_size = data.size(1) - 1
+    total_lengths = 0
+    sink = io.StringIO()
+    _sync(device)
+    t0 = time.perf_counter()
+    for iter_num in range(iters):
+        input_ids, targets = data[:, :block_size], data[:, 1:]
+        is_accumulating = (iter_num + 1) % gradient_accumulation_steps != 0
+        loss = model(input_ids, targets=targets)
+        (loss / gradient_accumulation_steps).backward()
+        if not is_accumulating:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad()
+        total_lengths += block_size
+        t1 = time.perf_counter()
+        with redirect_stdout(sink):
+            if host_loss:
+                print(f"iter {iter_num + 1}: loss {loss.item():.4f}, iter time: {(t1 - t0) * 1000:.2f}ms")
+                train_loss = loss.item()
+            else:
+                train_loss = loss.detach()
+            metrics = monitor.on_train_batch_end(
+                (iter_num + 1) * data.size(0), t1 - t0, 1, iter_num, lengths=total_lengths, train_loss=train_loss
+            )
+            if not host_loss and metrics is not None:
+                print(f"iter {iter_num + 1}: loss {metrics.get('metric/train_loss', float('nan')):.4f}")
+    _sync(device)
+    return (time.perf_counter() - t0) / iters
+
+
+def benchmark(
+    model_name: str = "tiny_LLaMA_120M",
+    n_layer: int = 2,
+    micro_batch_size: int = 2,
+    block_size: int = 256,
+    iters: int = 100,
+    gradient_accumulation_steps: int = 4,
+    log_step_interval: int = 10,
+    device: Optional[str] = None,
+    seed: int = 1234,
+) -> None:
+    """Compare the step time of the training loop that syncs with the device on every iteration (`loss.item()` for
+    the print and for the monitor) to the one that keeps the loss on the device and syncs every `log_iter_interval`
+    iterations, on a small randomly initialized model. The gap is widest on GPUs, where the host can run ahead."""
+    torch.manual_seed(seed)
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    config = Config.from_name(model_name, n_layer=n_layer, block_size=block_size)
+    with device:
+        model = GPT(config)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    data = torch.randint(0, config.vocab_size, (micro_batch_size, block_size + 1), device=device)
+    log_iter_interval = log_step_interval * gradient_accumulation_steps
+    args = (model, optimizer, data, iters, gradient_accumulation_steps, log_iter_interval)
+    # warm up
+    run(*args[:3], 2 * gradient_accumulation_steps, *args[4:], host_loss=False)
+    synced = run(*args, host_loss=True)
+    deferred = run(*args, host_loss=False)
+    print(
+        f"{model_name} with {n_layer} layers, micro batch {micro_batch_size} x {block_size} tokens on {device.type}:"
+        f" {synced * 1000:.2f}ms per iteration syncing every iteration ({2 * iters} host syncs),"
+        f" {deferred * 1000:.2f}ms syncing every {log_iter_interval} ({-(-iters // log_iter_interval)} host syncs)",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(benchmark)
@@ -0,0 +1,102 @@
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.activation_checkpointing import CheckpointPolicy, best_policy, candidate_policies
+from lit_gpt.model import GPT, Config
+
+
+def measure(config: Config, policy: CheckpointPolicy, micro_batch_size: int, block_size: int, iters: int) -> tuple:
+    """Peak memory and time of a forward and backward of a randomly initialized model on CUDA with `policy`."""
+    torch.cuda.empty_cache()
+    with torch.device("cuda"):
+        model = GPT(config)
+    policy.apply(model)
+    x = torch.randint(0, config.vocab_size, (micro_batch_size, block_size + 1), device="cuda")
+    input_ids, targets = x[:, :-1], x[:, 1:]
+    elapsed = 0.0
+    for i in range(iters + 1):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        t0 = time.perf_counter()
+        with torch.autocast("cuda", dtype=torch.bfloat16):
+            loss = model(input_ids, targets=targets)
+        loss.backward()
+        torch.cuda.synchronize()
+        # the first iteration warms up
+        elapsed += (time.perf_counter() - t0) if i else 0.0
+        model.zero_grad(set_to_none=True)
+    return torch.cuda.max_memory_allocated(), elapsed / iters
+
+
+def estimate(
+    model_name: str = "tiny_LLaMA_1b",
+    micro_batch_size: int = 16,
+    block_size: Optional[int] = None,
+    devices: int = 8,
+    memory_budget_gb: Optional[float] = None,
+    policies: Optional[List[str]] = None,
+    bytes_per_element: int = 2,
+    loss_chunk_size: int = 1024,
+    measure_iters: int = 0,
+) -> None:
+    """Predict the memory per device and the relative throughput of activation checkpointing policies for training
+    `model_name` with FSDP over `devices` devices, and the fastest one that fits.
+
+    Args:
+        memory_budget_gb: per device, 90% of the first GPU's memory by default.
+        policies: e.g. ["none", "mlp", "block:2"], all the combinations of `candidate_policies` by default.
+        measure_iters: if > 0, also run that many forward and backward passes of the model on one GPU (no FSDP, so the
+            parameter memory is not sharded) with every policy and report the measured peak memory and time.
+    """
+    config = Config.from_name(model_name)
+    block_size = block_size or config.block_size
+    if memory_budget_gb is None:
+        if not torch.cuda.is_available():
+            raise ValueError("Pass `memory_budget_gb` when there is no GPU to read it from")
+        memory_budget_gb = 0.9 * torch.cuda.get_device_properties(0).total_memory / 1e9
+    candidates = [CheckpointPolicy.from_string(p) for p in policies] if policies else candidate_policies()
+    best, estimates = best_policy(
+        config,
+        micro_batch_size,
+        memory_budget_gb * 1e9,
+        candidates=candidates,
+        block_size=block_size,
+        n_devices=devices,
+        bytes_per_element=bytes_per_element,
+        loss_chunk_size=loss_chunk_size,
+    )
+    print(
+        f"{model_name}, micro batch {micro_batch_size} x {block_size} tokens, {devices} devices,"
+        f" budget {memory_budget_gb:.1f} GB per device",
+        flush=True,
+    )
+    for e in estimates:
+        line = (
+            f"  {str(e.policy):>16}: activations {e.activation_memory / 1e9:6.2f} GB,"
+            f" total {e.total_memory / 1e9:6.2f} GB, relative throughput {e.relative_throughput:.3f}"
+            f"{'' if e.fits else ', does not fit'}"
+        )
+        if measure_iters:
+            peak, elapsed = measure(config, e.policy, micro_batch_size, block_size, measure_iters)
+            line += f" | measured on 1 GPU: peak {peak / 1e9:6.2f} GB, {elapsed * 1000:.1f}ms"
+        print(line, flush=True)
+    if best is None:
+        print("No policy is predicted to fit, lower `micro_batch_size`", flush=True)
+    else:
+        print(f"Best: --activation_checkpointing {best.policy}", flush=True)
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(estimate)
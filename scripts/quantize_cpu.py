@@ -0,0 +1,151 @@
+import glob
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from torch.utils.data import DataLoader
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt.generate import decode_one, prefill, sample
+from lit_gpt.model import GPT, Config
+from lit_gpt.packed_dataset import PackedDataset
+from lit_gpt.utils import check_valid_checkpoint_dir, chunked_cross_entropy, lazy_load, quantization
+
+
+def load_model(checkpoint_dir: Path, mode: Optional[str], dtype: torch.dtype) -> GPT:
+    """Load a float lit checkpoint, quantizing its linear layers according to `mode` (`None` keeps them in float)."""
+    with open(checkpoint_dir / "lit_config.json") as fp:
+        config = Config(**json.load(fp))
+    with quantization(mode):
+        model = GPT(config)
+    with lazy_load(checkpoint_dir / "lit_model.pth") as checkpoint:
+        model.load_state_dict(checkpoint.get("model", checkpoint), strict=True)
+    return model.to(dtype=dtype).eval()
+
+
+def model_bytes(model: GPT) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def quantize(checkpoint_dir: Path, out_dir: Path, mode: str = "cpu.int8", dtype: str = "float32") -> None:
+    """Quantize a lit checkpoint and save it with its config and tokenizer.
+
+    The saved checkpoint loads into a model created under `lit_gpt.utils.quantization(mode)` with the same `mode`.
+    """
+    check_valid_checkpoint_dir(checkpoint_dir)
+    model = load_model(checkpoint_dir, mode, getattr(torch, dtype))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    torch.save(model.state_dict(), out_dir / "lit_model.pth")
+    for name in ("lit_config.json", "tokenizer.model", "tokenizer.json", "tokenizer_config.json"):
+        if (checkpoint_dir / name).is_file():
+            shutil.copy(checkpoint_dir / name, out_dir / name)
+    with open(out_dir / "quantization.json", "w") as fp:
+        json.dump({"mode": mode}, fp)
+    print(f"Saved {mode} checkpoint ({model_bytes(model) / 2**20:.1f} MiB) to {out_dir}", flush=True)
+
+
+@torch.no_grad()
+def perplexity(model: GPT, val_dataloader: DataLoader, eval_iters: int) -> float:
+    losses = []
+    for k, val_data in enumerate(val_dataloader):
+        if k >= eval_iters:
+            break
+        input_ids = val_data[:, 0 : model.config.block_size].contiguous()
+        targets = val_data[:, 1 : model.config.block_size + 1].contiguous()
+        logits = model(input_ids)
+        losses.append(chunked_cross_entropy(logits, targets, chunk_size=0).item())
+    return float(torch.tensor(losses).mean().exp())
+
+
+class LargestAllocation(TorchDispatchMode):
+    """Records the size of the largest tensor the dispatched ops allocate."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.largest = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor):
+                self.largest = max(self.largest, t.untyped_storage().nbytes())
+        return out
+
+
+@torch.no_grad()
+def largest_decode_allocation(model: GPT, prompt_length: int) -> int:
+    """Bytes of the largest temporary of a decode step, a float copy of a whole weight shows up here."""
+    idx = torch.randint(0, model.config.vocab_size, (1, prompt_length))
+    logits = prefill(model, idx, prompt_length + 1)
+    with LargestAllocation() as mode:
+        decode_one(model, sample(logits, temperature=0.0), torch.tensor([prompt_length]), prompt_length + 1)
+    return mode.largest
+
+
+@torch.no_grad()
+def decode_latency(model: GPT, prompt_length: int, max_new_tokens: int) -> float:
+    """Seconds per decoded token for a random prompt."""
+    idx = torch.randint(0, model.config.vocab_size, (1, prompt_length))
+    max_seq_length = prompt_length + max_new_tokens
+    logits = prefill(model, idx, max_seq_length)
+    input_pos = torch.tensor([prompt_length])
+    t0 = time.perf_counter()
+    for _ in range(max_new_tokens):
+        token = sample(logits, temperature=0.0)
+        logits = decode_one(model, token, input_pos, max_seq_length)
+        input_pos = input_pos + 1
+    return (time.perf_counter() - t0) / max_new_tokens
+
+
+def compare(
+    checkpoint_dir: Path,
+    val_data_dir: Path,
+    modes: List[str] = ["cpu.int8", "cpu.int4"],
+    eval_iters: int = 20,
+    batch_size: int = 1,
+    prompt_length: int = 128,
+    max_new_tokens: int = 32,
+    dtype: str = "float32",
+) -> None:
+    """Compare the size, validation perplexity and CPU decode latency of a float checkpoint and its quantized versions.
+
+    The perplexity is measured on the `validation*` packed dataset files in `val_data_dir`.
+    """
+    check_valid_checkpoint_dir(checkpoint_dir)
+    with open(checkpoint_dir / "lit_config.json") as fp:
+        block_size = Config(**json.load(fp)).block_size
+    filenames = sorted(glob.glob(str(val_data_dir / "validation*")))
+    if not filenames:
+        raise FileNotFoundError(f"No validation*.bin files found in {val_data_dir}")
+
+    for mode in [None] + modes:
+        torch.manual_seed(0)
+        model = load_model(checkpoint_dir, mode, getattr(torch, dtype))
+        dataset = PackedDataset(filenames, n_chunks=1, block_size=block_size + 1, shuffle=False)
+        ppl = perplexity(model, DataLoader(dataset, batch_size=batch_size), eval_iters)
+        latency = decode_latency(model, prompt_length, max_new_tokens)
+        largest = largest_decode_allocation(model, prompt_length)
+        print(
+            f"{mode or dtype:>10}: {model_bytes(model) / 2**20:9.1f} MiB, perplexity {ppl:.3f},"
+            f" {latency * 1000:.1f}ms/token, largest decode temporary {largest / 2**20:.1f} MiB",
+            flush=True,
+        )
+        del model
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI([quantize, compare])
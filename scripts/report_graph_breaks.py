@@ -0,0 +1,105 @@
+import sys
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import kernels
+from lit_gpt.generate import decode_one, prefill
+from lit_gpt.model import GPT, Config
+
+
+def user_frame(stack: List) -> str:
+    """The innermost frame of the reason's stack that is in this repository."""
+    for frame in reversed(stack or []):
+        if str(wd) in frame.filename:
+            return f"{Path(frame.filename).relative_to(wd)}:{frame.lineno} in {frame.name}"
+    return "outside the repository"
+
+
+def explain(name: str, fn: Callable, *args, **kwargs) -> int:
+    """Trace `fn(*args, **kwargs)` with dynamo and print its graphs and every graph break."""
+    torch._dynamo.reset()
+    out = torch._dynamo.explain(fn)(*args, **kwargs)
+    print(f"{name}: {out.graph_count} graph(s), {out.graph_break_count} graph break(s)", flush=True)
+    for reason in out.break_reasons:
+        print(f"  - {reason.reason.splitlines()[0]}\n    at {user_frame(reason.user_stack)}", flush=True)
+    return out.graph_break_count
+
+
+def report(
+    model_name: str = "tiny_LLaMA_120M",
+    n_layer: int = 2,
+    batch_size: int = 2,
+    seq_length: int = 64,
+    device: Optional[str] = None,
+    dtype: Optional[str] = None,
+    references: bool = True,
+    kernel_backends: Optional[Dict[str, str]] = None,
+) -> None:
+    """List the graph breaks `torch.compile` hits in `CausalSelfAttention.forward` and `Block.forward` (with and without
+    a KV cache), in the training loss and in a decode step of `model_name`.
+
+    Args:
+        references: use the PyTorch reference of every op while compiling (the default of `lit_gpt.kernels`). False
+            keeps the eager backend choice, to see where the fused kernels break the graph.
+        kernel_backends: `{op: backend}` to force, e.g. {"rmsnorm": "fused", "swiglu": "xformers"}.
+    """
+    torch.manual_seed(1234)
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    dtype = getattr(torch, dtype or ("bfloat16" if device.type == "cuda" else "float32"))
+    kernels.compile_with_references = references
+    kernels.configure(kernel_backends)
+    config = Config.from_name(model_name, n_layer=n_layer)
+    with device:
+        model = GPT(config).to(dtype)
+    block = model.transformer.h[0]
+    idx = torch.randint(0, config.vocab_size, (batch_size, seq_length + 1), device=device)
+    x = torch.randn(batch_size, seq_length, config.n_embd, device=device, dtype=dtype)
+    model.rope_cache = model.build_rope_cache(idx)
+    cos, sin = model.rope_cache
+    rope = (cos[:seq_length], sin[:seq_length])
+    print(
+        f"{model_name} ({n_layer} layers), {batch_size} x {seq_length} tokens, {device.type} {dtype},"
+        f" {'PyTorch references' if references else 'eager kernel backends'} while compiling",
+        flush=True,
+    )
+
+    breaks = explain("CausalSelfAttention.forward", block.attn, block.norm_1(x), rope, seq_length)
+    breaks += explain("Block.forward", block, x, rope, seq_length)
+    breaks += explain("GPT.forward with targets", model, idx[:, :-1], targets=idx[:, 1:])
+
+    # one decode step after a prefill, as in `lit_gpt.generate`
+    max_seq_length = seq_length + 8
+    with torch.no_grad():
+        prefill(model, idx[:, :seq_length], max_seq_length)
+        input_pos = torch.tensor([seq_length], device=device)
+        cache_pos, mask = model.kv_cache_index(input_pos, max_seq_length)
+        step_rope = (cos.index_select(0, input_pos), sin.index_select(0, input_pos))
+        step_x = torch.randn(batch_size, 1, config.n_embd, device=device, dtype=dtype)
+        kv_cache = model.kv_caches[0]
+        breaks += explain(
+            "CausalSelfAttention.forward with a KV cache",
+            block.attn,
+            block.norm_1(step_x),
+            step_rope,
+            max_seq_length,
+            mask,
+            cache_pos,
+            kv_cache,
+        )
+        breaks += explain(
+            "Block.forward with a KV cache", block, step_x, step_rope, max_seq_length, mask, cache_pos, kv_cache
+        )
+        breaks += explain("decode_one", decode_one, model, idx[:, -1], input_pos, max_seq_length)
+    print(f"{breaks} graph break(s) in total", flush=True)
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(report)
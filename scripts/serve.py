@@ -0,0 +1,192 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import Tokenizer
+from lit_gpt.continuous_batching import ContinuousBatchingEngine
+from lit_gpt.model import GPT, Config
+from lit_gpt.paged_kv_cache import PagedKVCache
+from lit_gpt.utils import check_valid_checkpoint_dir, lazy_load
+
+
+class IncrementalDecoder:
+    """Turns a stream of tokens into text while decoding only a few trailing tokens per step.
+
+    Decoding a token alone loses its leading space and splits characters that span several tokens, so the window
+    starts at the token before the last emitted text, and text ending in an incomplete character is held back.
+    """
+
+    def __init__(self, tokenizer: Tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self.tokens: List[int] = []
+        # `tokens[prefix_offset:read_offset]` decode to text that was already emitted
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, token: int) -> str:
+        """Append `token` and return the text it completes, possibly empty."""
+        self.tokens.append(token)
+        prefix = self.tokenizer.decode(torch.tensor(self.tokens[self.prefix_offset : self.read_offset]))
+        text = self.tokenizer.decode(torch.tensor(self.tokens[self.prefix_offset :]))
+        if len(text) <= len(prefix) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.tokens)
+        return text[len(prefix) :]
+
+
+class Server:
+    """A minimal HTTP/1.1 front end for `ContinuousBatchingEngine`.
+
+    - ``POST /generate`` with a JSON body ``{"prompt": str}`` (or ``{"prompt_ids": [int]}``) and optional
+      ``max_new_tokens``, ``temperature``, ``top_k``, ``top_p``. The response streams one JSON object per line for
+      every generated token and ends with ``{"done": true}``.
+    - ``GET /metrics`` returns the engine metrics (queue depth, tokens/sec, ...) as JSON.
+    """
+
+    def __init__(self, engine: ContinuousBatchingEngine, tokenizer: Optional[Tokenizer]) -> None:
+        self.engine = engine
+        self.tokenizer = tokenizer
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode()
+            method, path, _ = request_line.split(" ", 2)
+            headers = {}
+            while (line := (await reader.readline()).decode().strip()):
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/metrics":
+                await self.respond(writer, 200, json.dumps(self.engine.metrics()))
+            elif method == "POST" and path == "/generate":
+                await self.generate(writer, json.loads(body or b"{}"))
+            else:
+                await self.respond(writer, 404, json.dumps({"error": f"{method} {path} not found"}))
+        except (ValueError, KeyError) as e:
+            await self.respond(writer, 400, json.dumps({"error": str(e)}))
+        except ConnectionError:
+            # the client went away, `generate` has cancelled its request in the engine
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, body: str) -> None:
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode()
+            + data
+        )
+        await writer.drain()
+
+    async def generate(self, writer: asyncio.StreamWriter, params: dict) -> None:
+        if "prompt_ids" in params:
+            prompt = torch.tensor(params["prompt_ids"], dtype=torch.int)
+        elif self.tokenizer is not None:
+            prompt = self.tokenizer.encode(params["prompt"], bos=True, eos=False)
+        else:
+            raise ValueError("The server runs without a tokenizer, send `prompt_ids`")
+        # answered with a 400 by `handle`, before the streaming response starts
+        self.engine.check_prompt(prompt)
+        stop_tokens = tuple(params.get("stop_tokens", ()))
+        if self.tokenizer is not None and not stop_tokens:
+            stop_tokens = (self.tokenizer.eos_id,)
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        decoder = IncrementalDecoder(self.tokenizer) if self.tokenizer is not None else None
+        tokens = self.engine.generate(
+            prompt,
+            max_new_tokens=params.get("max_new_tokens", 128),
+            temperature=params.get("temperature", 1.0),
+            top_k=params.get("top_k"),
+            top_p=params.get("top_p"),
+            stop_tokens=stop_tokens,
+        )
+        try:
+            async for token in tokens:
+                message = {"token": token}
+                if decoder is not None:
+                    message["text"] = decoder.add(token)
+                self.write_chunk(writer, json.dumps(message) + "\n")
+                # raises a `ConnectionError` once the client has disconnected
+                await writer.drain()
+        finally:
+            # cancels the request in the engine if the client disconnected or this task was cancelled
+            await tokens.aclose()
+        self.write_chunk(writer, json.dumps({"done": True}) + "\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def write_chunk(writer: asyncio.StreamWriter, data: str) -> None:
+        encoded = data.encode()
+        writer.write(f"{len(encoded):x}\r\n".encode() + encoded + b"\r\n")
+
+
+def main(
+    checkpoint_dir: Optional[Path] = None,
+    model_name: str = "tiny_LLaMA_120M",
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 16,
+    cache_memory_gb: float = 1.0,
+    page_size: int = 16,
+    device: str = "cpu",
+    dtype: str = "float32",
+) -> None:
+    """Serve a lit_gpt model over HTTP with continuous batching.
+
+    Without `checkpoint_dir`, a randomly initialized `model_name` is served and prompts must be sent as token ids,
+    which is enough to exercise the scheduler on CPU.
+    """
+    device = torch.device(device)
+    dtype = getattr(torch, dtype)
+    if checkpoint_dir is not None:
+        check_valid_checkpoint_dir(checkpoint_dir)
+        with open(checkpoint_dir / "lit_config.json") as fp:
+            config = Config(**json.load(fp))
+        tokenizer = Tokenizer(checkpoint_dir)
+    else:
+        config = Config.from_name(model_name)
+        tokenizer = None
+    with torch.device(device):
+        model = GPT(config)
+    if checkpoint_dir is not None:
+        with lazy_load(checkpoint_dir / "lit_model.pth") as checkpoint:
+            model.load_state_dict(checkpoint.get("model", checkpoint), strict=True)
+    model = model.to(dtype=dtype).eval()
+
+    cache = PagedKVCache.from_memory_budget(
+        config, int(cache_memory_gb * 2**30), page_size=page_size, device=device, dtype=dtype
+    )
+    engine = ContinuousBatchingEngine(model, cache, max_batch_size=max_batch_size)
+    server = Server(engine, tokenizer)
+
+    async def serve() -> None:
+        engine_task = asyncio.create_task(engine.run())
+        http = await asyncio.start_server(server.handle, host, port)
+        print(f"Serving {config.name} on http://{host}:{port} ({cache.num_pages} cache pages)", flush=True)
+        async with http:
+            await asyncio.gather(http.serve_forever(), engine_task)
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(main)
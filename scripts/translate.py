@@ -0,0 +1,119 @@
+import json
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import Tokenizer
+from lit_gpt.beam_search import beam_search
+from lit_gpt.generate import generate
+from lit_gpt.model import GPT, Config
+from lit_gpt.utils import check_valid_checkpoint_dir, lazy_load
+from scripts.prepare_parallel import generate_text
+
+
+def build_prompt(text: str, src_lang: str, tgt_lang: str) -> str:
+    """The parallel training format of `generate_text` with the target side left empty, e.g. ``"en: Hello\\nid:"``.
+
+    The trailing space after the target language is dropped: in the training data it is part of the first target token.
+    """
+    # `generate_text` orders the languages alphabetically, reversed to put the target last when it sorts first
+    return generate_text({src_lang: text, tgt_lang: ""}, reverse=src_lang > tgt_lang).rstrip()
+
+
+def newline_tokens(tokenizer: Tokenizer) -> List[int]:
+    """Ids of all the tokens whose text contains a newline, the end of a translation in the parallel format."""
+    return [i for i in range(tokenizer.vocab_size) if "\n" in tokenizer.decode(torch.tensor([i]))]
+
+
+def main(
+    checkpoint_dir: Path,
+    source_file: Path,
+    output_file: Optional[Path] = None,
+    src_lang: str = "en",
+    tgt_lang: str = "id",
+    batch_size: int = 16,
+    max_new_tokens: int = 256,
+    num_beams: int = 1,
+    length_penalty: float = 1.0,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    dtype: str = "bfloat16" if torch.cuda.is_available() else "float32",
+) -> None:
+    """Translate every line of `source_file` with a lit_gpt checkpoint trained on `"{lang}: {text}"` parallel data.
+
+    Prompts are sorted by token length and decoded greedily in batches of similar lengths, so little compute goes to
+    padding. A sequence stops at its first newline or EOS token and the batch ends once all of them stopped. The
+    translations are written in the original order, one per line, to `output_file` (or stdout). With `num_beams` > 1,
+    every sentence is decoded on its own with beam search instead.
+    """
+    check_valid_checkpoint_dir(checkpoint_dir)
+    device = torch.device(device)
+    with open(checkpoint_dir / "lit_config.json") as fp:
+        config = Config(**json.load(fp))
+    tokenizer = Tokenizer(checkpoint_dir)
+    with torch.device(device):
+        model = GPT(config)
+    with lazy_load(checkpoint_dir / "lit_model.pth") as checkpoint:
+        model.load_state_dict(checkpoint.get("model", checkpoint), strict=True)
+    model = model.to(dtype=getattr(torch, dtype)).eval()
+
+    with open(source_file, encoding="utf-8") as f:
+        sources = [line.rstrip("\n") for line in f]
+    prompts = [
+        tokenizer.encode(build_prompt(text, src_lang, tgt_lang), device=device, bos=True, eos=False) for text in sources
+    ]
+    stop_tokens = [tokenizer.eos_id] + newline_tokens(tokenizer)
+
+    order = sorted(range(len(prompts)), key=lambda i: prompts[i].size(0))
+    translations: List[str] = [""] * len(prompts)
+    generated_tokens = 0
+    t0 = time.perf_counter()
+    for start in range(0, len(order), batch_size):
+        bucket = order[start : start + batch_size]
+        if num_beams > 1:
+            outputs = [
+                beam_search(
+                    model,
+                    prompts[i],
+                    max_new_tokens,
+                    num_beams=num_beams,
+                    length_penalty=length_penalty,
+                    stop_tokens=stop_tokens,
+                )[0][0]
+                for i in bucket
+            ]
+        else:
+            outputs = generate(
+                model, [prompts[i] for i in bucket], max_new_tokens, temperature=0.0, stop_tokens=stop_tokens
+            )
+        for i, output in zip(bucket, outputs):
+            translations[i] = tokenizer.decode(output).strip()
+            generated_tokens += output.size(0)
+        print(f"Translated {start + len(bucket)}/{len(order)} sentences", file=sys.stderr, flush=True)
+    elapsed = time.perf_counter() - t0
+
+    if output_file is not None:
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.writelines(t + "\n" for t in translations)
+    else:
+        print("\n".join(translations))
+    print(
+        f"{src_lang}->{tgt_lang}: {len(sources)} sentences in {elapsed:.2f}s, {len(sources) / elapsed:.2f} sentences/sec,"
+        f" {generated_tokens / elapsed:.1f} tokens/sec",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+
+    from jsonargparse import CLI
+
+    CLI(main)